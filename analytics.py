@@ -4,30 +4,412 @@
 Как это работает: Строятся перпендикуляры к отрезкам, соединяющим соседние точки. Пересечения этих перпендикуляров образуют границы полигонов.
 '''
 
-import sqlite3
+import os
+import math
+import hashlib
+import itertools
+import threading
 import numpy as np
-from scipy.spatial import Voronoi
-from shapely.geometry import Polygon, mapping, box
-import geojson
+from scipy.spatial import Voronoi, cKDTree
+import shapely
+from shapely import STRtree
+from shapely.geometry import mapping, box
+
+import db
+import geobin
+import metrics
+from serialize import dumps
+
+# отступ рамки вокруг магазинов (в градусах) - за неё полигоны не выходят
+BBOX_MARGIN = 0.05
+
+# число знаков после запятой в координатах GeoJSON (6 знаков - около 10 см)
+COORD_PRECISION = 6
+
+# знаков после запятой в двоичном формате geobin (5 знаков - около 1 м, границам зон точнее не нужно)
+BINARY_PRECISION = 5
+
+# свойства ячейки - общие для GeoJSON и geobin
+CELL_PROPERTIES = ('shop_name', 'address', 'color')
+
+# уровни упрощения ячеек - зумы карты; уровень z годится для всех зумов <= z,
+# на зумах крупнее последнего отдаётся полная геометрия
+SIMPLIFY_ZOOMS = (9, 11, 13)
+
+# допуск упрощения в пикселях тайла: вершины ближе полупикселя на экране не различимы
+SIMPLIFY_PIXELS = 0.5
+
+# режим построения по умолчанию:
+# 'planar' - lon/lat считаются плоскими X/Y (годится в пределах одного города)
+# 'projected' - каждый город строится отдельно в собственной равновеликой проекции (метры)
+VORONOI_MODE = os.environ.get('VORONOI_MODE', 'planar')
+VORONOI_MODES = ('planar', 'projected')
+
+# радиус Земли (м) для сферической проекции и отступ рамки вокруг магазинов города (м)
+EARTH_RADIUS = 6371008.8
+PROJECTED_MARGIN = 3000
+
+# путь к GeoJSON с границей города - если задан, полигоны обрезаются по ней вместо рамки
+BOUNDARY_PATH = os.environ.get('VORONOI_BOUNDARY')
+
+# кэш диаграммы Вороного: пересчёт только при смене версии данных в базе
+# хранятся ячейки и по уровням упрощения - уже сериализованные байты GeoJSON и ETag для условных запросов;
+# после обновления базы запись строится из прошлой: пересчитываются только ячейки, которых коснулись
+# вставки и удаления магазинов, а смена свойств (цвета) пересериализует только Feature этих магазинов
+# ключ словаря - режим построения (VORONOI_MODES)
+_voronoi_cache = {}
+_voronoi_lock = threading.Lock()
 
 def get_db_points():
     """
     Функция для импорта координат всех магазинов из Базы Данных
     """
-    conn = sqlite3.connect('shops.db')
+    conn = db.get_connection(readonly=True)
     cursor = conn.cursor()
     
     cursor.execute('SELECT id, shop_name, address, lat, lon, color FROM shops')
     rows = cursor.fetchall()
     
-    conn.close()
     return rows
 
-def generate_voronoi_geojson():
+def load_boundary(path):
+    """
+    Функция загрузки границы города (Polygon/MultiPolygon) из файла GeoJSON, координаты lon/lat.
+    """
+    with open(path, encoding='utf-8') as f:
+        data = shapely.from_geojson(f.read())
+    # FeatureCollection превращается в коллекцию геометрий - объединяю в одну
+    return shapely.union_all(data) if data.geom_type == 'GeometryCollection' else data
+
+def build_voronoi_cells(points, clip, frame=None, topology=False):
+    """
+    Функция построения ограниченных ячеек Вороного.
+    points - массив (n, 2) уникальных координат, clip - область обрезки (Shapely).
+    frame - рамка (min_x, min_y, max_x, max_y), от которой отстраиваются вспомогательные точки;
+    по умолчанию - общая рамка точек и области обрезки.
+    Возвращает массив полигонов Shapely длиной n: ячейка i соответствует points[i].
+    topology=True - возвращает кортеж (cells, topology), см. voronoi_topology.
+    """
+    n = len(points)
+    
+    # у крайних магазинов области уходят "в бесконечность" (вершина -1)
+    # чтобы все области стали конечными, добавляю 4 вспомогательные точки далеко за рамкой:
+    # тогда каждый магазин лежит внутри выпуклой оболочки, а ячейки вспомогательных точек
+    # заведомо не дотягиваются до рамки (они дальше от неё, чем любая точка рамки от магазинов)
+    if frame is None:
+        frame = (*np.minimum(points.min(axis=0), clip.bounds[:2]), *np.maximum(points.max(axis=0), clip.bounds[2:]))
+    min_x, min_y, max_x, max_y = frame
+    center_x, center_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+    far = 10 * max(max_x - min_x, max_y - min_y, 1e-3)
+    ghosts = np.array([
+        [center_x - far, center_y - far],
+        [center_x + far, center_y - far],
+        [center_x + far, center_y + far],
+        [center_x - far, center_y + far],
+    ])
+    
+    # диаграмма Вороного
+    vor = Voronoi(np.vstack([points, ghosts]))
+    
+    # point_region - это индекс региона, соответствующего точке points[i]
+    # вершины всех регионов склеиваются в один массив, кольца собираются одним вызовом Shapely
+    regions = [vor.regions[region_index] for region_index in vor.point_region[:n]]
+    counts = np.fromiter(map(len, regions), dtype=np.int64, count=n)
+    vertex_index = np.fromiter(itertools.chain.from_iterable(regions), dtype=np.int64, count=counts.sum())
+    
+    rings = shapely.linearrings(vor.vertices[vertex_index], indices=np.repeat(np.arange(n), counts))
+    cells = shapely.polygons(rings)
+    
+    # обрезка рамкой (или границей города) нужна только ячейкам, которые выходят за неё:
+    # подготовленная геометрия clip быстро отсеивает ячейки, лежащие целиком внутри
+    shapely.prepare(clip)
+    crossing = ~shapely.contains_properly(clip, cells)
+    cells[crossing] = shapely.intersection(cells[crossing], clip)
+    
+    if not topology:
+        return cells
+    return cells, voronoi_topology(vor, n, counts, vertex_index, tuple(map(float, frame)))
+
+def group_rows(owner, values, n):
+    """
+    Функция упаковки пар (owner, value) в сжатые строки (CSR): значения строки i -
+    values[indptr[i]:indptr[i + 1]]. Возвращает кортеж (indptr, values).
+    """
+    order = np.argsort(owner, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(owner, minlength=n))])
+    return indptr, values[order]
+
+def take_rows(indptr, rows):
+    """
+    Функция выбора нескольких строк CSR без цикла: возвращает (positions, owner) - позиции значений
+    в массиве values и номер строки (индекс в rows) для каждой позиции.
+    """
+    counts = indptr[rows + 1] - indptr[rows]
+    owner = np.repeat(np.arange(len(rows)), counts)
+    positions = np.repeat(indptr[rows], counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+    return positions, owner
+
+def voronoi_topology(vor, n, counts, vertex_index, frame):
+    """
+    Функция сохранения связности диаграммы для последующих частичных пересчётов (update_planar_cells):
+    - neighbours - соседи каждой точки по триангуляции Делоне (общее ребро ячеек), без вспомогательных точек
+    - vertices - вершины необрезанной ячейки каждой точки (центры описанных окружностей треугольников Делоне)
+    - frame - рамка вспомогательных точек
+    """
+    pairs = vor.ridge_points[(vor.ridge_points < n).all(axis=1)]
+    pairs = np.vstack([pairs, pairs[:, ::-1]])
+    return {
+        'neighbours': group_rows(pairs[:, 0], pairs[:, 1], n),
+        'vertices': (np.concatenate([[0], np.cumsum(counts)]), vor.vertices[vertex_index]),
+        'frame': frame,
+    }
+
+def match_points(old_points, points):
+    """
+    Функция сопоставления точек двух построений: для каждой точки points - индекс такой же точки
+    в old_points или -1 (новая точка). Точки сравниваются как комплексные числа x + iy.
+    """
+    old_keys = old_points[:, 0] + 1j * old_points[:, 1]
+    keys = points[:, 0] + 1j * points[:, 1]
+    order = np.argsort(old_keys)
+    position = np.minimum(np.searchsorted(old_keys[order], keys), len(order) - 1)
+    return np.where(old_keys[order][position] == keys, order[position], -1)
+
+def update_planar_cells(previous, points, clip, old_index):
+    """
+    Функция частичного пересчёта ячеек после вставки и удаления точек (вместо построения заново).
+    previous - прошлое состояние (compute_cells), old_index - результат match_points.
+
+    Меняются только ячейки:
+    - соседей удалённых точек (по старой триангуляции)
+    - точек, чьи треугольники Делоне "разрушает" новая точка (как в алгоритме Боуэра-Уотсона):
+      новая точка лежит внутри описанной окружности треугольника, т. е. ближе к вершине Вороного,
+      чем сами точки этой вершины
+    - самих новых точек.
+    Их новые соседи - среди старых соседей и самих изменённых точек, поэтому ячейки изменённых точек
+    строятся локальной диаграммой по изменённым точкам и их соседям (с теми же вспомогательными точками).
+
+    Возвращает кортеж (cells, topology, changed), changed - маска пересчитанных ячеек;
+    или None, если выгоднее построить заново (изменилась рамка или затронута большая часть точек).
+    """
+    topology = previous['topology']
+    old_points = previous['points']
+    if topology is None or not shapely.equals_exact(clip, previous['clip'], 0):
+        return None
+    
+    min_x, min_y, max_x, max_y = topology['frame']
+    inserted = np.flatnonzero(old_index < 0)
+    if not ((points[inserted] >= (min_x, min_y)).all() and (points[inserted] <= (max_x, max_y)).all()):
+        return None
+    
+    found = np.flatnonzero(old_index >= 0)
+    new_index = np.full(len(old_points), -1)
+    new_index[old_index[found]] = found
+    kept = new_index >= 0
+    
+    neighbour_indptr, neighbours = topology['neighbours']
+    vertex_indptr, vertices = topology['vertices']
+    
+    # соседи удалённых точек
+    positions, _ = take_rows(neighbour_indptr, np.flatnonzero(~kept))
+    affected = [neighbours[positions]]
+    
+    # вершины Вороного, в описанную окружность которых попала новая точка - все их точки
+    if len(inserted):
+        owner = np.repeat(np.arange(len(old_points)), np.diff(vertex_indptr))
+        radius = np.hypot(*(vertices - old_points[owner]).T)
+        distance, _ = cKDTree(points[inserted]).query(vertices)
+        affected.append(owner[distance <= radius * (1 + 1e-9)])
+    
+    affected = np.unique(np.concatenate(affected))
+    affected = affected[kept[affected]]
+    
+    changed = np.zeros(len(points), dtype=bool)
+    changed[inserted] = True
+    changed[new_index[affected]] = True
+    
+    # окружение для локальной диаграммы - изменённые точки и старые соседи изменённых
+    positions, _ = take_rows(neighbour_indptr, affected)
+    context = neighbours[positions]
+    local = np.union1d(np.flatnonzero(changed), new_index[context[kept[context]]])
+    if len(local) > len(points) // 2:
+        return None
+    
+    local_cells, local_topology = build_voronoi_cells(points[local], clip, topology['frame'], topology=True)
+    local_changed = changed[local]
+    
+    cells = np.empty(len(points), dtype=object)
+    cells[found] = previous['cells'][old_index[found]]
+    cells[local[local_changed]] = local_cells[local_changed]
+    
+    # связность: строки неизменённых точек переносятся с новыми номерами, строки изменённых - из локальной диаграммы
+    def merge(old_rows, local_rows, remap):
+        old_indptr, old_values = old_rows
+        rows = np.flatnonzero(kept & ~np.isin(new_index, local[local_changed]))
+        positions, owner = take_rows(old_indptr, rows)
+        
+        local_indptr, local_values = local_rows
+        local_positions, local_owner = take_rows(local_indptr, np.flatnonzero(local_changed))
+        
+        owner = np.concatenate([new_index[rows][owner], local[local_changed][local_owner]])
+        values = np.concatenate([remap(old_values[positions], True), remap(local_values[local_positions], False)])
+        return group_rows(owner, values, len(points))
+    
+    new_topology = {
+        'neighbours': merge(topology['neighbours'], local_topology['neighbours'],
+                            lambda values, old: new_index[values] if old else local[values]),
+        'vertices': merge(topology['vertices'], local_topology['vertices'], lambda values, old: values),
+        'frame': topology['frame'],
+    }
+    return cells, new_topology, changed
+
+def update_projected_cells(previous, points, cities, old_index):
+    """
+    Функция частичного пересчёта ячеек в режиме projected: города строятся независимо,
+    поэтому заново строятся только города, в которых изменился набор точек.
+    Возвращает кортеж (cells, changed).
+    """
+    cells = np.empty(len(points), dtype=object)
+    changed = np.zeros(len(points), dtype=bool)
+    old_cities = previous['cities']
+    
+    for city in np.unique(cities):
+        members = np.flatnonzero(cities == city)
+        old_members = old_index[members]
+        if (old_members >= 0).all() and len(members) == np.count_nonzero(old_cities == city) \
+                and (old_cities[old_members] == city).all():
+            cells[members] = previous['cells'][old_members]
+        else:
+            cells[members] = build_projected_cells(points[members], cities[members])
+            changed[members] = True
+    
+    return cells, changed
+
+def cells_to_geometries(cells, precision=COORD_PRECISION):
+    """
+    Функция перевода ячеек Shapely в словари геометрий GeoJSON.
+    Простые полигоны (без дыр) обрабатываются векторно через numpy,
+    остальные (после обрезки по невыпуклой границе) - через shapely.mapping.
+    """
+    geometries = [None] * len(cells)
+    
+    simple = (shapely.get_type_id(cells) == 3) & (shapely.get_num_interior_rings(cells) == 0) & ~shapely.is_empty(cells)
+    simple_index = np.flatnonzero(simple)
+    
+    if len(simple_index):
+        coords, owner = shapely.get_coordinates(
+            shapely.get_exterior_ring(cells[simple_index]), return_index=True
+        )
+        # один вызов tolist() на все вершины, дальше - срезы списка по границам колец
+        coords = np.round(coords, precision).tolist()
+        bounds = np.flatnonzero(np.diff(owner)) + 1
+        starts = [0, *bounds.tolist()]
+        ends = [*bounds.tolist(), len(coords)]
+        for i, start, end in zip(simple_index.tolist(), starts, ends):
+            geometries[i] = {'type': 'Polygon', 'coordinates': [coords[start:end]]}
+    
+    for i in np.flatnonzero(~simple):
+        if not cells[i].is_empty:
+            geometries[i] = mapping(cells[i])
+    
+    return geometries
+
+def laea_forward(points, lon0, lat0):
+    """
+    Функция перевода lon/lat (градусы) в метры азимутальной равновеликой проекции Ламберта
+    с центром (lon0, lat0). Сфера радиуса EARTH_RADIUS; points - массив (n, 2).
+    """
+    lon, lat = np.radians(points[:, 0]), np.radians(points[:, 1])
+    lon0, lat0 = np.radians(lon0), np.radians(lat0)
+    
+    cos_dlon = np.cos(lon - lon0)
+    k = np.sqrt(2 / (1 + np.sin(lat0) * np.sin(lat) + np.cos(lat0) * np.cos(lat) * cos_dlon))
+    x = EARTH_RADIUS * k * np.cos(lat) * np.sin(lon - lon0)
+    y = EARTH_RADIUS * k * (np.cos(lat0) * np.sin(lat) - np.sin(lat0) * np.cos(lat) * cos_dlon)
+    return np.column_stack([x, y])
+
+def laea_inverse(points, lon0, lat0):
+    """
+    Функция обратного перевода метров проекции Ламберта в lon/lat (градусы).
+    """
+    x, y = points[:, 0], points[:, 1]
+    lon0, lat0 = np.radians(lon0), np.radians(lat0)
+    
+    rho = np.hypot(x, y)
+    c = 2 * np.arcsin(np.clip(rho / (2 * EARTH_RADIUS), -1, 1))
+    # в центре проекции rho = 0 - деление заменяю нулём, там lat = lat0
+    ratio = np.divide(y * np.sin(c), rho, out=np.zeros_like(rho), where=rho > 0)
+    
+    lat = np.arcsin(np.cos(c) * np.sin(lat0) + ratio * np.cos(lat0))
+    lon = lon0 + np.arctan2(x * np.sin(c), rho * np.cos(lat0) * np.cos(c) - y * np.sin(lat0) * np.sin(c))
+    return np.column_stack([np.degrees(lon), np.degrees(lat)])
+
+def get_city(address):
+    """
+    Функция выделения города из адреса вида 'Минск, ул. ...'.
+    """
+    return address.split(',')[0].strip()
+
+def build_projected_cells(points, cities):
+    """
+    Функция построения ячеек Вороного по городам в проекции.
+    Для каждого города точки переводятся в метры проекции с центром в этом городе,
+    диаграмма строится только по его магазинам, ячейки возвращаются обратно в lon/lat.
+    Стоимость - сумма по городам, а не одна большая искажённая диаграмма на всю страну.
+    """
+    cells = np.empty(len(points), dtype=object)
+    
+    for city in np.unique(cities):
+        members = np.flatnonzero(cities == city)
+        lon0, lat0 = points[members].mean(axis=0)
+        projected = laea_forward(points[members], lon0, lat0)
+        
+        # рамка вокруг магазинов города в метрах
+        min_x, min_y = projected.min(axis=0) - PROJECTED_MARGIN
+        max_x, max_y = projected.max(axis=0) + PROJECTED_MARGIN
+        
+        city_cells = build_voronoi_cells(projected, box(min_x, min_y, max_x, max_y))
+        cells[members] = shapely.transform(city_cells, lambda xy: laea_inverse(xy, lon0, lat0))
+    
+    return cells
+
+def generate_voronoi_geojson(boundary=None, mode='planar'):
     """
     Функция для построения полигонов Вороного вокруг магазинов из базы данных.
+    Полигоны обрезаются рамкой вокруг магазинов или границей города boundary.
+    mode='projected' - построение по городам в проекции (см. build_projected_cells).
     Возвращает FeatureCollection в формате GeoJSON.
     """
+    result = compute_voronoi(boundary, mode)
+    if result is None:
+        return None
+    
+    features, _ = result
+    return {'type': 'FeatureCollection', 'features': features}
+
+def compute_voronoi(boundary=None, mode='planar'):
+    """
+    Функция построения ячеек Вороного для магазинов из базы данных.
+    Возвращает кортеж (features, cells): список Feature GeoJSON и массив полигонов Shapely
+    в том же порядке, или None, если магазинов нет.
+    """
+    state = compute_cells(boundary, mode)
+    if state is None:
+        return None
+    
+    return cells_to_features(state['rows'], state['cells'], state['point_index'])
+
+def compute_cells(boundary=None, mode='planar', previous=None):
+    """
+    Функция построения ячеек Вороного без перевода в GeoJSON.
+    previous - состояние прошлого построения: если задано, пересчитываются только ячейки,
+    которых коснулись вставки и удаления магазинов (update_planar_cells / update_projected_cells).
+    Возвращает состояние - словарь:
+    rows (строки магазинов), points (уникальные точки), point_index (номер точки для каждой строки),
+    cells (ячейки точек), clip, topology, cities (для частичных пересчётов),
+    old_index и changed (сопоставление с previous и маска пересчитанных ячеек; None - построено заново);
+    или None, если магазинов нет.
+    """
     rows = get_db_points()
     
     if not rows:
@@ -35,57 +417,339 @@ def generate_voronoi_geojson():
         return None
     
     # метод Voronoi работает в плоскости и для точных карт нужно использовать проекции
-    # я оперирую в рамках одного города - можно пренебречь искажениями и считать lat/lon координатами X/Y
+    # в режиме planar я оперирую в рамках одного города - можно пренебречь искажениями и считать lon/lat координатами X/Y
+    # точки сразу собираются в порядке (lon, lat), как ждёт GeoJSON - переставлять координаты не нужно
+    points = np.array([(row[4], row[3]) for row in rows], dtype=float)
     
-    # подготовка данных - списка координат
-    points = np.array([[row[3], row[4]] for row in rows])
+    # несколько магазинов по одному адресу - одна точка, ячейка достаётся каждому из них
+    unique_points, point_index = np.unique(points, axis=0, return_inverse=True)
+    point_index = point_index.ravel()
     
-    # диаграмма Вороного
-    vor = Voronoi(points)
+    state = {
+        'rows': rows,
+        'points': unique_points,
+        'point_index': point_index,
+        'clip': boundary,
+        'topology': None,
+        'cities': None,
+        'old_index': None,
+        'changed': None,
+    }
+    if previous is not None:
+        old_index = match_points(previous['points'], unique_points)
+    
+    if mode == 'projected':
+        # город берётся из адреса первого магазина в точке
+        _, first_row = np.unique(point_index, return_index=True)
+        cities = np.array([get_city(rows[i][2]) for i in first_row])
+        state['cities'] = cities
+        
+        if previous is not None and previous['cities'] is not None and (
+                boundary is None and previous['clip'] is None
+                or boundary is not None and previous['clip'] is not None and shapely.equals_exact(boundary, previous['clip'], 0)):
+            cells, changed = update_projected_cells(previous, unique_points, cities, old_index)
+            if boundary is not None:
+                cells[changed] = shapely.intersection(cells[changed], boundary)
+            state.update(cells=cells, old_index=old_index, changed=changed)
+            return state
+        
+        cells = build_projected_cells(unique_points, cities)
+        if boundary is not None:
+            cells = shapely.intersection(cells, boundary)
+        state['cells'] = cells
+        return state
     
     # ограничивающая рамка bbox вокруг наших точек, чтобы полигоны не выходили за неё
     # границы рамки - мин/макс координаты магазинов -/+ отступ
-    min_lat, min_lon = points.min(axis=0) - 0.05
-    max_lat, max_lon = points.max(axis=0) + 0.05
-    bbox = box(min_lat, min_lon, max_lat, max_lon)
+    if boundary is None:
+        min_lon, min_lat = points.min(axis=0) - BBOX_MARGIN
+        max_lon, max_lat = points.max(axis=0) + BBOX_MARGIN
+        boundary = box(min_lon, min_lat, max_lon, max_lat)
+    state['clip'] = boundary
     
-    features = []
+    update = None
+    if previous is not None:
+        update = update_planar_cells(previous, unique_points, boundary, old_index)
+    if update is not None:
+        cells, topology, changed = update
+        state.update(cells=cells, topology=topology, old_index=old_index, changed=changed)
+    else:
+        state['cells'], state['topology'] = build_voronoi_cells(unique_points, boundary, topology=True)
     
-    # перебор полигонов = областей, созданных алгоритмом Voronoi
-    # point_region - это индекс региона, соответствующего точке points[i]
-    for i, region_index in enumerate(vor.point_region):
-        region = vor.regions[region_index]
+    return state
+
+def cells_to_features(rows, cells, point_index, precision=COORD_PRECISION):
+    """
+    Функция сборки Feature GeoJSON: каждому магазину - ячейка его точки.
+    Возвращает кортеж (features, cells) - ячейки в порядке features.
+    """
+    geometries = cells_to_geometries(cells, precision)
+    
+    features = []
+    feature_cells = []
+    for row, cell_index in zip(rows, point_index):
+        geometry = geometries[cell_index]
         
-        # если область пустая или содержит вершину "в бесконечности" (-1), она игнорируется
-        if not region or -1 in region:
+        # магазин вне границы города (или ячейка меньше шага сетки на этом уровне упрощения) - ячейки нет
+        if geometry is None:
             continue
         
-        # координаты вершин областей
-        polygon_coords = [vor.vertices[i] for i in region]
-        
-        # объект типа Polygon из библиотеки Shapely с координатами вершин областей
-        clipped_poly = Polygon(polygon_coords)
-        
-        if clipped_poly.is_empty:
-            continue
+        feature_cells.append(cell_index)
+        features.append({
+            'type': 'Feature',
+            'geometry': geometry,
+            'properties': {
+                'shop_name': row[1],
+                'address': row[2],
+                'color': row[5]
+            }
+        })
+    
+    return features, cells[np.array(feature_cells, dtype=np.int64)]
+
+def zoom_tolerance(zoom):
+    """
+    Функция допуска упрощения (градусы) для зума карты: доля SIMPLIFY_PIXELS пикселя тайла 256 px.
+    """
+    return SIMPLIFY_PIXELS * 360 / (256 * 2 ** zoom)
+
+def zoom_precision(zoom):
+    """
+    Функция числа знаков после запятой в координатах для уровня упрощения:
+    на один знак точнее шага сетки, но не больше COORD_PRECISION.
+    """
+    return min(COORD_PRECISION, math.ceil(-math.log10(zoom_tolerance(zoom))) + 1)
+
+def zoom_level(zoom):
+    """
+    Функция выбора уровня упрощения для зума карты: самый грубый уровень, который на этом зуме
+    ещё не отличим от полной геометрии. None - полная геометрия.
+    """
+    if zoom is None or zoom > SIMPLIFY_ZOOMS[-1]:
+        return None
+    return min(level for level in SIMPLIFY_ZOOMS if level >= zoom)
+
+def simplify_cells(cells, tolerance):
+    """
+    Функция упрощения ячеек с сохранением общих границ (без щелей между соседями).
+    1. shapely.coverage_simplify (GEOS >= 3.12) упрощает рёбра покрытия целиком: общее ребро двух ячеек
+       упрощается один раз и одинаково для обеих; у ячеек Вороного рёбра прямые, так что это
+       в основном касается ломаной границы города (VORONOI_BOUNDARY).
+    2. Вершины привязываются к сетке с шагом tolerance (shapely.set_precision): узлы ближе шага
+       сливаются, короткие рёбра исчезают. Общая вершина соседей округляется одинаково - щелей нет.
+       В отличие от простого округления координат, set_precision исправляет получившиеся самопересечения
+       (ячейка остаётся валидной, и обрезка по рамке не падает с TopologyException), а ячейки меньше шага
+       становятся пустыми - на этом уровне их не видно.
+    """
+    if hasattr(shapely, 'coverage_simplify'):
+        try:
+            cells = shapely.coverage_simplify(cells, tolerance)
+        except shapely.errors.GEOSException as e:
+            print(f' [Warn] coverage_simplify не справился ({e}), только привязка к сетке.')
+    
+    return shapely.set_precision(cells, tolerance)
+
+def build_voronoi_cache(version, mode, previous=None):
+    """
+    Функция подготовки записи кэша: ячейки строятся один раз, уровни упрощения (см. get_voronoi_level)
+    собираются из них при первом запросе соответствующего зума.
+    previous - запись кэша прошлой версии данных: ячейки пересчитываются частично,
+    а уже собранные уровни обновляются сразу - только по изменившимся ячейкам и магазинам.
+    """
+    boundary = load_boundary(BOUNDARY_PATH) if BOUNDARY_PATH else None
+    previous_state = previous['state'] if previous is not None else None
+    
+    with metrics.span('voronoi_build', mode=mode):
+        state = compute_cells(boundary, mode, previous_state)
+    
+    levels = {}
+    if state is not None:
+        incremental = state['changed'] is not None
+        rebuilt = np.count_nonzero(state['changed']) if incremental else len(state['points'])
+        metrics.inc('voronoi_cells_rebuilt_total', rebuilt, 'Пересчитанные ячейки Вороного',
+                    mode=mode, kind='incremental' if incremental else 'full')
         
-        # формирование GeoJSON
-        # может быть путаница с координатами: GeoJSON ждёт (lon, lat), у меня (lat, lon)
-        # mappint(clipped_poly) вернет структуру координат, её меняю местами
-        swapped_coords = []
-        if clipped_poly.geom_type == 'Polygon':
-            exterior = [[p[1], p[0]] for p in list(clipped_poly.exterior.coords)]
-            swapped_coords.append(exterior)
+        if incremental:
+            for level, previous_level in previous['levels'].items():
+                levels[level] = build_voronoi_level(state, level, previous_level)
+    
+    return {
+        'version': version,
+        'state': state,
+        'levels': levels,
+    }
+
+def build_voronoi_level(state, level, previous=None):
+    """
+    Функция подготовки уровня кэша: каждый полигон сериализуется один раз,
+    поверх полигонов строится пространственный индекс STRtree для запросов по рамке.
+    level - зум из SIMPLIFY_ZOOMS (упрощённые ячейки) или None (полная геометрия).
+    previous - тот же уровень прошлой версии: упрощаются и переводятся в GeoJSON только
+    пересчитанные ячейки, Feature сериализуется заново, только если изменились его ячейка или свойства
+    (смена цвета магазина - это новые свойства при той же геометрии).
+    """
+    precision = COORD_PRECISION if level is None else zoom_precision(level)
+    if state is None:
+        fragments, tree, properties = [], None, []
+        body = dumps(None)
+        binary = encode_cells([], [])
+        return {
+            'precision': precision,
+            'etag': hashlib.sha1(body).hexdigest()[:16],
+            'body': body,
+            'binary_etag': hashlib.sha1(binary).hexdigest()[:16],
+            'binary': binary,
+            'fragments': fragments,
+            'properties': properties,
+            'tree': tree,
+            'cells': None,
+        }
+    
+    cells = state['cells']
+    level_cells = np.empty(len(cells), dtype=object)
+    geometries = np.empty(len(cells), dtype=object)
+    row_fragments = {}
+    
+    if previous is not None and previous['cells'] is not None and state['changed'] is not None:
+        changed, old_index = state['changed'], state['old_index']
+        kept = np.flatnonzero(~changed)
+        level_cells[kept] = previous['cells'][old_index[kept]]
+        geometries[kept] = previous['geometries'][old_index[kept]]
+        row_fragments = previous['row_fragments']
+        redo = np.flatnonzero(changed)
+    else:
+        redo = np.arange(len(cells))
+    
+    if len(redo):
+        if level is None:
+            level_cells[redo] = cells[redo]
+        else:
+            # общие рёбра упрощаются вместе с соседями - так же, как при упрощении всего покрытия
+            context = redo
+            if state['topology'] is not None and len(redo) < len(cells):
+                indptr, neighbours = state['topology']['neighbours']
+                positions, _ = take_rows(indptr, redo)
+                context = np.union1d(redo, neighbours[positions])
+            with metrics.span('voronoi_simplify', level=level):
+                simplified = simplify_cells(cells[context], zoom_tolerance(level))
+            level_cells[redo] = simplified[np.isin(context, redo)]
         
-        feature = geojson.Feature(
-            geometry=geojson.Polygon(swapped_coords),
-            properties={
-                'shop_name': rows[i][1],
-                'address': rows[i][2],
-                'color': rows[i][5]
-            }
-        )
-        features.append(feature)
+        redo_geometries = np.empty(len(redo), dtype=object)
+        redo_geometries[:] = cells_to_geometries(level_cells[redo], precision)
+        geometries[redo] = redo_geometries
+    
+    # Feature каждого магазина: готовый фрагмент прошлой версии берётся, если у магазина
+    # та же геометрия (тот же объект - ячейка не пересчитывалась) и те же свойства
+    fragments, properties, feature_cells = [], [], []
+    new_row_fragments = {}
+    with metrics.span('serialize', target='voronoi'):
+        for row, cell_index in zip(state['rows'], state['point_index']):
+            geometry = geometries[cell_index]
+            
+            # магазин вне границы города (или ячейка меньше шага сетки на этом уровне упрощения) - ячейки нет
+            if geometry is None:
+                continue
+            
+            feature_properties = {'shop_name': row[1], 'address': row[2], 'color': row[5]}
+            cached = row_fragments.get(row[0])
+            if cached is not None and cached[0] is geometry and cached[1] == feature_properties:
+                fragment = cached[2]
+            else:
+                fragment = dumps({'type': 'Feature', 'geometry': geometry, 'properties': feature_properties})
+            
+            new_row_fragments[row[0]] = (geometry, feature_properties, fragment)
+            fragments.append(fragment)
+            properties.append(feature_properties)
+            feature_cells.append(cell_index)
+    
+    feature_cells = level_cells[np.array(feature_cells, dtype=np.int64)]
+    body = join_features(fragments)
+    binary = encode_cells(feature_cells, properties, min(precision, BINARY_PRECISION))
+    
+    return {
+        'precision': precision,
+        'etag': hashlib.sha1(body).hexdigest()[:16],
+        'body': body,
+        'binary_etag': hashlib.sha1(binary).hexdigest()[:16],
+        'binary': binary,
+        'fragments': fragments,
+        'properties': properties,
+        'tree': STRtree(feature_cells),
+        # ячейки и геометрии GeoJSON по точкам и фрагменты по магазинам - для обновления следующей версии
+        'cells': level_cells,
+        'geometries': geometries,
+        'row_fragments': new_row_fragments,
+    }
+
+def encode_cells(cells, properties, precision=BINARY_PRECISION):
+    """
+    Функция кодирования ячеек и их свойств в двоичный формат geobin (квантованные координаты).
+    """
+    columns = {name: [item[name] for item in properties] for name in CELL_PROPERTIES}
+    return geobin.encode(cells, columns, precision)
+
+def join_features(fragments):
+    """
+    Функция склейки заранее сериализованных Feature в FeatureCollection (байты).
+    """
+    return b'{"type":"FeatureCollection","features":[' + b','.join(fragments) + b']}'
+
+def get_voronoi_level(mode=None, zoom=None):
+    """
+    Функция получения уровня кэша диаграммы Вороного для зума карты.
+    Диаграмма пересчитывается только если версия данных изменилась.
+    """
+    mode = mode or VORONOI_MODE
+    version = db.get_data_version()
+    level = zoom_level(zoom)
+    
+    # быстрый путь - версия не менялась и уровень уже собран
+    cache = _voronoi_cache.get(mode)
+    if cache is not None and cache['version'] == version and level in cache['levels']:
+        return cache['levels'][level]
+    
+    # под блокировкой - чтобы параллельные запросы не считали одно и то же
+    with _voronoi_lock:
+        cache = _voronoi_cache.get(mode)
+        if cache is None or cache['version'] != version:
+            # запись заменяется целиком - читатели без блокировки видят согласованное состояние;
+            # прошлая запись нужна, чтобы пересчитать только изменившиеся ячейки
+            cache = build_voronoi_cache(version, mode, cache)
+            _voronoi_cache[mode] = cache
         
-    return geojson.FeatureCollection(features)
+        if level not in cache['levels']:
+            cache['levels'][level] = build_voronoi_level(cache['state'], level)
+        return cache['levels'][level]
+
+def drop_voronoi_cache(mode=None):
+    """
+    Функция освобождения кэша режима mode: веб-приложение вызывает её, когда диаграмма этого режима
+    отдаётся из общего снимка (store.py) и собственная копия процесса больше не нужна.
+    """
+    with _voronoi_lock:
+        _voronoi_cache.pop(mode or VORONOI_MODE, None)
 
+def get_voronoi_cached(mode=None, bbox=None, binary=False, zoom=None):
+    """
+    Функция получения диаграммы Вороного из кэша.
+    Возвращает кортеж (etag, body), где body - готовые байты GeoJSON (или geobin, если binary).
+    bbox=(min_lon, min_lat, max_lon, max_lat) - только полигоны, пересекающие рамку.
+    zoom - зум карты: на мелких зумах отдаются упрощённые ячейки (см. SIMPLIFY_ZOOMS).
+    """
+    cache = get_voronoi_level(mode, zoom)
+    
+    etag, body = (cache['binary_etag'], cache['binary']) if binary else (cache['etag'], cache['body'])
+    if bbox is None or cache['tree'] is None:
+        return etag, body
+    
+    # полигоны в рамке - через индекс STRtree, в исходном порядке
+    index = np.sort(cache['tree'].query(box(*bbox), predicate='intersects'))
+    if binary:
+        properties = cache['properties']
+        body = encode_cells(cache['tree'].geometries[index], [properties[i] for i in index],
+                            min(cache['precision'], BINARY_PRECISION))
+    else:
+        fragments = cache['fragments']
+        body = join_features([fragments[i] for i in index])
+    etag = hashlib.sha1(f'{etag}:{bbox}'.encode()).hexdigest()[:16]
+    return etag, body
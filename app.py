@@ -1,56 +1,287 @@
-from flask import Flask, jsonify, render_template
-import sqlite3
-from analytics import generate_voronoi_geojson
+import hashlib
+import os
+import time
+
+from flask import Flask, Response, abort, g, render_template, request, send_file, send_from_directory, stream_with_context
+import db
+import metrics
+from serialize import dumps
+from geodata import iter_shops_from_db, shops_geobin, stream_shops_geojson
+from geobin import MIMETYPE as GEOBIN_MIMETYPE
+from tiles import parse_bbox, tile_bbox
+from analytics import VORONOI_MODES, drop_voronoi_cache, get_voronoi_cached, zoom_level
+from clusters import clusters_geobin, clusters_geojson, find_clusters
+from heatmap import get_tile as get_heatmap_tile
+from export import ENCODINGS, MANIFEST_NAME, SNAPSHOT_DIR
+from history import get_shop_history
+from shop_index import MAX_NEAREST, MAX_RADIUS, find_best, find_nearest
+from store import get_store, shops_body, voronoi_body
 
 app = Flask(__name__)
 
-def get_shops_from_db():
-    conn = sqlite3.connect('shops.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+# соединения с базой живут в потоке (db.get_connection) и переиспользуются, пока поток жив;
+# сервер, который создаёт поток на каждый запрос (отладочный сервер Flask), их не переиспользует -
+# тогда соединения закрываются в конце запроса (DB_CLOSE_ON_TEARDOWN=1 или запуск python app.py)
+app.config['DB_CLOSE_ON_TEARDOWN'] = os.environ.get('DB_CLOSE_ON_TEARDOWN') == '1'
+
+# выборочный профилировщик - если задана переменная окружения PROFILE_INTERVAL
+metrics.start_profiler()
+
+# самый крупный зум карты, который принимает API
+MAX_ZOOM = 22
+
+# снимки с хэшем в имени не меняются - браузер и CDN могут хранить их год
+SNAPSHOT_MAX_AGE = 365 * 24 * 3600
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    # время запроса записывается, когда ответ отдан целиком - для потоковых ответов это конец потока
+    started = g.get('started')
+    if started is None:
+        return response
+    
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method, status = request.method, response.status_code
     
-    cursor.execute('SELECT * FROM shops')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    def observe():
+        metrics.observe(
+            'http_request_duration_seconds', time.perf_counter() - started,
+            'Время обработки запросов по маршрутам, сек', route=route, method=method, status=status
+        )
+    response.call_on_close(observe)
+    return response
+
+@app.teardown_appcontext
+def close_db(exc):
+    if app.config['DB_CLOSE_ON_TEARDOWN']:
+        db.close_connections()
+
+@app.route('/metrics')
+def api_metrics():
+    # метрики веб-приложения и (из файла) процесса обновления данных
+    body = metrics.render() + metrics.read_textfile()
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+def get_bbox_arg():
+    """
+    Функция чтения необязательного параметра запроса bbox=min_lon,min_lat,max_lon,max_lat.
+    """
+    text = request.args.get('bbox')
+    if text is None:
+        return None
+    try:
+        return parse_bbox(text)
+    except ValueError as e:
+        abort(400, str(e))
+
+def get_tile_bbox(z, x, y):
+    """
+    Функция рамки тайла z/x/y для маршрутов тайлов: зум больше MAX_ZOOM - 400 (как у параметра zoom),
+    номер вне сетки уровня - 404.
+    """
+    if z > MAX_ZOOM:
+        abort(400, f'zoom должен быть от 0 до {MAX_ZOOM}')
+    try:
+        return tile_bbox(z, x, y)
+    except ValueError as e:
+        abort(404, str(e))
+
+def wants_binary():
+    """
+    Функция выбора формата ответа: параметр format=json|bin, иначе - по заголовку Accept
+    (GeoJSON, если клиент явно не просит geobin).
+    """
+    fmt = request.args.get('format')
+    if fmt is not None:
+        if fmt not in ('json', 'bin'):
+            abort(400, 'format должен быть json или bin')
+        return fmt == 'bin'
+    return request.accept_mimetypes.best_match(['application/json', GEOBIN_MIMETYPE]) == GEOBIN_MIMETYPE
+
+def store_response(etag, body, path, mimetype):
+    """
+    Функция ответа из общего снимка (store.py): готовый файл целиком или собранные байты по рамке.
+    Браузер перепроверяет данные при каждом запросе (ETag).
+    """
+    if path is not None:
+        response = send_file(path, mimetype=mimetype, etag=etag)
+    else:
+        response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+    response.vary.add('Accept')
+    response.cache_control.no_cache = True
+    return response
+
+def shops_response(bbox):
+    # если опубликован общий снимок - магазины берутся из него, без запроса к базе
+    store = get_store()
+    binary = wants_binary()
+    if store is not None:
+        return store_response(*shops_body(store, bbox, binary), GEOBIN_MIMETYPE if binary else 'application/json')
+    
+    if binary:
+        response = Response(shops_geobin(bbox), mimetype=GEOBIN_MIMETYPE)
+    else:
+        cursor = iter_shops_from_db(bbox)
+        response = Response(stream_with_context(stream_shops_geojson(cursor)), mimetype='application/json')
+    response.vary.add('Accept')
+    return response
 
 @app.route('/api/shops')
 def api_shops():
-    rows = get_shops_from_db()
-    
-    features = []
-    for row in rows:
-        feature = {
-            'type': 'Feature',
-            'properties': {
-                'shop_name': row['shop_name'],
-                'address': row['address'],
-                'discount': row['discount'],
-                'color': row['color']
-            },
-            'geometry': {
-                'type': 'Point',
-                'coordinates': [row['lon'], row['lat']]
-            }
-        }
-        features.append(feature)
-    
-    geojson = {
-        'type': 'FeatureCollection',
-        'features': features
-    }
-    
-    return jsonify(geojson)
+    return shops_response(get_bbox_arg())
+
+@app.route('/api/shops/tiles/<int:z>/<int:x>/<int:y>')
+def api_shops_tile(z, x, y):
+    return shops_response(get_tile_bbox(z, x, y))
+
+@app.route('/api/shops/clusters')
+def api_shop_clusters():
+    # кластеры магазинов для зума карты: число магазинов и лучший магазин в каждом
+    zoom = request.args.get('zoom', type=int)
+    if zoom is None or not 0 <= zoom <= MAX_ZOOM:
+        abort(400, f'Нужен параметр zoom от 0 до {MAX_ZOOM}')
+    bbox = get_bbox_arg()
+    binary = wants_binary()
+
+    version, positions, properties = find_clusters(zoom, bbox)
+    if binary:
+        response = Response(clusters_geobin(positions, properties), mimetype=GEOBIN_MIMETYPE)
+    else:
+        response = Response(clusters_geojson(positions, properties), mimetype='application/json')
+
+    # кластеры меняются только вместе с версией данных
+    response.set_etag(hashlib.sha1(f'{version}:{zoom}:{bbox}:{binary}'.encode()).hexdigest()[:16])
+    response.vary.add('Accept')
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/api/heatmap/<int:z>/<int:x>/<int:y>.png')
+def api_heatmap_tile(z, x, y):
+    # тайл тепловой карты: цвет - самый выгодный магазин в пешей доступности
+    get_tile_bbox(z, x, y)
+    version, png = get_heatmap_tile(z, x, y)
+
+    response = Response(png, mimetype='image/png')
+    # тайл меняется только вместе с версией данных
+    response.set_etag(hashlib.sha1(f'{version}:{z}:{x}:{y}'.encode()).hexdigest()[:16])
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/api/shops/<int:shop_id>/history')
+def api_shop_history(shop_id):
+    # изменения цены магазина по датам и сводка "сегодня против типичного" по дням недели
+    result = get_shop_history(shop_id)
+    if result is None:
+        abort(404, f'Нет истории цен магазина {shop_id}')
+    return Response(dumps(result), mimetype='application/json')
+
+@app.route('/snapshots/<path:filename>')
+def snapshot(filename):
+    # манифест перепроверяется при каждом открытии карты (ETag), снимки кэшируются навсегда
+    if filename == MANIFEST_NAME:
+        response = send_from_directory(SNAPSHOT_DIR, filename, mimetype='application/json', max_age=0)
+        response.cache_control.no_cache = True
+        return response
+    
+    mimetype = GEOBIN_MIMETYPE if filename.endswith('.bin') else 'application/json'
+    
+    # готовая сжатая копия выбирается по Accept-Encoding (brotli лучше gzip), сжатия на лету нет
+    accepted = request.accept_encodings
+    for ext, (encoding, _) in ENCODINGS.items():
+        if accepted[encoding] and os.path.exists(os.path.join(SNAPSHOT_DIR, filename + ext)):
+            response = send_from_directory(SNAPSHOT_DIR, filename + ext, mimetype=mimetype, max_age=SNAPSHOT_MAX_AGE)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(SNAPSHOT_DIR, filename, mimetype=mimetype, max_age=SNAPSHOT_MAX_AGE)
+    
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/')
 def index():
     return render_template('map.html')
 
+def voronoi_response(bbox, zoom=None):
+    # режим построения: planar (по умолчанию) или projected - по городам в проекции
+    mode = request.args.get('mode')
+    if mode is not None and mode not in VORONOI_MODES:
+        abort(400, f'mode должен быть одним из: {", ".join(VORONOI_MODES)}')
+    
+    # зум карты: на мелких зумах ячейки отдаются упрощёнными (у тайлов - зум тайла)
+    zoom = request.args.get('zoom', default=zoom, type=int)
+    if zoom is not None and not 0 <= zoom <= MAX_ZOOM:
+        abort(400, f'zoom должен быть от 0 до {MAX_ZOOM}')
+    
+    # диаграмма берётся из общего снимка (для режима, в котором он построен)
+    binary = wants_binary()
+    mimetype = GEOBIN_MIMETYPE if binary else 'application/json'
+    store = get_store()
+    if store is not None and mode in (None, store['meta']['voronoi_mode']):
+        # диаграмма, построенная по SQLite до публикации снимка, больше не нужна
+        drop_voronoi_cache(store['meta']['voronoi_mode'])
+        return store_response(*voronoi_body(store, zoom_level(zoom), bbox, binary), mimetype)
+    
+    # иначе - из кэша процесса, который пересчитывается только после обновления базы
+    with metrics.span('voronoi_response', format='bin' if binary else 'json'):
+        etag, body = get_voronoi_cached(mode, bbox, binary, zoom)
+    
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    # браузер перепроверяет данные при каждом запросе, при совпадении ETag получает 304 без тела
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route('/api/voronoi')
 def api_voronoi():
-    data = generate_voronoi_geojson()
-    return jsonify(data)
+    return voronoi_response(get_bbox_arg())
+
+@app.route('/api/voronoi/tiles/<int:z>/<int:x>/<int:y>')
+def api_voronoi_tile(z, x, y):
+    return voronoi_response(get_tile_bbox(z, x, y), z)
+
+def get_point_args():
+    """
+    Функция чтения обязательных параметров запроса lat и lon.
+    """
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        abort(400, 'Нужны параметры lat и lon (градусы)')
+    return lat, lon
+
+@app.route('/api/nearest')
+def api_nearest():
+    # k ближайших магазинов к точке пользователя
+    lat, lon = get_point_args()
+    k = request.args.get('k', default=5, type=int)
+    if not 1 <= k <= MAX_NEAREST:
+        abort(400, f'k должен быть от 1 до {MAX_NEAREST}')
+    
+    return Response(dumps(find_nearest(lat, lon, k)), mimetype='application/json')
+
+@app.route('/api/best')
+def api_best():
+    # самые выгодные магазины в радиусе radius метров от точки пользователя
+    lat, lon = get_point_args()
+    radius = request.args.get('radius', default=2000, type=float)
+    limit = request.args.get('limit', default=10, type=int)
+    if not 0 < radius <= MAX_RADIUS:
+        abort(400, f'radius должен быть от 0 до {MAX_RADIUS} м')
+    if not 1 <= limit <= MAX_NEAREST:
+        abort(400, f'limit должен быть от 1 до {MAX_NEAREST}')
+    
+    return Response(dumps(find_best(lat, lon, radius, limit)), mimetype='application/json')
 
 if __name__ == '__main__':
-    print(app.url_map)
+    app.config['DB_CLOSE_ON_TEARDOWN'] = True
     app.run(debug=True)
\ No newline at end of file
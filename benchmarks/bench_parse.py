@@ -0,0 +1,53 @@
+'''
+Замер скорости разбора страниц источников на HTML из benchmarks/fixtures.
+Это не сохранённые страницы сайтов, а синтетическая разметка: блоки и классы, которые ищут
+parse_modamax / parse_econom (таблица цен, ячейки "сегодня", адреса), плюс меню, встроенный скрипт
+с данными и лишние блоки - чтобы объём и "шум" страницы были порядка настоящих. Абсолютное время
+на живых страницах может отличаться; замер годится для сравнения вариантов разбора между собой.
+Сравниваются:
+- "полное дерево html.parser" - только построение полного дерева страницы, как делал прежний код
+  до любых find_all (нижняя граница его стоимости);
+- parse_*(parser='html.parser') - текущий разбор с фильтром SoupStrainer на встроенном парсере;
+- parse_*(parser='lxml') - текущий разбор с фильтром SoupStrainer на lxml.
+
+Запуск из корня проекта: python benchmarks/bench_parse.py
+'''
+
+import contextlib
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+import scraper
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+REPEAT = 5
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+def best_time(func):
+    # отладочные print внутри парсеров не должны попадать в замер
+    with contextlib.redirect_stdout(io.StringIO()):
+        return min(timeit.repeat(func, number=1, repeat=REPEAT))
+
+def main():
+    for name, parse in (('modamax.html', scraper.parse_modamax), ('econom.html', scraper.parse_econom)):
+        html_text = load_fixture(name)
+        print(f'{name} ({len(html_text) // 1024} КБ):')
+
+        baseline = best_time(lambda: BeautifulSoup(html_text, 'html.parser'))
+        print(f'  полное дерево html.parser:  {baseline * 1000:8.1f} мс')
+
+        for parser in ('html.parser', 'lxml'):
+            elapsed = best_time(lambda: parse(html_text, parser))
+            print(f'  {parse.__name__}({parser}): {elapsed * 1000:8.1f} мс  (x{baseline / elapsed:.1f})')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+'''
+Бенчмарк горячих мест всего конвейера на синтетических базах разного размера.
+
+Для каждого размера (по умолчанию 1k, 10k, 100k магазинов) создаётся база generate_db.fill_db
+во временном каталоге и замеряются:
+- classify_cold / classify_warm: get_profit_color по текстам предложений всех магазинов
+  (с пустым и заполненным кэшем классификатора);
+- save_to_db_insert: запись всех магазинов в пустую базу (геокодирование подменено -
+  координаты берутся из сгенерированных данных, без сети и без лимита Nominatim);
+- save_to_db_update: повторная запись, у 10% магазинов изменилось предложение;
+- generate_voronoi_geojson: построение диаграммы Вороного;
+- api_shops / api_shops_bin: GET /api/shops (GeoJSON и geobin) через тестовый клиент Flask;
+- api_voronoi_cold / api_voronoi_warm: GET /api/voronoi - первый запрос после смены версии данных
+  (с построением диаграммы) и повторный (из кэша).
+Независимо от размера замеряется разбор страниц источников на синтетической разметке benchmarks/fixtures
+(повторяет структуру и классы, которые ищут парсеры; подробнее - в bench_parse.py).
+
+Результат - JSON (в stdout или в файл --output): окружение, коммит и для каждого замера
+лучшее и медианное время из repeat повторов. С --baseline прошлый результат выводится рядом
+для сравнения версий.
+
+Запуск из корня проекта: python benchmarks/bench_pipeline.py --sizes 1000 10000 --output bench.json
+'''
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import analytics
+import classifier
+import database
+import db
+import geocoder
+import scraper
+import shop_index
+import store
+from app import app
+from generate_db import fill_db, generate_shops, random_discounts
+
+import numpy as np
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+def measure(func, repeat, setup=None):
+    '''
+    Функция замера: repeat запусков func (перед каждым - setup), вывод print подавляется.
+    Возвращает словарь с лучшим и медианным временем (сек).
+    '''
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+            started = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - started)
+    return {'best': min(times), 'median': statistics.median(times), 'repeat': repeat}
+
+def reset_caches():
+    # кэши в памяти привязаны к версии данных, а у новой базы версии начинаются заново
+    analytics._voronoi_cache.clear()
+    shop_index._index = None
+    store._store = None
+    classifier.classify.cache_clear()
+
+def stub_geocoding(shops):
+    # подмена запроса к Nominatim: координаты из сгенерированных данных, без сети и без лимита
+    coordinates = {shop['address']: (shop['lat'], shop['lon']) for shop in shops}
+    geocoder._query_nominatim = lambda address: coordinates.get(address, (None, None))
+
+def bench_parsers(repeat):
+    results = {}
+    for name, parse in (('modamax', scraper.parse_modamax), ('econom', scraper.parse_econom)):
+        with open(os.path.join(FIXTURES, f'{name}.html'), encoding='utf-8') as f:
+            html_text = f.read()
+        results[f'parse_{name}'] = measure(lambda: parse(html_text), repeat)
+    return results
+
+def bench_size(size, workdir, repeat):
+    '''
+    Функция замеров для базы из size магазинов.
+    '''
+    results = {}
+    path = os.path.join(workdir, f'shops_{size}.db')
+
+    # классификатор - на текстах предложений всех магазинов
+    texts = random_discounts(np.random.default_rng(size), size)
+    results['classify_cold'] = measure(
+        lambda: [classifier.get_profit_color(text) for text in texts], repeat, classifier.classify.cache_clear
+    )
+    results['classify_warm'] = measure(lambda: [classifier.get_profit_color(text) for text in texts], repeat)
+
+    # запись в базу: вставка в пустую базу и обновление
+    shops = generate_shops(size, seed=size)
+    stub_geocoding(shops)
+    scraped = [{key: shop[key] for key in ('shop_name', 'address', 'discount')} for shop in shops]
+
+    def empty_db():
+        db.close_connections()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        db.set_db_path(path)
+        database.init_db()
+
+    results['save_to_db_insert'] = measure(
+        lambda: database.save_to_db([dict(item) for item in scraped]), repeat, empty_db
+    )
+
+    changed = [dict(item) for item in scraped]
+    new_texts = random_discounts(np.random.default_rng(size + 1), size)
+    for i in range(0, size, 10):
+        changed[i]['discount'] = new_texts[i]
+    results['save_to_db_update'] = measure(lambda: database.save_to_db([dict(item) for item in changed]), repeat)
+
+    # аналитика и API - на базе от генератора
+    with contextlib.redirect_stdout(io.StringIO()):
+        fill_db(path, size, seed=size)
+    reset_caches()
+
+    results['generate_voronoi_geojson'] = measure(analytics.generate_voronoi_geojson, repeat)
+
+    client = app.test_client()
+    results['api_shops'] = measure(lambda: client.get('/api/shops').get_data(), repeat)
+    results['api_shops_bin'] = measure(lambda: client.get('/api/shops?format=bin').get_data(), repeat)
+    results['api_voronoi_cold'] = measure(
+        lambda: client.get('/api/voronoi').get_data(), repeat, analytics._voronoi_cache.clear
+    )
+    results['api_voronoi_warm'] = measure(lambda: client.get('/api/voronoi').get_data(), repeat)
+
+    db.close_connections()
+    return results
+
+def load_baseline(path):
+    '''
+    Функция чтения прошлого результата: словарь {(name, size): лучшее время}.
+    '''
+    with open(path, encoding='utf-8') as f:
+        return {(item['name'], item['size']): item['best'] for item in json.load(f)['results']}
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'shapely': analytics.shapely.__version__,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк конвейера на синтетических данных')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='размеры баз (число магазинов)')
+    parser.add_argument('--repeat', type=int, default=3, help='повторов каждого замера')
+    parser.add_argument('--output', help='файл для результата JSON (по умолчанию - stdout)')
+    parser.add_argument('--baseline', help='результат JSON прошлой версии - для сравнения времени')
+    args = parser.parse_args()
+
+    report = {'environment': environment(), 'results': []}
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+
+    def add(size, results):
+        for name, timing in results.items():
+            report['results'].append({'name': name, 'size': size, **timing})
+            line = f'  {name:<26} {timing["best"] * 1000:10.1f} мс'
+            if (name, size) in baseline:
+                line += f'  (x{timing["best"] / baseline[name, size]:.2f} к базовой версии)'
+            print(line, file=sys.stderr)
+
+    print('Разбор страниц источников:', file=sys.stderr)
+    add(None, bench_parsers(args.repeat))
+
+    with tempfile.TemporaryDirectory(prefix='shops_bench_') as workdir:
+        # общий снимок - свой, в temp-каталоге: снимок ./store рабочей базы не должен подменять
+        # замеры api_shops и api_voronoi чтением готовых файлов
+        os.environ['SHOPS_STORE'] = store.STORE_DIR = os.path.join(workdir, 'store')
+        for size in args.sizes:
+            print(f'{size} магазинов:', file=sys.stderr)
+            add(size, bench_size(size, workdir, args.repeat))
+
+    text = json.dumps(report, ensure_ascii=False, indent=1)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
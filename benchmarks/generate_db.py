@@ -0,0 +1,114 @@
+'''
+Генератор синтетической базы магазинов для бенчмарков.
+
+Магазины двух сетей с "настоящими" текстами предложений (цена за кг, за вещь, скидка в %,
+спецпредложения), адресами вида "Минск, ул. ..., 12" и координатами в окрестностях Минска
+(плотнее к центру, как у реальных магазинов). Тексты предложений берутся из небольшого набора -
+как и на сайтах, в один день у многих магазинов одно и то же предложение.
+
+Запуск из корня проекта: python benchmarks/generate_db.py 10000 --db /tmp/shops_10k.db
+'''
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import database
+from classifier import classify_items
+
+CHAINS = ('МодаМакс', 'ЭкономСити')
+STREETS = (
+    'пр-т Независимости', 'ул. Немига', 'ул. Сурганова', 'пр-т Победителей', 'ул. Кальварийская',
+    'ул. Притыцкого', 'пр-т Дзержинского', 'ул. Есенина', 'ул. Ангарская', 'ул. Якубова',
+    'ул. Я. Коласа', 'ул. Калиновского', 'пр-т Партизанский', 'ул. Маяковского', 'ул. Жуковского',
+)
+SPECIAL_OFFERS = ('Спецпредложение', 'Новое поступление', 'Скидка на всё')
+
+# центр и разброс координат (градусы): около 15 км вокруг центра Минска
+CENTER = (53.9023, 27.5619)
+SPREAD = (0.05, 0.08)
+
+def random_discounts(rng, n):
+    '''
+    Функция генерации текстов предложений: цены с шагом 0.5 руб., скидки с шагом 10%.
+    '''
+    kind = rng.choice(4, size=n, p=[0.45, 0.25, 0.25, 0.05])
+    per_kg = rng.integers(20, 140, size=n) / 2
+    per_item = rng.integers(2, 20, size=n) / 2
+    percent = rng.integers(1, 8, size=n) * 10
+    special = rng.integers(0, len(SPECIAL_OFFERS), size=n)
+
+    texts = []
+    for k, kg, item, pct, sp in zip(kind, per_kg, per_item, percent, special):
+        if k == 0:
+            texts.append(f'{kg:.2f} руб/кг')
+        elif k == 1:
+            texts.append(f'{item:.2f} руб/вещь')
+        elif k == 2:
+            texts.append(f'-{pct}%')
+        else:
+            texts.append(SPECIAL_OFFERS[sp])
+    return texts
+
+def generate_shops(n, seed=0):
+    '''
+    Функция генерации n магазинов - словари как у парсера (shop_name, address, discount)
+    плюс координаты lat/lon.
+    '''
+    rng = np.random.default_rng(seed)
+    lat = rng.normal(CENTER[0], SPREAD[0], size=n)
+    lon = rng.normal(CENTER[1], SPREAD[1], size=n)
+    chains = rng.integers(0, len(CHAINS), size=n)
+    streets = rng.integers(0, len(STREETS), size=n)
+
+    return [
+        {
+            'shop_name': CHAINS[chain],
+            # номер дома уникален - пары (сеть, адрес) не повторяются
+            'address': f'Минск, {STREETS[street]}, {i + 1}',
+            'discount': discount,
+            'lat': round(float(shop_lat), 6),
+            'lon': round(float(shop_lon), 6),
+        }
+        for i, (chain, street, discount, shop_lat, shop_lon)
+        in enumerate(zip(chains, streets, random_discounts(rng, n), lat, lon))
+    ]
+
+def fill_db(path, n, seed=0):
+    '''
+    Функция создания базы path с n синтетическими магазинами (старая база удаляется).
+    Возвращает список сгенерированных магазинов.
+    '''
+    # соединения этого потока могут держать старый файл базы
+    db.close_connections()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    db.set_db_path(path)
+    database.init_db()
+
+    shops = classify_items(generate_shops(n, seed))
+    conn = db.get_connection()
+    with conn:
+        conn.executemany('''
+            INSERT INTO shops (shop_name, address, discount, color, price, unit, lat, lon)
+            VALUES (:shop_name, :address, :discount, :color, :price, :unit, :lat, :lon)
+        ''', shops)
+        db.bump_data_version(conn)
+    return shops
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Синтетическая база магазинов')
+    parser.add_argument('count', type=int, help='число магазинов')
+    parser.add_argument('--db', default='shops.db', help='путь к файлу базы')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fill_db(args.db, args.count, args.seed)
+    print(f'{args.db}: {args.count} магазинов')
@@ -0,0 +1,129 @@
+'''
+Разбор текста предложения магазина ("25.00 руб/кг", "3 руб/вещь", "-50%") и его оценка:
+единица, числовое значение, цвет точки на карте и оценка выгодности для ранжирования магазинов.
+
+Границы цветов задаются таблицей THRESHOLDS, шаблоны чисел скомпилированы заранее.
+Одни и те же тексты предложений повторяются у многих магазинов в один день,
+поэтому результат classify() запоминается (lru_cache).
+'''
+
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+Classification = namedtuple('Classification', ['unit', 'value', 'color', 'score'])
+
+# шаблоны чисел: цена может быть дробной ("25,50"), процент - целый
+PRICE_PATTERN = re.compile(r"(\d+[\.,]?\d*)")
+PERCENT_PATTERN = re.compile(r"(\d+)")
+
+# таблица правил по единицам, в порядке проверки:
+# marker - признак единицы в тексте, pattern - шаблон числа,
+# green/orange - границы цветов, lower_is_better - выгоднее меньшее значение (цена) или большее (скидка)
+THRESHOLDS = {
+    'руб/кг': {'marker': 'руб/кг', 'pattern': PRICE_PATTERN, 'green': 30, 'orange': 60, 'lower_is_better': True},
+    'руб/вещь': {'marker': 'руб/вещь', 'pattern': PRICE_PATTERN, 'green': 4, 'orange': 7, 'lower_is_better': True},
+    '%': {'marker': '%', 'pattern': PERCENT_PATTERN, 'green': 50, 'orange': 20, 'lower_is_better': False},
+}
+
+# порядок цветов от выгодного к невыгодному
+COLORS = ('green', 'orange', 'red', 'gray')
+
+UNCLASSIFIED = Classification(None, None, 'gray', None)
+
+def _color(rule, value):
+    if rule['lower_is_better']:
+        if value < rule['green']: return 'green'
+        if value < rule['orange']: return 'orange'
+        return 'red'
+
+    if value > rule['green']: return 'green'
+    if value > rule['orange']: return 'orange'
+    return 'red'
+
+def _score(rule, value):
+    # значение делится на границу "красной" зоны своей единицы: меньше 1 - зелёная или оранжевая зона,
+    # 1 и больше - красная; для скидки берётся доля цены, которую остаётся заплатить
+    if rule['lower_is_better']:
+        return value / rule['orange']
+    return (100 - value) / (100 - rule['orange'])
+
+@lru_cache(maxsize=4096)
+def classify(discount_text):
+    '''
+    Функция разбора текста предложения. Возвращает Classification(unit, value, color, score):
+    unit - 'руб/кг', 'руб/вещь' или '%'; value - число из текста; color - цвет точки;
+    score - оценка выгодности (чем меньше, тем выгоднее). Если число не найдено - unit/value/score = None.
+    '''
+    text_lower = discount_text.lower()
+
+    for unit, rule in THRESHOLDS.items():
+        if rule['marker'] not in text_lower:
+            continue
+
+        match = rule['pattern'].search(text_lower)
+        if match:
+            number = match.group(1)
+            value = float(number.replace(',', '.')) if rule['pattern'] is PRICE_PATTERN else int(number)
+            return Classification(unit, value, _color(rule, value), _score(rule, value))
+
+    return UNCLASSIFIED
+
+def classify_batch(discount_texts):
+    '''
+    Функция разбора списка текстов предложений (повторяющиеся тексты разбираются один раз).
+    '''
+    return [classify(text) for text in discount_texts]
+
+def classify_items(items):
+    '''
+    Функция разбора всего результата парсинга сразу: каждому предложению (словарь с ключом discount)
+    добавляются color, price и unit. Возвращает тот же список.
+    '''
+    for item, result in zip(items, classify_batch([item['discount'] for item in items])):
+        item['color'] = result.color
+        item['price'] = result.value
+        item['unit'] = result.unit
+    return items
+
+def parse_discount(discount_text):
+    '''
+    Функция выделения единицы и числового значения из текста предложения.
+    Возвращает (unit, value); если число не найдено - (None, None).
+    '''
+    result = classify(discount_text)
+    return result.unit, result.value
+
+def get_profit_color(discount_text):
+    '''
+    Функция задания логики определения цвета точки на карте
+    в зависимости от текста информации о цене/скидке
+    '''
+    return classify(discount_text).color
+
+def profit_score(unit, value):
+    '''
+    Функция числовой оценки выгодности предложения по единице и значению: чем меньше, тем выгоднее.
+    Если единица неизвестна - None.
+    '''
+    rule = THRESHOLDS.get(unit)
+    if rule is None or value is None:
+        return None
+    return _score(rule, value)
+
+def profit_scores(units, values):
+    '''
+    Векторная версия profit_score для массивов единиц и значений (например, колонок таблицы shops).
+    Для неразобранных предложений - NaN.
+    '''
+    units = np.asarray(units, dtype=object)
+    values = np.asarray(values, dtype=float)
+    scores = np.full(len(values), np.nan)
+
+    for unit, rule in THRESHOLDS.items():
+        mask = units == unit
+        scores[mask] = _score(rule, values[mask])
+
+    return scores
@@ -0,0 +1,209 @@
+'''
+Иерархическая кластеризация магазинов для карты (по образцу supercluster, но сеткой).
+
+- координаты переводятся в проекцию Меркатора (как у тайлов карты), на каждом зуме z
+  магазины группируются по клеткам сетки CLUSTER_PIXELS x CLUSTER_PIXELS пикселей экрана
+- клетки зума z - это ровно 4 клетки зума z + 1, поэтому уровни строятся снизу вверх:
+  кластеры зума z собираются из кластеров зума z + 1 (центры - средние, взвешенные числом магазинов),
+  и каждый уровень считается векторно по кластерам предыдущего, а не по всем магазинам
+- у кластера - число магазинов, лучший магазин (наименьшая оценка classifier.profit_scores,
+  его цвет и цена) и зум, на котором кластер распадается (expansion_zoom)
+- на зумах крупнее CLUSTER_MAX_ZOOM отдаются сами магазины
+- ответ ограничен зумом, а не числом магазинов: в видимую область попадает не больше кластеров,
+  чем клеток сетки на экране
+- иерархия строится по индексу shop_index (те же строки и оценки) и перестраивается только при смене версии данных;
+  если опубликован общий снимок (store.py), уровни берутся из него готовыми
+'''
+
+import threading
+
+import numpy as np
+import shapely
+
+import geobin
+import metrics
+from serialize import dumps
+from shop_index import get_shop_index
+from store import ShopRows, get_store
+
+# размер клетки кластеризации в пикселях тайла 256 px
+CLUSTER_PIXELS = 64
+
+# самый крупный зум, на котором магазины ещё объединяются; дальше - отдельные магазины
+CLUSTER_MAX_ZOOM = 16
+
+# предел широты проекции Меркатора (как у тайлов карты)
+MAX_LATITUDE = 85.05112878
+
+# свойства кластера: число магазинов, зум распада и поля лучшего магазина
+# (у кластера из одного магазина - сам магазин)
+CLUSTER_PROPERTIES = ('count', 'expansion_zoom', 'id', 'shop_name', 'address', 'discount', 'color', 'price', 'unit')
+
+_clusters = None
+_clusters_lock = threading.Lock()
+
+def mercator(lon, lat):
+    '''
+    Функция перевода lon/lat (градусы) в координаты Меркатора, нормированные на [0, 1] (как номер тайла / 2 ** z).
+    '''
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon) + 180) / 360
+    y = 0.5 - np.log(np.tan(np.pi / 4 + lat / 2)) / (2 * np.pi)
+    return x, y
+
+def _level(lon, lat, count, best, expansion):
+    # кластеры уровня упорядочены по долготе - запрос по рамке берёт отрезок массива (searchsorted)
+    order = np.argsort(lon, kind='stable')
+    return {
+        'lon': lon[order],
+        'lat': lat[order],
+        'count': count[order],
+        'best': best[order],
+        'expansion': expansion[order],
+    }
+
+def build_clusters(index):
+    '''
+    Функция построения иерархии кластеров по индексу магазинов (shop_index.build_shop_index).
+    Возвращает словарь {'version', 'levels'}: уровни по зуму 0..CLUSTER_MAX_ZOOM + 1,
+    последний - отдельные магазины.
+    '''
+    rows = index['rows']
+    n = len(rows)
+
+    lon = np.array([row['lon'] for row in rows], dtype=float)
+    lat = np.array([row['lat'] for row in rows], dtype=float)
+    # магазины без разобранной цены - в конце очереди на "лучший"
+    score = np.nan_to_num(index['score'], nan=np.inf)
+
+    shops = np.arange(n)
+    levels = {CLUSTER_MAX_ZOOM + 1: _level(lon, lat, np.ones(n, dtype=np.int64), shops, np.full(n, -1))}
+    if not n:
+        for zoom in range(CLUSTER_MAX_ZOOM + 1):
+            levels[zoom] = levels[CLUSTER_MAX_ZOOM + 1]
+        return {'version': index['version'], 'levels': levels}
+
+    # клетки самого крупного зума - прямо из координат магазинов
+    x, y = mercator(lon, lat)
+    scale = 2 ** CLUSTER_MAX_ZOOM * 256 / CLUSTER_PIXELS
+    cell_x = np.floor(x * scale).astype(np.int64)
+    cell_y = np.floor(y * scale).astype(np.int64)
+
+    # "дети" текущего уровня: сначала магазины, дальше - кластеры предыдущего (более крупного) зума
+    child = {
+        'count': np.ones(n, dtype=np.int64),
+        'lon_sum': lon,
+        'lat_sum': lat,
+        'best': shops,
+        'expansion': np.full(n, -1),
+    }
+
+    for zoom in range(CLUSTER_MAX_ZOOM, -1, -1):
+        if zoom < CLUSTER_MAX_ZOOM:
+            # клетка зума z содержит 2 x 2 клетки зума z + 1
+            cell_x, cell_y = cell_x >> 1, cell_y >> 1
+
+        _, first, parent, children = np.unique(
+            (cell_x << 32) | cell_y, return_index=True, return_inverse=True, return_counts=True
+        )
+        parent = parent.ravel()
+        size = len(first)
+
+        count = np.bincount(parent, weights=child['count'], minlength=size).astype(np.int64)
+        lon_sum = np.bincount(parent, weights=child['lon_sum'], minlength=size)
+        lat_sum = np.bincount(parent, weights=child['lat_sum'], minlength=size)
+
+        # лучший магазин кластера - лучший среди лучших магазинов его детей
+        order = np.lexsort((score[child['best']], parent))
+        group_start = np.flatnonzero(np.diff(parent[order], prepend=-1))
+        best = child['best'][order[group_start]]
+
+        # кластер из нескольких детей распадается на следующем зуме, из одного - там же, где его ребёнок
+        expansion = np.where(children > 1, zoom + 1, child['expansion'][first])
+
+        levels[zoom] = _level(lon_sum / count, lat_sum / count, count, best, expansion)
+        child = {'count': count, 'lon_sum': lon_sum, 'lat_sum': lat_sum, 'best': best, 'expansion': expansion}
+        cell_x, cell_y = cell_x[first], cell_y[first]
+
+    return {'version': index['version'], 'levels': levels}
+
+def get_clusters():
+    '''
+    Функция получения актуальной иерархии кластеров и индекса магазинов, по которому она построена.
+    '''
+    global _clusters
+    store = get_store()
+    if store is not None:
+        # иерархия, построенная по SQLite до публикации снимка, больше не нужна
+        _clusters = None
+        return {'rows': ShopRows(store)}, {'version': store['version'], 'levels': store['clusters']}
+
+    index = get_shop_index()
+
+    clusters = _clusters
+    if clusters is not None and clusters['version'] == index['version']:
+        return index, clusters
+
+    with _clusters_lock:
+        if _clusters is None or _clusters['version'] != index['version']:
+            with metrics.span('clusters_build'):
+                _clusters = build_clusters(index)
+        return index, _clusters
+
+def find_clusters(zoom, bbox=None):
+    '''
+    Функция выбора кластеров зума zoom в рамке bbox=(min_lon, min_lat, max_lon, max_lat).
+    Возвращает кортеж (version, positions, properties): координаты (n, 2) в порядке lon/lat
+    и колонки свойств CLUSTER_PROPERTIES.
+    '''
+    index, clusters = get_clusters()
+    level = clusters['levels'][min(zoom, CLUSTER_MAX_ZOOM + 1)]
+
+    selected = np.arange(len(level['lon']))
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        start = np.searchsorted(level['lon'], min_lon, side='left')
+        end = np.searchsorted(level['lon'], max_lon, side='right')
+        selected = np.arange(start, end)
+        lat = level['lat'][selected]
+        selected = selected[(lat >= min_lat) & (lat <= max_lat)]
+
+    rows = index['rows']
+    best = level['best'][selected]
+    expansion = level['expansion'][selected]
+    properties = {
+        'count': level['count'][selected].tolist(),
+        'expansion_zoom': [None if value < 0 else value for value in expansion.tolist()],
+    }
+    if isinstance(rows, ShopRows):
+        # строки общего снимка читаются по колонкам
+        for name in CLUSTER_PROPERTIES[2:]:
+            properties[name] = rows.column(name, best)
+    else:
+        best_rows = [rows[i] for i in best]
+        for name in CLUSTER_PROPERTIES[2:]:
+            properties[name] = [row[name] for row in best_rows]
+
+    positions = np.column_stack([level['lon'][selected], level['lat'][selected]])
+    return clusters['version'], positions, properties
+
+def clusters_geojson(positions, properties):
+    '''
+    Функция сериализации кластеров (результат find_clusters) в GeoJSON FeatureCollection (байты).
+    '''
+    names = list(properties)
+    features = [
+        {
+            'type': 'Feature',
+            'properties': dict(zip(names, values)),
+            'geometry': {'type': 'Point', 'coordinates': [round(lon, 6), round(lat, 6)]},
+        }
+        for (lon, lat), *values in zip(positions.tolist(), *properties.values())
+    ]
+    return dumps({'type': 'FeatureCollection', 'features': features})
+
+def clusters_geobin(positions, properties):
+    '''
+    Функция кодирования кластеров (результат find_clusters) в двоичный формат geobin.
+    '''
+    return geobin.encode(shapely.points(positions) if len(positions) else [], properties)
@@ -1,20 +1,14 @@
-import sqlite3
-from geopy import Nominatim
-import time
-
+import db
+import fetcher
+import geocoder
+import history
+import metrics
+from classifier import classify_batch, classify_items
+from export import export_snapshots, publish_store
 from scraper import get_discounts
 
-CORRECTIONS = {
-    'Минск, ул. Ангарская, 36А': (53.871291, 27.685107),
-    'Минск, ул. Алибегова, 13/1': (53.871037, 27.473608),
-    'Минск, ул. Я. Коласа, 33': (53.924654, 27.591547),
-    'Молодечно, ул. В. Гостинец, 54': (54.307416, 26.829399),
-    'Минск, ул. Калиновского, 55 (1 этаж)': (53.947219, 27.628711),
-    'Минск, ул.Романовская Слобода, 12': (53.903292, 27.546281)
-}
-
 def init_db():
-    conn = sqlite3.connect('shops.db')
+    conn = db.get_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -27,50 +21,74 @@ def init_db():
             lat REAL,
             lon REAL,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            price REAL,
+            unit TEXT,
             UNIQUE(shop_name, address)
         )
     ''')
     
+    # миграция: числовая цена и её единица (classifier.classify) хранятся рядом с текстом предложения,
+    # чтобы запросы не разбирали текст заново; для старых баз колонки добавляются и заполняются
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(shops)')}
+    if 'price' not in columns:
+        cursor.execute('ALTER TABLE shops ADD COLUMN price REAL')
+        cursor.execute('ALTER TABLE shops ADD COLUMN unit TEXT')
+        
+        rows = cursor.execute('SELECT id, discount FROM shops').fetchall()
+        results = classify_batch([discount for _, discount in rows])
+        cursor.executemany('UPDATE shops SET price = ?, unit = ? WHERE id = ?', [
+            (result.value, result.unit, shop_id) for (shop_id, _), result in zip(rows, results)
+        ])
+    
+    # пространственный индекс R*Tree по координатам магазинов - для запросов по рамке карты
+    # индекс поддерживается триггерами, так что save_to_db о нём не знает
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS shops_rtree USING rtree(
+            id, min_lon, max_lon, min_lat, max_lat
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS shops_rtree_insert AFTER INSERT ON shops BEGIN
+            INSERT INTO shops_rtree VALUES (new.id, new.lon, new.lon, new.lat, new.lat);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS shops_rtree_update AFTER UPDATE OF lat, lon ON shops BEGIN
+            UPDATE shops_rtree SET min_lon = new.lon, max_lon = new.lon, min_lat = new.lat, max_lat = new.lat
+            WHERE id = new.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS shops_rtree_delete AFTER DELETE ON shops BEGIN
+            DELETE FROM shops_rtree WHERE id = old.id;
+        END
+    ''')
+    # магазины, добавленные до появления индекса
+    cursor.execute('''
+        INSERT INTO shops_rtree
+        SELECT id, lon, lon, lat, lat FROM shops
+        WHERE id NOT IN (SELECT id FROM shops_rtree)
+    ''')
+    
     conn.commit()
-    conn.close()
+    
+    # таблица кэша геокодирования и ручные правки адресов
+    geocoder.init_cache(conn)
+    
+    # состояния загруженных страниц источников (ETag, хэши) для условных запросов
+    fetcher.init_fetch_cache(conn)
+    
+    # история цен магазинов
+    history.init_history(conn)
 
 def get_coordinates(address):
-    # Проверяю наличие координат для адреса в CORRECTIONS
-    if address in CORRECTIONS:
-        print(f'   [!] Применена ручная правка для: {address}')
-        return CORRECTIONS[address]
-    
-    # Если правленного адреса нет буду опрашивать Nominatum
-    # создаю объект геолокатора
-    geolocator = Nominatim(user_agent='secondhand_map_pet_project')
-    
-    # очистка адреса для улучшения поисковых возможностей
-    clean_address = address.\
-        replace('г.', '').\
-        replace('ул.', '').\
-        replace('пр-т', '').\
-        replace('тр-т', '').\
-        replace('/', ' к')
-         
-    try:
-        location = geolocator.geocode(clean_address)
-        
-        if location:
-            # вывод этапов поиска для отладки
-            print(f'  [Check] Запрос для поиска: {clean_address} > Результат: {location.address}')
-                       
-            return location.latitude, location.longitude
-        else:
-            print(f"  [Warn] Nominatum ничего не нашел по запросу: {clean_address}")
-            
-    except Exception as e:
-        print(f'  [Error] Ошибка геокодинга для {address}: {e}')
-    
-    return None, None
+    # координаты берутся из кэша геокодирования (туда же записаны ручные правки CORRECTIONS),
+    # Nominatum опрашивается только если адреса в кэше нет
+    return geocoder.geocode(address)
 
+@metrics.timed('save_to_db')
 def save_to_db(scraped_data):
-    conn =sqlite3.connect('shops.db')
-    conn.row_factory = sqlite3.Row
+    conn = db.get_connection()
     cursor = conn.cursor()
     
     print(f'\n--- Начало обновления базы данных ---')
@@ -91,76 +109,99 @@ def save_to_db(scraped_data):
     
     scraped_data = unique_data
     
-    # загрузка существующей базы в память
-    # создается словать {('название', 'адрес'): row_id}
-    existing_shops = {} 
-    cursor.execute('SELECT id, shop_name, address FROM shops')
-    for row in cursor.fetchall():
-        key = (row['shop_name'], row['address'])
-        existing_shops[key] = row['id']
+    # цвет, цена и единица - из классификатора (если парсер их ещё не проставил)
+    if any('unit' not in item for item in scraped_data):
+        classify_items(scraped_data)
     
-    print(f'В базе данных найдено {len(existing_shops)} магазинов.')
-    
-    # далее - список ПАР (название, адрес), которые обработаны в этом запуске (чтобы удалить лишнее)
-    processed_keys = []
+    # загрузка пачки во временную таблицу - дальше синхронизация идёт set-based запросами
+    # первичный ключ (название, адрес) служит индексом для сравнения с таблицей shops
+    cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS scraped (
+            shop_name TEXT,
+            address TEXT,
+            discount TEXT,
+            color TEXT,
+            price REAL,
+            unit TEXT,
+            lat REAL,
+            lon REAL,
+            is_new INTEGER DEFAULT 0,
+            PRIMARY KEY (shop_name, address)
+        )
+    ''')
+    cursor.execute('DELETE FROM temp.scraped')
+    cursor.executemany('''
+        INSERT INTO temp.scraped (shop_name, address, discount, color, price, unit)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [
+        (item.get('shop_name', 'Unknown'), item['address'], item['discount'], item['color'], item['price'], item['unit'])
+        for item in scraped_data
+    ])
+    
+    # новые магазины - пары (название, адрес), которых ещё нет в shops
+    cursor.execute('''
+        UPDATE temp.scraped SET is_new = NOT EXISTS (
+            SELECT 1 FROM shops WHERE shops.shop_name = scraped.shop_name AND shops.address = scraped.address
+        )
+    ''')
+    new_shops = cursor.execute('SELECT shop_name, address FROM temp.scraped WHERE is_new').fetchall()
     
-    # счётчики - для статистики
-    cnt_updated = 0
-    cnt_inserted = 0
-    cnt_error = 0
+    print(f"В базе данных найдено {cursor.execute('SELECT count(*) FROM shops').fetchone()[0]} магазинов.")
     
-    # обработка новых данных    
-    for item in scraped_data:
-        shop_name = item.get('shop_name', 'Unknown')
-        address = item['address']
-        discount = item['discount']
-        color = item.get('color', 'gray')
+    # геокодирование только действительно новых адресов, одной пачкой - до начала записи в shops
+    if new_shops:
+        for shop_name, address in new_shops:
+            print(f' [New] Найден новый магазин {shop_name} по адресу {address}')
         
-        current_key = (shop_name, address)
-        processed_keys.append(current_key)
+        coordinates = geocoder.geocode_batch([address for _, address in new_shops], conn)
+        cursor.executemany('''
+            UPDATE temp.scraped SET lat = ?, lon = ? WHERE shop_name = ? AND address = ?
+        ''', [(*coordinates[address], shop_name, address) for shop_name, address in new_shops])
+    
+    cnt_updated = cursor.execute('SELECT count(*) FROM temp.scraped WHERE NOT is_new').fetchone()[0]
+    cnt_inserted = cursor.execute('SELECT count(*) FROM temp.scraped WHERE is_new AND lat IS NOT NULL').fetchone()[0]
+    cnt_error = len(new_shops) - cnt_inserted
+    
+    for shop_name, address in cursor.execute('SELECT shop_name, address FROM temp.scraped WHERE is_new AND lat IS NULL'):
+        print(f' [Warn] {shop_name}: Не удалось найти координаты для нового магазина {address}')
+    
+    # вся запись в shops - одна транзакция
+    with metrics.span('db_sync'), conn:
+        # логика А и Б: существующим магазинам обновляются скидка, цвет, цена и время (координаты не трогаем),
+        # новые магазины с найденными координатами добавляются
+        cursor.execute('''
+            INSERT INTO shops (shop_name, address, discount, color, price, unit, lat, lon)
+            SELECT shop_name, address, discount, color, price, unit, lat, lon FROM temp.scraped
+            WHERE NOT is_new OR lat IS NOT NULL
+            ON CONFLICT(shop_name, address) DO UPDATE SET
+                discount = excluded.discount,
+                color = excluded.color,
+                price = excluded.price,
+                unit = excluded.unit,
+                updated_at = CURRENT_TIMESTAMP
+        ''')
         
-        # логика А: магазин уже есть в базе 
-        # (UPDATE) обновляются скидка, цвет и время; 
-        # координаты заново не собираем
-        if current_key in existing_shops:
-            cursor.execute('''
-                UPDATE shops
-                SET discount = ?, color = ?, updated_at = CURRENT_TIMESTAMP 
-                WHERE shop_name = ? AND address = ?
-            ''', (discount, color, shop_name, address))
-            cnt_updated += 1
+        # логика В: магазина сети больше нет на сайте - удаляем его одним запросом
+        # удаляются только магазины тех сетей, что пришли в этом запуске:
+        # если источник упал или не уложился в дедлайн, его магазины остаются как есть
+        deleted = cursor.execute('''
+            DELETE FROM shops
+            WHERE shop_name IN (SELECT shop_name FROM temp.scraped)
+              AND NOT EXISTS (
+                  SELECT 1 FROM temp.scraped s WHERE s.shop_name = shops.shop_name AND s.address = shops.address
+              )
+            RETURNING shop_name, address
+        ''').fetchall()
         
-        # логика Б: магазин по новому адресу или новый магазин сети по существующему адресу
-        # (INSERT) добавляем магазин, делаем геокодирование
-        else:
-            print(f' [New] Найден новый магазин {shop_name} по адресу {address}')
-            lat, lon = get_coordinates(address)
-            
-            if lat and lon:
-                cursor.execute('''
-                    INSERT INTO shops (shop_name, address, discount, color, lat, lon)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (shop_name, address, discount, color, lat, lon))
-                cnt_inserted += 1
-                
-                if address not in CORRECTIONS:
-                    time.sleep(1)
-            else:
-                print(f' [Warn] {shop_name}: Не удалось найти координаты \
-                    для нового магазина {address}')
-                cnt_error += 1
-    
-    # логика В: адрес есть в существующих, но его нет в обработанных - магазина больше нет на сайте
-    # (DELETE) удаляем магазин по адресу из базы данных
-    cnt_deleted = 0
-    for old_key, old_id in existing_shops.items():
-        if old_key not in processed_keys:
-            print(f'  [Warn] Магазин {old_key} больше не существует, удаляется.')
-            cursor.execute('DELETE FROM shops WHERE id = ?', (old_id,))
-            cnt_deleted += 1
-    
-    conn.commit()
-    conn.close()
+        for shop_name, address in deleted:
+            print(f'  [Warn] Магазин {(shop_name, address)} больше не существует, удаляется.')
+        cnt_deleted = len(deleted)
+        
+        # изменившиеся цены дописываются в историю (удалённые магазины в ней остаются)
+        cnt_history = history.record_prices(conn)
+        
+        # увеличиваю версию данных - по ней веб-приложение сбрасывает кэш диаграммы Вороного
+        db.bump_data_version(conn)
     
     print(f'\n --- Статистика ---')
     print(f"Всего получено от парсера: {len(scraped_data)}")
@@ -168,14 +209,30 @@ def save_to_db(scraped_data):
     print(f"Добавлено новых: {cnt_inserted}")
     print(f"Удалено старых: {cnt_deleted}")
     print(f"Ошибок геокодинга: {cnt_error}")
+    print(f"Изменений цен в истории: {cnt_history}")
+    
+    for kind, count in (('updated', cnt_updated), ('inserted', cnt_inserted), ('deleted', cnt_deleted),
+                        ('geocode_failed', cnt_error), ('price_changed', cnt_history)):
+        metrics.inc('shops_changes_total', count, 'Изменения магазинов при записи в базу', kind=kind)
            
 if __name__ == '__main__':
+    metrics.start_profiler()
     init_db()
     
     print('Парсинг данных с сайтов...')
-    all_data = get_discounts()
+    all_data, pages = get_discounts()
     
     if all_data:
         save_to_db(all_data)
     else:
-        print('Парсинг не удался или список пуст.')
\ No newline at end of file
+        print('Новых данных нет: парсинг не удался или страницы не изменились.')
+    
+    # состояние страниц запоминается только после того, как их данные сохранены
+    fetcher.commit_fetch_state(pages)
+    
+    # статические снимки для карты и общий снимок для процессов веб-приложения (если версия данных изменилась)
+    export_snapshots()
+    publish_store()
+    
+    # метрики этого запуска - для /metrics веб-приложения
+    metrics.write_textfile()
\ No newline at end of file
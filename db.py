@@ -0,0 +1,100 @@
+'''
+Общий слой доступа к базе данных магазинов (SQLite).
+Используется веб-приложением (app.py), аналитикой (analytics.py) и парсером (database.py).
+
+- путь к базе настраивается переменной окружения SHOPS_DB или функцией set_db_path()
+- у каждого потока одно долгоживущее соединение на запись и одно на чтение,
+  поэтому на каждый запрос не тратится время на открытие файла базы
+- база переводится в режим журнала WAL: запись парсера не блокирует читателей
+- соединения веб-приложения открываются в режиме только для чтения (mode=ro)
+- sqlite3 кэширует подготовленные выражения по тексту SQL (cached_statements),
+  поэтому запросы держим в виде неизменных строк
+'''
+
+import os
+import sqlite3
+import threading
+from urllib.parse import quote
+
+DB_PATH = os.environ.get('SHOPS_DB', 'shops.db')
+
+# размер кэша подготовленных выражений на одно соединение
+CACHED_STATEMENTS = 256
+
+# сколько миллисекунд ждать освобождения блокировки, прежде чем вернуть ошибку
+BUSY_TIMEOUT_MS = 5000
+
+# пул соединений: у каждого потока свои соединения
+_local = threading.local()
+
+def set_db_path(path):
+    '''
+    Функция смены пути к базе данных.
+    Соединения со старой базой будут переоткрыты при следующем обращении в каждом потоке.
+    '''
+    global DB_PATH
+    DB_PATH = path
+
+def _connect(readonly):
+    if readonly:
+        # URI-режим: база открывается только для чтения и не создаётся, если её нет
+        uri = f'file:{quote(os.path.abspath(DB_PATH))}?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS)
+    else:
+        conn = sqlite3.connect(DB_PATH, cached_statements=CACHED_STATEMENTS)
+        # WAL сохраняется в файле базы - достаточно включить один раз со стороны писателя
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def get_connection(readonly=False):
+    '''
+    Функция получения соединения с базой из пула текущего потока.
+    Соединение не нужно закрывать - оно переиспользуется следующими вызовами в этом потоке.
+    Переиспользование работает, когда потоки долгоживущие (рабочие процессы и потоки gunicorn,
+    планировщик); если поток создаётся на каждый запрос, соединения нужно закрывать в конце запроса
+    (close_connections, см. DB_CLOSE_ON_TEARDOWN в app.py).
+    '''
+    key = 'ro' if readonly else 'rw'
+    pooled = getattr(_local, key, None)
+
+    # соединение открыто для другого пути (после set_db_path) - переоткрываю
+    if pooled is not None and pooled[0] != DB_PATH:
+        pooled[1].close()
+        pooled = None
+
+    if pooled is None:
+        pooled = (DB_PATH, _connect(readonly))
+        setattr(_local, key, pooled)
+
+    return pooled[1]
+
+def close_connections():
+    '''
+    Функция закрытия соединений текущего потока.
+    '''
+    for key in ('ro', 'rw'):
+        pooled = getattr(_local, key, None)
+        if pooled is not None:
+            pooled[1].close()
+            setattr(_local, key, None)
+
+def get_data_version(conn=None):
+    '''
+    Функция чтения версии данных таблицы shops.
+    Версия (PRAGMA user_version) увеличивается в database.save_to_db при каждом обновлении.
+    '''
+    if conn is None:
+        conn = get_connection(readonly=True)
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def bump_data_version(conn):
+    '''
+    Функция увеличения версии данных внутри текущей транзакции писателя.
+    '''
+    version = get_data_version(conn)
+    conn.execute(f'PRAGMA user_version = {version + 1}')
+    return version + 1
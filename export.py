@@ -0,0 +1,306 @@
+'''
+Выгрузка статических снимков данных карты после обновления базы.
+
+Данные меняются только после парсинга, поэтому GeoJSON магазинов и диаграммы Вороного
+один раз сериализуются и сжимаются заранее, а дальше отдаются как обычные файлы:
+- снимки пишутся в GeoJSON и в двоичном формате geobin (shops.<hash>.bin)
+- имя файла содержит хэш содержимого (shops.<hash>.geojson) - такой URL можно кэшировать
+  в браузере и CDN "навсегда", новая версия данных получит новый URL
+- рядом лежат сжатые копии .gz и .br (brotli - если установлен пакет brotli),
+  сжатие с максимальным уровнем выполняется один раз, а не на каждый запрос
+- manifest.json - короткий файл без долгого кэширования: версия данных и URL актуальных снимков,
+  с него начинает map.html
+- файлы пишутся во временные и переименовываются (os.replace), манифест - последним,
+  поэтому читатель никогда не видит недописанный снимок
+
+Каталог SNAPSHOT_DIR можно отдавать и фронтовым веб-сервером (nginx gzip_static / brotli_static),
+тогда Flask в раздаче вообще не участвует.
+
+Там же публикуется снимок для процессов веб-приложения (publish_store, формат - в store.py).
+'''
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import shapely
+
+import db
+import geobin
+import metrics
+import store
+from analytics import BINARY_PRECISION, SIMPLIFY_ZOOMS, VORONOI_MODE, get_voronoi_cached, get_voronoi_level
+from clusters import CLUSTER_MAX_ZOOM, build_clusters
+from geodata import shop_feature, shops_geobin, shops_geojson
+from serialize import dumps
+from shop_index import build_shop_index
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots'))
+SNAPSHOT_URL = '/snapshots'
+MANIFEST_NAME = 'manifest.json'
+
+# сколько секунд хранить снимки прошлых версий - страницы, открытые до обновления, ещё дочитают их
+SNAPSHOT_KEEP = 3600
+
+# сколько последних версий общего снимка хранить: процессы, ещё не заметившие новую версию, дочитают прошлую
+STORE_KEEP = 2
+
+# сжатые варианты в порядке предпочтения: расширение файла -> (Content-Encoding, функция сжатия)
+ENCODINGS = {}
+if brotli is not None:
+    ENCODINGS['.br'] = ('br', lambda body: brotli.compress(body, quality=11))
+ENCODINGS['.gz'] = ('gzip', lambda body: gzip.compress(body, compresslevel=9, mtime=0))
+
+def _write_atomic(path, body):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+
+def write_snapshot(name, body, ext='.geojson'):
+    '''
+    Функция записи одного снимка и его сжатых копий. Возвращает описание для манифеста.
+    Если файл с таким хэшем уже есть - он не переписывается.
+    '''
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    filename = f'{name}.{digest}{ext}'
+    path = os.path.join(SNAPSHOT_DIR, filename)
+
+    sizes = {'identity': len(body)}
+    for suffix, (encoding, compress) in ENCODINGS.items():
+        if not os.path.exists(path + suffix):
+            _write_atomic(path + suffix, compress(body))
+        sizes[encoding] = os.path.getsize(path + suffix)
+
+    if not os.path.exists(path):
+        _write_atomic(path, body)
+
+    return {'url': f'{SNAPSHOT_URL}/{filename}', 'sizes': sizes}
+
+def load_manifest():
+    '''
+    Функция чтения текущего манифеста снимков. Если снимков ещё нет - None.
+    '''
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, MANIFEST_NAME), 'rb') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def cleanup_snapshots(manifest):
+    '''
+    Функция удаления снимков, на которые не ссылается манифест и которые старше SNAPSHOT_KEEP.
+    '''
+    current = {os.path.basename(entry['url']) for entry in manifest['files'].values()}
+    deadline = time.time() - SNAPSHOT_KEEP
+
+    for filename in os.listdir(SNAPSHOT_DIR):
+        # у сжатой копии снимок определяется по имени без расширения сжатия
+        base, ext = os.path.splitext(filename)
+        snapshot_name = base if ext in ENCODINGS else filename
+        if filename == MANIFEST_NAME or snapshot_name in current:
+            continue
+        path = os.path.join(SNAPSHOT_DIR, filename)
+        if os.path.getmtime(path) < deadline:
+            os.remove(path)
+
+@metrics.timed('export')
+def export_snapshots(force=False):
+    '''
+    Функция выгрузки снимков магазинов и диаграммы Вороного для текущей версии данных.
+    Если снимки этой версии уже выгружены (и force не задан) - ничего не делает.
+    Возвращает манифест.
+    '''
+    version = db.get_data_version()
+    db_path = os.path.abspath(db.DB_PATH)
+    manifest = load_manifest()
+    if not force and manifest is not None and manifest['version'] == version and manifest.get('db_path') == db_path:
+        return manifest
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    started = time.monotonic()
+
+    shop_count = db.get_connection(readonly=True).execute('SELECT count(*) FROM shops').fetchone()[0]
+    _, voronoi_body = get_voronoi_cached()
+    _, voronoi_binary = get_voronoi_cached(binary=True)
+
+    manifest = {
+        'version': version,
+        # снимки другой базы с тем же номером версии выгружаются заново (проверка в начале функции)
+        'db_path': db_path,
+        'created_at': int(time.time()),
+        'shop_count': shop_count,
+        'files': {
+            'shops': write_snapshot('shops', shops_geojson()),
+            'voronoi': write_snapshot('voronoi', voronoi_body),
+            # те же данные в двоичном формате geobin - их загружает map.html
+            'shops_bin': write_snapshot('shops', shops_geobin(), '.bin'),
+            'voronoi_bin': write_snapshot('voronoi', voronoi_binary, '.bin'),
+        },
+    }
+    _write_atomic(os.path.join(SNAPSHOT_DIR, MANIFEST_NAME), json.dumps(manifest, indent=1).encode('utf-8'))
+    cleanup_snapshots(manifest)
+
+    print(f'[Export] Снимки версии {version} выгружены за {time.monotonic() - started:.1f} с '
+          f'(магазинов: {shop_count}, сжатие: {", ".join(encoding for encoding, _ in ENCODINGS.values())}).')
+    return manifest
+
+def _digest(body):
+    return hashlib.sha1(body).hexdigest()[:16]
+
+def _save_array(path, name, array):
+    np.save(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(array))
+
+def _save_table(path, name, items, prefix=b'', suffix=b''):
+    # данные записей подряд (между prefix и suffix) и границы записей: запись i - data[offsets[i]:offsets[i + 1]]
+    lengths = np.fromiter(map(len, items), dtype=np.int64, count=len(items))
+    _save_array(path, f'{name}.offsets', len(prefix) + np.concatenate([[0], np.cumsum(lengths)]))
+    with open(os.path.join(path, f'{name}.dat'), 'wb') as f:
+        f.write(prefix + b''.join(items) + suffix)
+
+def _save_values(path, name, values):
+    _save_table(path, name, [dumps(value) for value in values])
+
+def _save_features(path, name, fragments):
+    # таблица Feature - это сразу FeatureCollection: за каждой записью её разделитель (',' или ']' у последней)
+    items = [fragment + b',' for fragment in fragments]
+    if items:
+        items[-1] = items[-1][:-1] + b']'
+        _save_table(path, name, items, store.FEATURES_PREFIX, b'}')
+    else:
+        _save_table(path, name, items, store.FEATURES_PREFIX, store.FEATURES_SUFFIX)
+
+def _save_raw(path, name, body):
+    with open(os.path.join(path, name), 'wb') as f:
+        f.write(body)
+
+def _save_shops(path, index):
+    rows = index['rows']
+    columns = {name: [row[name] for row in rows] for name in store.SHOP_COLUMNS}
+    for name in store.SHOP_COLUMNS:
+        if name in store.SHOP_NUMERIC:
+            dtype = np.int64 if name == 'id' else float
+            _save_array(path, f'shops.{name}', np.array([np.nan if v is None else v for v in columns[name]], dtype=dtype))
+        else:
+            _save_values(path, f'shops.{name}', columns[name])
+    _save_array(path, 'shops.score', index['score'])
+
+    fragments = [dumps(shop_feature(*(row[name] for name in ('id', 'shop_name', 'address', 'discount', 'color', 'lon', 'lat'))))
+                 for row in rows]
+    _save_features(path, 'shops.features', fragments)
+    binary = geobin.encode(
+        shapely.points(np.column_stack([columns['lon'], columns['lat']])) if rows else [],
+        {name: columns[name] for name in store.SHOP_PROPERTIES},
+    )
+    _save_raw(path, 'shops.bin', binary)
+    return {'etag': _digest(store.FEATURES_PREFIX + b','.join(fragments)), 'binary_etag': _digest(binary)}
+
+def _save_voronoi_level(path, level):
+    # уровень кэша analytics: Feature, ячейки и свойства в одном порядке
+    cache = get_voronoi_level(VORONOI_MODE, level)
+    name = f'voronoi.{store.level_key(level)}'
+    cells = cache['tree'].geometries if cache['tree'] is not None else np.empty(0, dtype=object)
+
+    _save_features(path, f'{name}.features', cache['fragments'])
+    _save_raw(path, f'{name}.bin', cache['binary'])
+    _save_array(path, f'{name}.bounds', shapely.bounds(cells).reshape(-1, 4))
+    for prop in store.CELL_PROPERTIES:
+        _save_values(path, f'{name}.{prop}', [item[prop] for item in cache['properties']])
+
+    geometry_type, offsets = None, []
+    if len(cells):
+        geometry_type, coords, offsets = shapely.to_ragged_array(geobin.polygonal(cells))
+        geometry_type = geometry_type.name
+        _save_array(path, f'{name}.coords', coords)
+        for i, level_offsets in enumerate(offsets):
+            _save_array(path, f'{name}.offsets{i}', level_offsets)
+
+    return {
+        'etag': cache['etag'],
+        'binary_etag': cache['binary_etag'],
+        'type': geometry_type,
+        'offsets': len(offsets),
+        'binary_precision': min(cache['precision'], BINARY_PRECISION),
+    }
+
+def _save_clusters(path, clusters):
+    levels = [clusters['levels'][zoom] for zoom in range(CLUSTER_MAX_ZOOM + 2)]
+    _save_array(path, 'clusters.levels', np.concatenate([[0], np.cumsum([len(level['lon']) for level in levels])]))
+    for field in ('lon', 'lat', 'count', 'best', 'expansion'):
+        _save_array(path, f'clusters.{field}', np.concatenate([level[field] for level in levels]))
+
+def cleanup_store(current):
+    '''
+    Функция удаления старых версий общего снимка: остаются STORE_KEEP последних (и текущая).
+    Процесс, у которого удалённые файлы ещё отображены в память, дочитает их - файл исчезнет после закрытия.
+    '''
+    versions = sorted(
+        (entry for entry in os.scandir(store.STORE_DIR) if entry.is_dir() and entry.name.startswith('v')),
+        key=lambda entry: entry.stat().st_mtime, reverse=True,
+    )
+    for entry in versions[STORE_KEEP:]:
+        if entry.name != current:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+def read_store_current():
+    try:
+        with open(os.path.join(store.STORE_DIR, store.CURRENT_NAME), encoding='utf-8') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+@metrics.timed('publish_store')
+def publish_store(force=False):
+    '''
+    Функция публикации общего снимка текущей версии данных для процессов веб-приложения (см. store.py).
+    Каталог пишется под временным именем и переименовывается целиком, затем атомарно заменяется CURRENT.
+    Если снимок этой версии уже опубликован (и force не задан) - ничего не делает. Возвращает имя каталога.
+    '''
+    version = db.get_data_version()
+    current = read_store_current()
+    if not force and current is not None and current.split('.')[0] == f'v{version}':
+        try:
+            if store.matches_db(store.load_meta(os.path.join(store.STORE_DIR, current))):
+                return current
+        except (OSError, ValueError):
+            pass
+
+    started = time.monotonic()
+    name = f'v{version}.{time.time_ns()}'
+    path = os.path.join(store.STORE_DIR, name)
+    tmp_path = f'{path}.tmp'
+    os.makedirs(tmp_path)
+
+    index = build_shop_index(version)
+    meta = {
+        'version': version,
+        'db_path': os.path.abspath(db.DB_PATH),
+        'created_at': int(time.time()),
+        'shop_count': len(index['rows']),
+        'voronoi_mode': VORONOI_MODE,
+        'shops': _save_shops(tmp_path, index),
+        'voronoi': {store.level_key(level): _save_voronoi_level(tmp_path, level) for level in (None, *SIMPLIFY_ZOOMS)},
+    }
+    _save_clusters(tmp_path, build_clusters(index))
+    _save_raw(tmp_path, 'meta.json', json.dumps(meta, indent=1).encode('utf-8'))
+
+    os.rename(tmp_path, path)
+    _write_atomic(os.path.join(store.STORE_DIR, store.CURRENT_NAME), name.encode('utf-8'))
+    cleanup_store(name)
+
+    print(f'[Export] Общий снимок версии {version} опубликован за {time.monotonic() - started:.1f} с '
+          f'(магазинов: {meta["shop_count"]}).')
+    return name
+
+if __name__ == '__main__':
+    export_snapshots(force=True)
+    publish_store(force=True)
@@ -0,0 +1,122 @@
+'''
+Слой условной загрузки страниц источников.
+
+Для каждого URL в таблице http_cache хранятся ETag / Last-Modified ответа, хэш содержимого
+страницы и хэш разобранных предложений:
+- запрос отправляется с If-None-Match / If-Modified-Since, ответ 304 означает "ничего не изменилось";
+- если сервер заголовки не поддерживает, совпадение хэша содержимого позволяет не разбирать страницу;
+- если страница изменилась (например, поменялся токен в разметке), но предложения те же -
+  источник тоже пропускается и save_to_db для него не вызывается.
+Во всех трёх случаях бросается PageNotModified.
+
+Новое состояние не записывается сразу: источник возвращает состояния своих страниц вместе с предложениями
+(page_state), get_discounts собирает их только у источников, чей результат получен, а вызывающий код
+сохраняет их commit_fetch_state(pages) после успешной записи данных в базу. Состояние живёт в рамках
+одного обновления - сбой или таймаут источника и сбой save_to_db не приводят к пропуску изменений.
+'''
+
+import hashlib
+import json
+import time
+
+import db
+
+class PageNotModified(Exception):
+    '''
+    Страница или предложения на ней не изменились с прошлого запуска - источник пропускается.
+    pages - новые состояния страниц (если предложения те же, а страница изменилась).
+    '''
+    def __init__(self, message, pages=None):
+        super().__init__(message)
+        self.pages = pages or {}
+
+def init_fetch_cache(conn=None):
+    '''
+    Функция создания таблицы состояний загруженных страниц.
+    '''
+    if conn is None:
+        conn = db.get_connection()
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS http_cache (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            content_hash TEXT,
+            result_hash TEXT,
+            checked_at INTEGER
+        )
+    ''')
+    conn.commit()
+
+def _load_state(url):
+    row = db.get_connection(readonly=True).execute(
+        'SELECT etag, last_modified, content_hash, result_hash FROM http_cache WHERE url = ?', (url,)
+    ).fetchone()
+    return dict(row) if row else {}
+
+def conditional_get(get, url, **kwargs):
+    '''
+    Функция условного GET-запроса. get(url, headers=..., **kwargs) - функция HTTP-клиента
+    (curl_cffi, cloudscraper). Возвращает кортеж (response, validators), где validators
+    нужно передать в page_state() после успешного разбора страницы.
+    '''
+    state = _load_state(url)
+
+    headers = dict(kwargs.pop('headers', None) or {})
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+
+    response = get(url, headers=headers, **kwargs)
+
+    if response.status_code == 304:
+        raise PageNotModified('сервер ответил 304 Not Modified')
+
+    validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'content_hash': hashlib.sha256(response.content).hexdigest(),
+    }
+
+    if response.status_code == 200 and validators['content_hash'] == state.get('content_hash'):
+        raise PageNotModified('содержимое страницы не изменилось')
+
+    return response, validators
+
+def page_state(url, validators, results):
+    '''
+    Функция состояния успешно разобранной страницы: {url: {...}} - источник возвращает его
+    вместе с предложениями. Если предложения совпадают с прошлым запуском - бросает PageNotModified
+    (состояние - в его атрибуте pages).
+    '''
+    result_hash = hashlib.sha256(
+        json.dumps(results, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+    # валидаторы новой версии страницы запоминаются в любом случае -
+    # в следующий раз её не придётся ни скачивать целиком, ни разбирать
+    pages = {url: {**validators, 'result_hash': result_hash}}
+
+    if result_hash == _load_state(url).get('result_hash'):
+        raise PageNotModified('предложения на странице не изменились', pages)
+    return pages
+
+def commit_fetch_state(pages, conn=None):
+    '''
+    Функция записи состояний страниц pages (от get_discounts) в базу.
+    Вызывается после того, как данные источников сохранены (или сохранять было нечего).
+    '''
+    if conn is None:
+        conn = db.get_connection()
+
+    now = int(time.time())
+    with conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO http_cache (url, etag, last_modified, content_hash, result_hash, checked_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [
+            (url, state['etag'], state['last_modified'], state['content_hash'], state['result_hash'], now)
+            for url, state in pages.items()
+        ])
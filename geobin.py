@@ -0,0 +1,166 @@
+'''
+Компактный двоичный формат данных карты (geobin) - замена GeoJSON для магазинов и ячеек Вороного.
+
+Устройство (все числа - little-endian):
+    b'GEOB' | версия (1 байт) | длина заголовка (uint32) | заголовок JSON (UTF-8) | тело
+
+- геометрии хранятся как "рваные массивы" shapely.to_ragged_array: общий массив координат
+  и массивы смещений колец/полигонов; в теле вместо смещений записываются длины
+- координаты квантуются: целое round((x - origin) * scale), scale = 10 ** precision
+  (precision 6 - около 10 см, 5 - около 1 м), и записываются разностями с предыдущей точкой
+  по каждой оси - соседние вершины близко, разности маленькие
+- разности переводятся в беззнаковые числа (zigzag) и пишутся varint'ами (7 бит на байт),
+  так что большинство координат занимает 1-2 байта вместо ~10 символов текста
+- свойства хранятся по колонкам словарём: уникальные значения - в заголовке,
+  номера значений для каждой геометрии - varint'ами в теле (названия сетей и цвета повторяются)
+
+Кодирование и декодирование векторные (numpy), без цикла Python по точкам.
+Декодер для браузера - decodeGeobin() в templates/map.html.
+'''
+
+import json
+import struct
+
+import numpy as np
+import shapely
+
+MAGIC = b'GEOB'
+VERSION = 1
+MIMETYPE = 'application/x-geobin'
+
+# шаг квантования координат по умолчанию (знаков после запятой в градусах)
+DEFAULT_PRECISION = 6
+
+def encode_varints(values):
+    '''
+    Функция записи массива беззнаковых целых varint'ами (как в Protocol Buffers). Возвращает байты.
+    '''
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b''
+
+    # число байт каждого значения: по 7 значащих бит на байт
+    sizes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        sizes += values >= np.uint64(1 << (7 * k))
+
+    owner = np.repeat(np.arange(len(values)), sizes)
+    position = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+    out = ((values[owner] >> (7 * position).astype(np.uint64)) & np.uint64(0x7f)).astype(np.uint8)
+    # старший бит - "дальше есть ещё байт"
+    out[position < sizes[owner] - 1] |= 0x80
+    return out.tobytes()
+
+def decode_varints(data):
+    '''
+    Функция чтения всех varint'ов из байтов. Возвращает массив uint64.
+    '''
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    sizes = ends - starts + 1
+
+    position = np.arange(len(data)) - np.repeat(starts, sizes)
+    parts = (data & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts)
+
+def zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+def unzigzag(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+
+def polygonal(geometries):
+    '''
+    Функция приведения геометрий к виду, который принимает shapely.to_ragged_array: после обрезки
+    по невыпуклой границе изредка получается GeometryCollection - от неё оставляются только полигоны.
+    '''
+    geometries = np.array(geometries, dtype=object)
+    odd = np.flatnonzero(~np.isin(shapely.get_type_id(geometries), (0, 3, 6)))
+    for i in odd:
+        parts = shapely.get_parts(geometries[i])
+        geometries[i] = shapely.multipolygons(parts[shapely.get_type_id(parts) == 3])
+    return geometries
+
+def encode(geometries, properties, precision=DEFAULT_PRECISION):
+    '''
+    Функция кодирования геометрий Shapely (точки или полигоны) и их свойств в geobin.
+    properties - словарь колонок {имя: список значений}, по значению на каждую геометрию.
+    '''
+    geometries = polygonal(geometries)
+    count = len(geometries)
+
+    header = {'count': count, 'precision': precision, 'type': None, 'origin': [0, 0], 'offsets': [], 'coords': 0}
+    chunks = []
+
+    if count:
+        geometry_type, coords, offsets = shapely.to_ragged_array(geometries)
+        scale = 10 ** precision
+
+        # начало отсчёта - первая точка, дальше разности по каждой оси
+        origin = np.round(coords[0], precision) if len(coords) else np.zeros(2)
+        quantized = np.round((coords - origin) * scale).astype(np.int64)
+        deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+
+        header.update({
+            'type': geometry_type.name,
+            'origin': origin.tolist(),
+            'offsets': [len(level) - 1 for level in offsets],
+            'coords': len(coords),
+        })
+
+        for level in offsets:
+            chunks.append(encode_varints(np.diff(level)))
+        chunks.append(encode_varints(zigzag(deltas.ravel())))
+
+    header['properties'] = {}
+    for name, values in properties.items():
+        unique = {}
+        index = [unique.setdefault(value, len(unique)) for value in values]
+        header['properties'][name] = list(unique)
+        chunks.append(encode_varints(index))
+
+    header_bytes = json.dumps(header, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return MAGIC + struct.pack('<BI', VERSION, len(header_bytes)) + header_bytes + b''.join(chunks)
+
+def decode(data):
+    '''
+    Функция декодирования geobin. Возвращает (geometries, properties) - массив Shapely и словарь колонок.
+    Нужна для проверок и бенчмарков: браузер декодирует формат сам.
+    '''
+    if data[:4] != MAGIC:
+        raise ValueError('Это не geobin')
+    version, header_length = struct.unpack_from('<BI', data, 4)
+    if version != VERSION:
+        raise ValueError(f'Неизвестная версия geobin: {version}')
+
+    body_start = 9 + header_length
+    header = json.loads(data[9:body_start].decode('utf-8'))
+    values = decode_varints(data[body_start:])
+
+    position = 0
+    def take(n):
+        nonlocal position
+        position += n
+        return values[position - n:position]
+
+    geometries = np.empty(0, dtype=object)
+    if header['count']:
+        offsets = [np.concatenate([[0], np.cumsum(take(n).astype(np.int64))]) for n in header['offsets']]
+        deltas = unzigzag(take(2 * header['coords'])).reshape(-1, 2)
+        coords = np.cumsum(deltas, axis=0) / 10 ** header['precision'] + header['origin']
+        geometry_type = shapely.GeometryType[header['type']]
+        geometries = shapely.from_ragged_array(geometry_type, coords, offsets or None)
+
+    properties = {}
+    for name, unique in header['properties'].items():
+        index = take(header['count']).astype(np.int64)
+        properties[name] = [unique[i] for i in index]
+
+    return geometries, properties
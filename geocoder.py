@@ -0,0 +1,238 @@
+'''
+Геокодирование адресов магазинов с постоянным кэшем в базе данных.
+
+- результаты (и удачные, и неудачные) хранятся в таблице geocode_cache по нормализованному адресу,
+  поэтому вернувшийся магазин или переименованный сетью адрес не геокодируется заново
+- у записей есть срок жизни: удачные живут долго, неудачные - недолго, чтобы повторить поиск позже
+- ручные правки CORRECTIONS записываются в кэш как бессрочные
+- один долгоживущий клиент Nominatim, запросы к нему проходят через ограничитель TokenBucket
+  (правила Nominatim - не больше 1 запроса в секунду)
+- geocode_batch() геокодирует сразу пачку адресов: время работы определяется лимитом запросов,
+  а не суммой пауз после каждого адреса
+'''
+
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from geopy import Nominatim
+
+import db
+import metrics
+
+CORRECTIONS = {
+    'Минск, ул. Ангарская, 36А': (53.871291, 27.685107),
+    'Минск, ул. Алибегова, 13/1': (53.871037, 27.473608),
+    'Минск, ул. Я. Коласа, 33': (53.924654, 27.591547),
+    'Молодечно, ул. В. Гостинец, 54': (54.307416, 26.829399),
+    'Минск, ул. Калиновского, 55 (1 этаж)': (53.947219, 27.628711),
+    'Минск, ул.Романовская Слобода, 12': (53.903292, 27.546281)
+}
+
+USER_AGENT = 'secondhand_map_pet_project'
+
+# лимит запросов к Nominatim (запросов в секунду) и допустимый всплеск
+RATE_LIMIT = 1.0
+RATE_BURST = 1
+
+# сколько потоков одновременно ждут ответа Nominatim в geocode_batch
+BATCH_WORKERS = 4
+
+# срок жизни записей кэша (сек): найденные координаты и "ничего не найдено"
+POSITIVE_TTL = 180 * 24 * 3600
+NEGATIVE_TTL = 7 * 24 * 3600
+
+# слова, которые не влияют на ключ кэша: "г.", "ул.", "пр-т" и т.п.
+ADDRESS_STOPWORDS = {'г', 'ул', 'улица', 'пр', 'т', 'тр', 'проспект', 'тракт', 'д', 'дом'}
+
+class TokenBucket:
+    '''
+    Ограничитель частоты запросов "ведро токенов": токены пополняются со скоростью rate в секунду,
+    каждый запрос забирает один токен и ждёт, если ведро пустое. Потокобезопасен.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+_bucket = TokenBucket(RATE_LIMIT, RATE_BURST)
+_geolocator = None
+_geolocator_lock = threading.Lock()
+
+def get_geolocator():
+    '''
+    Функция получения единственного клиента Nominatim (создаётся при первом обращении).
+    '''
+    global _geolocator
+    with _geolocator_lock:
+        if _geolocator is None:
+            _geolocator = Nominatim(user_agent=USER_AGENT, timeout=10)
+        return _geolocator
+
+def normalize_address(address):
+    '''
+    Функция построения ключа кэша по адресу:
+    регистр, "ё", пунктуация, лишние пробелы и служебные слова ("ул.", "г.") не учитываются.
+    '''
+    words = re.findall(r'\w+', address.lower().replace('ё', 'е'))
+    return ' '.join(word for word in words if word not in ADDRESS_STOPWORDS)
+
+def init_cache(conn=None):
+    '''
+    Функция создания таблицы кэша и записи в неё ручных правок CORRECTIONS.
+    '''
+    if conn is None:
+        conn = db.get_connection()
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            address_key TEXT PRIMARY KEY,
+            lat REAL,
+            lon REAL,
+            source TEXT,
+            expires_at INTEGER
+        )
+    ''')
+
+    # ручные правки бессрочные (expires_at = NULL) и перезаписывают найденное Nominatim
+    conn.executemany('''
+        INSERT OR REPLACE INTO geocode_cache (address_key, lat, lon, source, expires_at)
+        VALUES (?, ?, ?, 'manual', NULL)
+    ''', [(normalize_address(address), lat, lon) for address, (lat, lon) in CORRECTIONS.items()])
+
+    conn.commit()
+
+def _lookup_cache(conn, keys):
+    '''
+    Функция чтения непросроченных записей кэша для набора ключей.
+    Возвращает словарь {ключ: (lat, lon)}; для неудачных поисков - (None, None).
+    '''
+    found = {}
+    keys = list(keys)
+    now = int(time.time())
+
+    # ключи передаются пачками, чтобы не упереться в лимит параметров SQLite
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        rows = conn.execute(f'''
+            SELECT address_key, lat, lon FROM geocode_cache
+            WHERE address_key IN ({placeholders}) AND (expires_at IS NULL OR expires_at > ?)
+        ''', (*chunk, now)).fetchall()
+
+        for row in rows:
+            found[row[0]] = (row[1], row[2])
+
+    return found
+
+def _store_cache(conn, results):
+    '''
+    Функция записи результатов Nominatim в кэш. results - словарь {ключ: (lat, lon)}.
+    '''
+    now = int(time.time())
+    conn.executemany('''
+        INSERT OR REPLACE INTO geocode_cache (address_key, lat, lon, source, expires_at)
+        VALUES (?, ?, ?, 'nominatim', ?)
+    ''', [
+        (key, lat, lon, now + (POSITIVE_TTL if lat is not None else NEGATIVE_TTL))
+        for key, (lat, lon) in results.items()
+    ])
+
+def _query_nominatim(address):
+    '''
+    Функция одного запроса к Nominatim с учётом лимита частоты.
+    '''
+    # очистка адреса для улучшения поисковых возможностей
+    clean_address = address.\
+        replace('г.', '').\
+        replace('ул.', '').\
+        replace('пр-т', '').\
+        replace('тр-т', '').\
+        replace('/', ' к')
+
+    # ожидание лимита и сам запрос замеряются отдельно - видно, на что уходит время геокодирования
+    with metrics.span('geocode_wait'):
+        _bucket.acquire()
+
+    try:
+        with metrics.span('geocode_request'):
+            location = get_geolocator().geocode(clean_address)
+
+        if location:
+            # вывод этапов поиска для отладки
+            print(f'  [Check] Запрос для поиска: {clean_address} > Результат: {location.address}')
+
+            return location.latitude, location.longitude
+        else:
+            print(f"  [Warn] Nominatum ничего не нашел по запросу: {clean_address}")
+
+    except Exception as e:
+        print(f'  [Error] Ошибка геокодинга для {address}: {e}')
+        # сетевую ошибку не кэширую - это не "адрес не найден"
+        return None
+
+    return None, None
+
+def geocode_batch(addresses, conn=None):
+    '''
+    Функция геокодирования пачки адресов.
+    Возвращает словарь {адрес: (lat, lon)}; если координаты не найдены - (None, None).
+    Адреса из кэша не запрашиваются, остальные запрашиваются параллельно в пределах лимита.
+    '''
+    if conn is None:
+        conn = db.get_connection()
+
+    keys = {address: normalize_address(address) for address in addresses}
+    cached = _lookup_cache(conn, set(keys.values()))
+
+    # по одному запросу на каждый ключ, которого нет в кэше
+    missing = {}
+    for address, key in keys.items():
+        if key not in cached and key not in missing:
+            missing[key] = address
+
+    hits = sum(key in cached for key in keys.values())
+    if hits:
+        print(f'  [Cache] Координаты из кэша: {hits} адресов.')
+    metrics.inc('geocode_cache_total', hits, 'Адреса по результату поиска в кэше геокодирования', result='hit')
+    metrics.inc('geocode_cache_total', len(keys) - hits, 'Адреса по результату поиска в кэше геокодирования', result='miss')
+
+    fetched = {}
+    if missing:
+        print(f'  [Geo] Запросов к Nominatim: {len(missing)} (не быстрее {RATE_LIMIT:g} в секунду)')
+        with metrics.span('geocode'), \
+                ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='geocoder') as executor:
+            for key, coords in zip(missing, executor.map(_query_nominatim, missing.values())):
+                if coords is not None:
+                    fetched[key] = coords
+
+        _store_cache(conn, fetched)
+        conn.commit()
+
+    results = {}
+    for address, key in keys.items():
+        results[address] = cached.get(key) or fetched.get(key) or (None, None)
+    return results
+
+def geocode(address, conn=None):
+    '''
+    Функция геокодирования одного адреса через кэш. Возвращает (lat, lon) или (None, None).
+    '''
+    return geocode_batch([address], conn)[address]
@@ -0,0 +1,95 @@
+'''
+Чтение магазинов из базы и их сериализация в GeoJSON или двоичный формат geobin.
+Используется веб-приложением (app.py) и выгрузкой статических снимков (export.py).
+'''
+
+import numpy as np
+import shapely
+
+import db
+import geobin
+import metrics
+from serialize import dumps
+
+# сколько строк курсора превращать в один кусок ответа
+STREAM_BATCH_SIZE = 500
+
+def iter_shops_from_db(bbox=None):
+    """
+    Функция чтения магазинов для GeoJSON.
+    Выбираются только нужные колонки, строки отдаются курсором по мере чтения - без fetchall().
+    bbox=(min_lon, min_lat, max_lon, max_lat) - только магазины в рамке (через индекс R*Tree).
+    """
+    # соединение только для чтения из пула текущего потока - закрывать не нужно
+    conn = db.get_connection(readonly=True)
+    cursor = conn.cursor()
+    # кортежи вместо sqlite3.Row - меньше накладных расходов на строку
+    cursor.row_factory = None
+    
+    if bbox is None:
+        cursor.execute('SELECT id, shop_name, address, discount, color, lon, lat FROM shops')
+    else:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        cursor.execute('''
+            SELECT s.id, s.shop_name, s.address, s.discount, s.color, s.lon, s.lat
+            FROM shops_rtree r JOIN shops s ON s.id = r.id
+            WHERE r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+        ''', (min_lon, max_lon, min_lat, max_lat))
+    return cursor
+
+def shop_feature(shop_id, shop_name, address, discount, color, lon, lat):
+    """
+    Функция сборки Feature GeoJSON магазина (колонки в порядке iter_shops_from_db).
+    """
+    return {
+        'type': 'Feature',
+        'properties': {
+            'id': shop_id,
+            'shop_name': shop_name,
+            'address': address,
+            'discount': discount,
+            'color': color
+        },
+        'geometry': {
+            'type': 'Point',
+            'coordinates': [lon, lat]
+        }
+    }
+
+def stream_shops_geojson(cursor):
+    """
+    Генератор GeoJSON FeatureCollection по частям.
+    Каждый магазин сериализуется отдельно и сразу уходит в сокет - в памяти не копится всё дерево.
+    """
+    yield b'{"type":"FeatureCollection","features":['
+    
+    separator = b''
+    while True:
+        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            break
+        
+        chunk = b','.join(dumps(shop_feature(*row)) for row in rows)
+        yield separator + chunk
+        separator = b','
+    
+    yield b']}'
+
+@metrics.timed('serialize', target='shops')
+def shops_geojson(bbox=None):
+    """
+    Функция получения всего GeoJSON магазинов одним куском байтов.
+    """
+    return b''.join(stream_shops_geojson(iter_shops_from_db(bbox)))
+
+@metrics.timed('serialize', target='shops_bin')
+def shops_geobin(bbox=None):
+    """
+    Функция получения магазинов в двоичном формате geobin (точки и колонки свойств).
+    """
+    rows = iter_shops_from_db(bbox).fetchall()
+    shop_id, shop_name, address, discount, color, lon, lat = zip(*rows) if rows else ([],) * 7
+    return geobin.encode(
+        shapely.points(np.column_stack([lon, lat])) if rows else [],
+        {'id': shop_id, 'shop_name': shop_name, 'address': address, 'discount': discount, 'color': color},
+    )
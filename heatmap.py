@@ -0,0 +1,194 @@
+'''
+Тепловая карта "насколько выгодно рядом": растр поверх карты в дополнение к ячейкам Вороного.
+
+- сетка с шагом HEATMAP_CELL метров покрывает рамку магазинов с запасом HEATMAP_RADIUS
+- цвет клетки - лучший цвет цены (classifier.get_profit_color, как у точек магазинов), магазин
+  которого есть в радиусе HEATMAP_RADIUS; прозрачность растёт с расстоянием до ближайшего такого магазина,
+  клетки без разобранных предложений рядом - прозрачные
+- расстояния считаются для всех клеток сразу преобразованием расстояний (scipy.ndimage.distance_transform_edt)
+  по растру магазинов каждого цвета - за линейное от числа клеток время, без запросов к дереву по клеткам
+- тайлы PNG 256 x 256 (схема z/x/y, как у подложки) вырезаются из сетки индексами numpy
+  и кодируются без сторонних библиотек (zlib); сетка и тайлы кэшируются до смены версии данных
+'''
+
+import math
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+import metrics
+from classifier import COLORS
+from shop_index import EARTH_RADIUS, get_shop_index
+from store import ShopRows
+
+# шаг сетки (м) и радиус "доступности" магазина (м)
+HEATMAP_CELL = 25
+HEATMAP_RADIUS = 1000
+
+# предел размера сетки (клеток): для рамки на несколько городов шаг увеличивается
+HEATMAP_MAX_CELLS = 1_500_000
+
+# прозрачность у самого магазина (0..255), к краю радиуса - до нуля
+HEATMAP_MAX_ALPHA = 170
+
+TILE_SIZE = 256
+
+# сколько тайлов хранить в кэше одной версии (LRU)
+TILE_CACHE_SIZE = 4096
+
+# цвета RGB по COLORS (как CSS-цвета точек на карте); последний код - "нет данных"
+PALETTE = np.array([
+    (0, 128, 0),      # green
+    (255, 165, 0),    # orange
+    (255, 0, 0),      # red
+    (128, 128, 128),  # gray
+    (0, 0, 0),        # нет магазинов рядом
+], dtype=np.uint8)
+NO_DATA = len(COLORS)
+
+_heatmap = None
+_heatmap_lock = threading.Lock()
+
+def encode_png(rgba):
+    '''
+    Функция кодирования изображения RGBA (массив h x w x 4, uint8) в PNG.
+    '''
+    height, width, _ = rgba.shape
+    # у каждой строки - байт фильтра 0 (без фильтра)
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + chunk(b'IEND', b'')
+
+EMPTY_TILE = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+def build_heatmap(index):
+    '''
+    Функция расчёта сетки по индексу магазинов (shop_index.get_shop_index).
+    Возвращает словарь: рамка и шаг сетки (градусы), коды цветов и прозрачность клеток.
+    '''
+    heatmap = {'version': index['version'], 'tiles': OrderedDict(), 'grid': None}
+    if index['tree'] is None:
+        return heatmap
+
+    lat, lon = np.asarray(index['lat']), np.asarray(index['lon'])
+    rows = index['rows']
+    colors = rows.column('color', np.arange(len(rows))) if isinstance(rows, ShopRows) else [row['color'] for row in rows]
+    colors = np.asarray(colors)
+
+    # клетки квадратные в метрах: шаг по долготе - с поправкой на широту центра;
+    # если рамка велика (несколько городов), шаг растёт так, чтобы клеток было не больше HEATMAP_MAX_CELLS
+    lat0 = math.radians((lat.min() + lat.max()) / 2)
+    margin = math.degrees(HEATMAP_RADIUS / EARTH_RADIUS)
+    min_lat, max_lat = lat.min() - margin, lat.max() + margin
+    min_lon, max_lon = lon.min() - margin / math.cos(lat0), lon.max() + margin / math.cos(lat0)
+    area = math.radians(max_lat - min_lat) * math.radians(max_lon - min_lon) * math.cos(lat0) * EARTH_RADIUS ** 2
+    cell = max(HEATMAP_CELL, math.sqrt(area / HEATMAP_MAX_CELLS))
+    step_lat = math.degrees(cell / EARTH_RADIUS)
+    step_lon = step_lat / math.cos(lat0)
+    shape = (math.ceil((max_lat - min_lat) / step_lat), math.ceil((max_lon - min_lon) / step_lon))
+
+    # клетки магазинов: строки сверху вниз (как пиксели изображения)
+    shop_row = np.floor((max_lat - lat) / step_lat).astype(np.int64)
+    shop_col = np.floor((lon - min_lon) / step_lon).astype(np.int64)
+
+    code = np.full(shape, NO_DATA, dtype=np.uint8)
+    alpha = np.zeros(shape, dtype=np.uint8)
+    radius = HEATMAP_RADIUS / cell
+    # от лучшего цвета к худшему: клетка получает первый цвет, магазин которого в радиусе
+    for color in COLORS[:-1]:
+        shops = colors == color
+        if not shops.any():
+            continue
+        empty = np.ones(shape, dtype=bool)
+        empty[shop_row[shops], shop_col[shops]] = False
+        # расстояние (в клетках) от каждой клетки до ближайшего магазина этого цвета
+        distance = distance_transform_edt(empty)
+        reached = (distance <= radius) & (code == NO_DATA)
+        code[reached] = COLORS.index(color)
+        alpha[reached] = (HEATMAP_MAX_ALPHA * (1 - distance[reached] / radius)).astype(np.uint8)
+
+    heatmap['grid'] = {
+        'max_lat': max_lat,
+        'min_lon': min_lon,
+        'step_lat': step_lat,
+        'step_lon': step_lon,
+        'cell': cell,
+        'code': code,
+        'alpha': alpha,
+    }
+    return heatmap
+
+def get_heatmap():
+    '''
+    Функция получения сетки актуальной версии данных (с пересчётом при смене версии).
+    '''
+    global _heatmap
+    index = get_shop_index()
+
+    heatmap = _heatmap
+    if heatmap is not None and heatmap['version'] == index['version']:
+        return heatmap
+
+    with _heatmap_lock:
+        if _heatmap is None or _heatmap['version'] != index['version']:
+            with metrics.span('heatmap_build'):
+                _heatmap = build_heatmap(index)
+        return _heatmap
+
+def render_tile(grid, z, x, y):
+    '''
+    Функция вырезки тайла z/x/y из сетки: центр каждого пикселя переводится в lon/lat (Меркатор)
+    и в номер клетки. Если тайл не задевает сетку - None.
+    '''
+    n = 2 ** z
+    pixels = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lon = (x + pixels) / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + pixels) / n))))
+
+    row = np.floor((grid['max_lat'] - lat) / grid['step_lat']).astype(np.int64)
+    col = np.floor((lon - grid['min_lon']) / grid['step_lon']).astype(np.int64)
+    rows_count, cols_count = grid['code'].shape
+    row_ok = (row >= 0) & (row < rows_count)
+    col_ok = (col >= 0) & (col < cols_count)
+    if not row_ok.any() or not col_ok.any():
+        return None
+
+    # строки и столбцы тайла независимы: выборка из сетки - внешнее произведение индексов
+    rows_index = np.clip(row, 0, rows_count - 1)[:, None]
+    cols_index = np.clip(col, 0, cols_count - 1)[None, :]
+    inside = row_ok[:, None] & col_ok[None, :]
+
+    rgba = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    rgba[..., :3] = PALETTE[grid['code'][rows_index, cols_index]]
+    rgba[..., 3] = np.where(inside, grid['alpha'][rows_index, cols_index], 0)
+    return encode_png(rgba)
+
+def get_tile(z, x, y):
+    '''
+    Функция получения тайла PNG тепловой карты. Возвращает кортеж (version, png).
+    '''
+    heatmap = get_heatmap()
+    key = (z, x, y)
+
+    # кэш LRU: запрошенный тайл переносится в конец, вытесняются давно не запрошенные
+    tiles = heatmap['tiles']
+    with _heatmap_lock:
+        png = tiles.get(key)
+        if png is not None:
+            tiles.move_to_end(key)
+    if png is None:
+        png = render_tile(heatmap['grid'], z, x, y) if heatmap['grid'] is not None else None
+        png = png or EMPTY_TILE
+        with _heatmap_lock:
+            tiles[key] = png
+            if len(tiles) > TILE_CACHE_SIZE:
+                tiles.popitem(last=False)
+    return heatmap['version'], png
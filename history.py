@@ -0,0 +1,228 @@
+'''
+История цен магазинов.
+
+- таблица price_history только дополняется: save_to_db перезаписывает текущее предложение в shops,
+  а сюда попадает строка, только если цена или единица магазина изменились
+- строка компактная: целые id магазина, номер дня (дней с 1970-01-01 по местной дате) и код единицы
+  (справочник price_units), числовая цена; таблица WITHOUT ROWID с ключом (shop_id, day) -
+  история одного магазина лежит подряд и читается поиском по диапазону ключа
+- строка действует со своего дня до дня следующей строки (окно LEAD), по дням её разворачивает numpy:
+  отсюда "типичная" цена по дням недели и сравнение с сегодняшней
+'''
+
+import datetime
+
+import numpy as np
+
+import db
+from classifier import THRESHOLDS, profit_scores
+
+EPOCH = datetime.date(1970, 1, 1)
+
+# дни недели по номеру datetime.date.weekday()
+WEEKDAYS = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+
+def today():
+    '''
+    Функция номера текущего дня (по местной дате сервера) - дней с 1970-01-01.
+    '''
+    return (datetime.date.today() - EPOCH).days
+
+def day_to_date(day):
+    return EPOCH + datetime.timedelta(days=int(day))
+
+def day_to_weekday(days):
+    # 1970-01-01 - четверг (weekday() == 3); работает и для чисел, и для массивов numpy
+    return (days + 3) % 7
+
+def init_history(conn=None):
+    '''
+    Функция создания таблиц истории цен и справочника единиц.
+    '''
+    if conn is None:
+        conn = db.get_connection()
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS price_units (
+            id INTEGER PRIMARY KEY,
+            unit TEXT UNIQUE
+        )
+    ''')
+    # коды единиц выдаются один раз и дальше не меняются
+    conn.executemany('INSERT OR IGNORE INTO price_units (unit) VALUES (?)', [(unit,) for unit in THRESHOLDS])
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS price_history (
+            shop_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            price REAL,
+            unit_id INTEGER,
+            PRIMARY KEY (shop_id, day)
+        ) WITHOUT ROWID
+    ''')
+    # выборки "что менялось в такой-то день" по всем магазинам
+    conn.execute('CREATE INDEX IF NOT EXISTS price_history_day ON price_history (day)')
+
+    conn.commit()
+
+def record_prices(conn, day=None):
+    '''
+    Функция записи в историю текущих цен магазинов из пачки save_to_db (временная таблица scraped).
+    Строка добавляется, только если цена или единица отличаются от последней записанной для магазина.
+    Строка дня day заменяется при повторном изменении в тот же день, а если цена вернулась
+    к последней записи до этого дня - удаляется (в истории не остаётся "изменения" без изменения).
+    Вызывается внутри транзакции save_to_db; возвращает число добавленных строк.
+    '''
+    if day is None:
+        day = today()
+
+    # цена вернулась к прежней в тот же день: сегодняшняя строка сравнивается с последней до сегодняшнего дня
+    conn.execute('''
+        DELETE FROM price_history
+        WHERE day = ? AND shop_id IN (
+            SELECT s.id
+            FROM temp.scraped t
+            JOIN shops s ON s.shop_name = t.shop_name AND s.address = t.address
+            LEFT JOIN price_units u ON u.unit = s.unit
+            WHERE EXISTS (
+                SELECT 1 FROM (
+                    SELECT price, unit_id FROM price_history h
+                    WHERE h.shop_id = s.id AND h.day < ?
+                    ORDER BY h.day DESC LIMIT 1
+                ) previous
+                WHERE previous.price IS s.price AND previous.unit_id IS u.id
+            )
+        )
+    ''', (day, day))
+
+    # последняя строка магазина находится по первичному ключу (shop_id, day) - без просмотра всей истории
+    cursor = conn.execute('''
+        INSERT OR REPLACE INTO price_history (shop_id, day, price, unit_id)
+        SELECT s.id, ?, s.price, u.id
+        FROM temp.scraped t
+        JOIN shops s ON s.shop_name = t.shop_name AND s.address = t.address
+        LEFT JOIN price_units u ON u.unit = s.unit
+        WHERE NOT EXISTS (
+            SELECT 1 FROM (
+                SELECT price, unit_id FROM price_history h
+                WHERE h.shop_id = s.id
+                ORDER BY h.day DESC LIMIT 1
+            ) last
+            WHERE last.price IS s.price AND last.unit_id IS u.id
+        )
+    ''', (day,))
+    return cursor.rowcount
+
+def load_history(shop_id):
+    '''
+    Функция чтения истории магазина в виде колонок numpy:
+    day, next_day (день следующей строки; у последней - завтрашний день), price, unit.
+    Если истории нет - None.
+    '''
+    conn = db.get_connection(readonly=True)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+
+    rows = cursor.execute('''
+        SELECT h.day, LEAD(h.day, 1, ?) OVER (ORDER BY h.day), h.price, u.unit
+        FROM price_history h LEFT JOIN price_units u ON u.id = h.unit_id
+        WHERE h.shop_id = ?
+        ORDER BY h.day
+    ''', (today() + 1, shop_id)).fetchall()
+
+    if not rows:
+        return None
+
+    day, next_day, price, unit = zip(*rows)
+    return {
+        'day': np.array(day, dtype=np.int64),
+        'next_day': np.array(next_day, dtype=np.int64),
+        'price': np.array([np.nan if value is None else value for value in price], dtype=float),
+        'unit': np.array(unit, dtype=object),
+    }
+
+def weekday_profile(history):
+    '''
+    Функция сводки "сегодня против типичного" по истории магазина (результат load_history).
+
+    Каждая строка истории разворачивается в дни, когда она действовала; для единицы текущего
+    предложения считается средняя цена по каждому дню недели. Снижения цены (в сравнимой оценке
+    classifier.profit_scores, так что рост скидки в % - тоже снижение) считаются по дням недели,
+    в которые они произошли.
+    '''
+    day, price, unit = history['day'], history['price'], history['unit']
+    current_unit = unit[-1]
+    current_price = price[-1]
+
+    # разворачивание строк по дням: k-я строка повторяется (next_day - day) раз
+    lengths = np.maximum(history['next_day'] - day, 0)
+    daily_day = np.repeat(day, lengths) + (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    daily_price = np.repeat(price, lengths)
+    daily_weekday = day_to_weekday(daily_day)
+
+    mask = (np.repeat(unit, lengths) == current_unit) & ~np.isnan(daily_price)
+    days_count = np.bincount(daily_weekday[mask], minlength=7)
+    price_sum = np.bincount(daily_weekday[mask], weights=daily_price[mask], minlength=7)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        typical = price_sum / days_count
+
+    # снижения: оценка выгодности стала меньше, чем у предыдущей строки той же единицы
+    score = profit_scores(unit, price)
+    same_unit = unit[1:] == unit[:-1]
+    drops = same_unit & (score[1:] < score[:-1])
+    drop_count = np.bincount(day_to_weekday(day[1:][drops]), minlength=7)
+
+    today_day = today()
+    today_weekday = day_to_weekday(today_day)
+
+    def number(value):
+        return None if np.isnan(value) else round(float(value), 2)
+
+    typical_today = typical[today_weekday]
+    has_typical = days_count.any()
+    return {
+        'unit': current_unit,
+        'today': {
+            'date': day_to_date(today_day).isoformat(),
+            'weekday': WEEKDAYS[today_weekday],
+            'price': number(current_price),
+            'typical': number(typical_today),
+            'delta': number(current_price - typical_today),
+            'typical_all_days': number(price_sum.sum() / days_count.sum()) if has_typical else None,
+        },
+        'weekdays': [
+            {
+                'weekday': WEEKDAYS[i],
+                'typical': number(typical[i]),
+                'days': int(days_count[i]),
+                'drops': int(drop_count[i]),
+            }
+            for i in range(7)
+        ],
+        # день недели, когда цена магазина обычно самая выгодная, и когда она чаще всего снижается
+        'best_weekday': WEEKDAYS[int(np.nanargmin(profit_scores([current_unit] * 7, typical)))]
+            if current_unit is not None and has_typical else None,
+        'drop_weekday': WEEKDAYS[int(np.argmax(drop_count))] if drop_count.any() else None,
+    }
+
+def get_shop_history(shop_id):
+    '''
+    Функция истории цен магазина для API: изменения цены по датам и сводка по дням недели.
+    Если магазин в истории не встречается - None.
+    '''
+    history = load_history(shop_id)
+    if history is None:
+        return None
+
+    return {
+        'shop_id': shop_id,
+        'history': [
+            {
+                'date': day_to_date(day).isoformat(),
+                'price': None if np.isnan(price) else float(price),
+                'unit': unit,
+            }
+            for day, price, unit in zip(history['day'], history['price'], history['unit'])
+        ],
+        'summary': weekday_profile(history),
+    }
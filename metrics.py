@@ -0,0 +1,222 @@
+'''
+Метрики и замеры времени этапов в формате Prometheus (text exposition format 0.0.4).
+
+- span('fetch', source='modamax') - контекстный менеджер: длительность этапа попадает
+  в гистограмму stage_seconds с метками stage и дополнительными метками; timed - то же для функции
+- histogram/counter/gauge - метрики по имени, метки - именованные аргументы
+- render() - текст для GET /metrics; процесс обновления (scheduler.py, database.py) пишет свои
+  метрики в файл write_textfile(), веб-приложение добавляет этот файл к своему ответу
+  (у метрик процесса обновления другой префикс имён, чтобы семейства не пересекались)
+- start_profiler() - выборочный профилировщик: фоновый поток раз в interval секунд снимает стеки
+  всех потоков и копит счётчики в формате "collapsed stacks" (для flamegraph.pl / speedscope);
+  включается переменной окружения PROFILE_INTERVAL (например, 0.01), файл - PROFILE_OUTPUT
+
+Без сторонних зависимостей: prometheus_client ради нескольких гистограмм не нужен.
+'''
+
+import atexit
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# префикс имён метрик веб-приложения и процесса обновления
+PREFIX = 'shops'
+REFRESH_PREFIX = 'shops_refresh'
+
+# файл с метриками процесса обновления - его читает /metrics веб-приложения
+METRICS_FILE = os.environ.get('METRICS_FILE', 'refresh_metrics.prom')
+
+# границы корзин гистограмм (сек): от миллисекунды у запросов API до минут у парсинга
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+# {имя: {'type': ..., 'help': ..., 'series': {метки: значение}}}
+_metrics = {}
+
+def _series(name, kind, help_text, labels):
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = {'type': kind, 'help': help_text, 'series': {}}
+    return metric['series'], tuple(sorted(labels.items()))
+
+def observe(name, value, help_text='', **labels):
+    '''
+    Функция записи значения в гистограмму name.
+    '''
+    with _lock:
+        series, key = _series(name, 'histogram', help_text, labels)
+        entry = series.get(key)
+        if entry is None:
+            entry = series[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                entry['buckets'][i] += 1
+        entry['sum'] += value
+        entry['count'] += 1
+
+def inc(name, value=1, help_text='', **labels):
+    '''
+    Функция увеличения счётчика name.
+    '''
+    with _lock:
+        series, key = _series(name, 'counter', help_text, labels)
+        series[key] = series.get(key, 0) + value
+
+def set_gauge(name, value, help_text='', **labels):
+    '''
+    Функция установки значения показателя name.
+    '''
+    with _lock:
+        series, key = _series(name, 'gauge', help_text, labels)
+        series[key] = value
+
+@contextmanager
+def span(stage, **labels):
+    '''
+    Контекстный менеджер замера этапа: длительность записывается в гистограмму stage_seconds.
+    Если этап прервался исключением - оно тоже записывается, имя класса в метке error
+    (PageNotModified - тоже исключение, так что "страница не изменилась" видно отдельно от сбоев).
+    '''
+    started = time.perf_counter()
+    error = ''
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        observe(
+            'stage_seconds', time.perf_counter() - started,
+            'Длительность этапов обработки данных, сек', stage=stage, error=error, **labels
+        )
+
+def timed(stage, **labels):
+    '''
+    Декоратор: каждый вызов функции замеряется как этап stage (см. span).
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _format_labels(key, extra=()):
+    pairs = [*key, *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def render(prefix=PREFIX):
+    '''
+    Функция вывода всех метрик процесса в текстовом формате Prometheus.
+    '''
+    lines = []
+    with _lock:
+        for name, metric in sorted(_metrics.items()):
+            full_name = f'{prefix}_{name}'
+            lines.append(f'# HELP {full_name} {metric["help"]}')
+            lines.append(f'# TYPE {full_name} {metric["type"]}')
+
+            for key, value in metric['series'].items():
+                if metric['type'] != 'histogram':
+                    lines.append(f'{full_name}{_format_labels(key)} {value}')
+                    continue
+
+                # корзины гистограммы Prometheus - накопительные
+                for bound, count in zip(BUCKETS, value['buckets']):
+                    lines.append(f'{full_name}_bucket{_format_labels(key, [("le", bound)])} {count}')
+                lines.append(f'{full_name}_bucket{_format_labels(key, [("le", "+Inf")])} {value["count"]}')
+                lines.append(f'{full_name}_sum{_format_labels(key)} {value["sum"]}')
+                lines.append(f'{full_name}_count{_format_labels(key)} {value["count"]}')
+
+    return '\n'.join(lines) + '\n'
+
+def write_textfile(path=None, prefix=REFRESH_PREFIX):
+    '''
+    Функция записи метрик процесса в файл (атомарно - через временный файл).
+    '''
+    path = path or METRICS_FILE
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(render(prefix))
+    os.replace(tmp_path, path)
+
+def read_textfile(path=None):
+    '''
+    Функция чтения метрик процесса обновления. Если файла нет - пустая строка.
+    '''
+    try:
+        with open(path or METRICS_FILE, encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return ''
+
+class SamplingProfiler:
+    '''
+    Выборочный профилировщик: раз в interval секунд снимает стеки всех потоков (sys._current_frames)
+    и считает, сколько раз встретился каждый стек. Накладные расходы - один проход по стекам
+    за интервал, код приложения не меняется.
+    '''
+    def __init__(self, interval, output):
+        self.interval = interval
+        self.output = output
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self):
+        '''
+        Функция записи накопленных стеков в формате "стек;через;точку_с_запятой число".
+        '''
+        with open(self.output, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
+        self.dump()
+
+_profiler = None
+
+def start_profiler():
+    '''
+    Функция запуска профилировщика, если задана переменная окружения PROFILE_INTERVAL (сек).
+    Результат пишется при выходе из процесса в PROFILE_OUTPUT (по умолчанию profile-<pid>.txt).
+    '''
+    global _profiler
+    interval = os.environ.get('PROFILE_INTERVAL')
+    if not interval or _profiler is not None:
+        return None
+
+    output = os.environ.get('PROFILE_OUTPUT', f'profile-{os.getpid()}.txt')
+    _profiler = SamplingProfiler(float(interval), output)
+    _profiler.start()
+    print(f'[Profile] Профилировщик включён: раз в {interval} с, результат - {output}')
+    return _profiler
@@ -0,0 +1,105 @@
+'''
+Планировщик обновления данных - долгоживущий процесс вместо разового запуска database.py по cron.
+
+- интерпретатор и тяжёлые модули (cloudscraper, curl_cffi, geopy) загружаются один раз
+- HTTP-сессии источников и клиент Nominatim остаются "тёплыми" между запусками
+- каждый источник опрашивается со своим интервалом (SOURCES[...]['interval']) и случайным сдвигом,
+  чтобы запросы не приходили на сайты строго по расписанию
+- неизменившиеся страницы пропускаются (fetcher), в базу пишутся только сети с новыми данными
+- save_to_db увеличивает версию данных - веб-приложение по ней само сбрасывает свои кэши
+
+Запуск: python scheduler.py (остановка - Ctrl+C или SIGTERM)
+'''
+
+import heapq
+import random
+import signal
+import threading
+import time
+
+import fetcher
+import metrics
+from database import init_db, save_to_db
+from export import export_snapshots, publish_store
+from scraper import SOURCES, get_discounts
+
+# доля интервала, на которую случайно сдвигается следующий запуск источника (+/-)
+JITTER = 0.1
+
+_stop = threading.Event()
+
+def next_delay(name):
+    '''
+    Функция расчёта паузы до следующего опроса источника: интервал +/- случайный сдвиг.
+    '''
+    interval = SOURCES[name]['interval']
+    return interval * (1 + random.uniform(-JITTER, JITTER))
+
+@metrics.timed('refresh')
+def refresh(names):
+    '''
+    Функция одного обновления: опрос источников names и запись изменившихся данных в базу.
+    '''
+    print(f"\n[Scheduler] Обновление: {', '.join(SOURCES[name]['title'] for name in names)}")
+    # состояния страниц - только этого обновления: если save_to_db упадёт, они пропадут вместе с ним,
+    # и источник будет опрошен заново, а не сочтён неизменившимся при обновлении другого источника
+    data, pages = get_discounts(names)
+
+    if data:
+        save_to_db(data)
+    else:
+        print('[Scheduler] Новых данных нет.')
+
+    # состояние страниц запоминается только после того, как их данные сохранены
+    fetcher.commit_fetch_state(pages)
+
+    # статические снимки для карты и общий снимок для процессов веб-приложения (если версия данных изменилась)
+    export_snapshots()
+    publish_store()
+
+def run_forever():
+    '''
+    Функция основного цикла планировщика.
+    '''
+    init_db()
+
+    # при старте все источники опрашиваются сразу, дальше - каждый по своему расписанию
+    now = time.monotonic()
+    queue = [(now, name) for name in SOURCES]
+    heapq.heapify(queue)
+
+    while not _stop.is_set():
+        wait = queue[0][0] - time.monotonic()
+        if wait > 0 and _stop.wait(wait):
+            break
+
+        # все источники, чей срок подошёл, опрашиваются вместе (параллельно в get_discounts)
+        due = []
+        now = time.monotonic()
+        while queue and queue[0][0] <= now:
+            due.append(heapq.heappop(queue)[1])
+
+        try:
+            refresh(due)
+        except Exception as e:
+            # сбой одного обновления не должен останавливать планировщик
+            print(f'[Scheduler] [Error] Обновление завершилось ошибкой: {e}')
+        
+        # метрики обновления - для /metrics веб-приложения
+        metrics.set_gauge('last_refresh_timestamp_seconds', time.time(), 'Время окончания последнего обновления')
+        metrics.write_textfile()
+
+        now = time.monotonic()
+        for name in due:
+            heapq.heappush(queue, (now + next_delay(name), name))
+
+    print('[Scheduler] Остановлен.')
+
+def stop(*_):
+    _stop.set()
+
+if __name__ == '__main__':
+    metrics.start_profiler()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    run_forever()
@@ -1,288 +1,445 @@
-from bs4 import BeautifulSoup
-import re
+from bs4 import BeautifulSoup, SoupStrainer
 import cloudscraper
 from curl_cffi import requests as c_requests
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-def get_profit_color(discount_text):
+import metrics
+from classifier import classify_items
+from fetcher import PageNotModified, conditional_get, page_state
+
+# общая политика повторов для всех источников:
+# число попыток, первая пауза между попытками и множитель её роста (в секундах)
+RETRY_POLICY = {
+    'attempts': 3,
+    'backoff': 2,
+    'factor': 2,
+    'max_backoff': 10,
+}
+
+# таймаут одного HTTP-запроса (сек); меньше, если до дедлайна источника осталось меньше
+REQUEST_TIMEOUT = 30
+
+# города ЭкономСити, которые попадают на карту; None - все города
+# для нескольких городов диаграмму Вороного стоит строить в режиме projected (analytics.VORONOI_MODE)
+ECONOM_CITIES = ('Минск',)
+
+# парсер HTML: lxml (написан на C) заметно быстрее встроенного html.parser
+# если lxml не установлен - работаем на html.parser, результат тот же
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+def class_strainer(*class_names):
     '''
-    Функция задания логики определения цвета точки на карте
-    в зависимости от текста информации о цене/скидке
+    Функция создания фильтра SoupStrainer по CSS-классам: при разборе страницы в дерево попадают
+    только элементы с любым из классов class_names (вместе со всем их содержимым).
+    Во время разбора атрибут class приходит строкой ("PriceTable__col PriceTable__col--today"),
+    поэтому классы сравниваются по словам.
     '''
-    text_lower = discount_text.lower()
-    # логика раскраски для задания цен за килограмм
-    if 'руб/кг' in text_lower:
-        prices = re.findall(r"(\d+[\.,]?\d*)", text_lower)
-        if prices:
-            price = float(prices[0].replace(',', '.'))
-            if price < 30: return 'green'
-            if price < 60: return 'orange'
-            return 'red'
-    
-    # логика раскраски для задания цен за вещь
-    if 'руб/вещь' in text_lower:
-        prices = re.findall(r"(\d+[\.,]?\d*)", text_lower)
-        if prices:
-            price = float(prices[0].replace(',', '.'))
-            if price < 4: return 'green'
-            if price < 7: return 'orange'
-            return 'red'
-        
-    # логика раскраски для задания процентов скидки
-    if '%' in text_lower:
-        percents = re.findall(r"(\d+)", text_lower)
-        if percents:
-            val = int(percents[0])
-            if val > 50: return 'green'
-            if val > 20: return 'orange'
-            return 'red'
-    
-    return 'gray'
+    wanted = set(class_names)
+    
+    def match(value):
+        if not value:
+            return False
+        classes = value.split() if isinstance(value, str) else value
+        return not wanted.isdisjoint(classes)
+    
+    return SoupStrainer(attrs={'class': match})
 
-def get_discounts_modamax():
+# из страницы МодаМакс нужны только адреса и колонка сегодняшнего дня в строках таблицы цен
+MODAMAX_STRAINER = class_strainer('PriceTable__link', 'PriceTable__col--today')
+
+# из страницы ЭкономСити - легенда иконок, блок адресов и колонка сегодняшнего дня
+ECONOM_STRAINER = class_strainer('CalendarLegend__item', 'price__cities', 'price__col--today')
+
+# HTTP-сессии источников живут между запусками (важно для планировщика scheduler.py):
+# соединения, cookies и пройденные проверки Cloudflare переиспользуются
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(key, factory):
     '''
-    Функция получения действующих предложений от сети МодаМакс
+    Функция получения долгоживущей HTTP-сессии по ключу (создаётся factory() при первом обращении).
     '''
-    url = "https://modamax.by/price/minsk"
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = factory()
+        return _sessions[key]
+
+def drop_session(key):
+    '''
+    Функция сброса сессии после неудачной попытки - следующая попытка начнёт с чистой сессии.
+    '''
+    with _sessions_lock:
+        _sessions.pop(key, None)
+
+class ScrapeError(Exception):
+    '''
+    Ошибка одной попытки получения данных источника - попытка будет повторена
+    '''
+
+def run_with_retry(source_title, attempt_func, deadline, policy=RETRY_POLICY):
+    '''
+    Функция выполнения попыток получения данных источника по общей политике повторов.
+    attempt_func(attempt, timeout) возвращает кортеж (список предложений, состояния страниц fetcher.page_state)
+    или бросает исключение. Новые попытки не начинаются после дедлайна deadline (по часам time.monotonic).
+    '''
+    delay = policy['backoff']
     
-    print(f"  -> МодаМакс: Скачиваем через curl_cffi...")
+    for attempt in range(policy['attempts']):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print(f'  [Fail] {source_title}: Истекло время, отведённое на источник.')
+            return [], {}
+        
+        try:
+            return attempt_func(attempt, min(REQUEST_TIMEOUT, remaining))
+        except PageNotModified:
+            # страница не изменилась - это не ошибка, повторять нечего
+            raise
+        except Exception as e:
+            print(f'  [Error] {source_title}: Попытка {attempt + 1} не удалась: {e}')
+        
+        # пауза перед следующей попыткой растёт, но не выходит за дедлайн
+        if attempt + 1 < policy['attempts']:
+            time.sleep(max(0, min(delay, deadline - time.monotonic())))
+            delay = min(delay * policy['factor'], policy['max_backoff'])
+    
+    print(f'  [Fail] {source_title}: Не удалось получить данные после всех попыток.')
+    return [], {}
+
+def parse_modamax(html_text, parser=HTML_PARSER):
+    '''
+    Функция разбора страницы цен МодаМакс
+    '''
     results = []
     
-    # так как даже через curl_cffi соединение может отваливаться
-    # буду перебирать по очереди разные браузеры, если будут ошибки
-    browsers = ["chrome110", "safari15_5", "chrome100"]
+    # парсинг скаченного - в дерево попадают только ссылки с адресами и колонки сегодняшнего дня,
+    # остальные дни недели и вся прочая страница пропускаются
+    soup = BeautifulSoup(html_text, parser, parse_only=MODAMAX_STRAINER)
     
-    for browser in browsers:
+    # строки таблицы собираются за один проход по элементам в порядке документа:
+    # ссылка с адресом открывает строку, первая следующая за ней колонка "сегодня" относится к ней же
+    # (колонка "сегодня" из заголовка таблицы идёт раньше всех адресов и не попадает никуда)
+    rows = []
+    for element in soup.children:
+        if element.name == 'a':
+            rows.append([element, None])
+        elif element.name == 'div' and rows and rows[-1][1] is None:
+            rows[-1][1] = element
+    print(f"  [Debug] МодаМакс: Найдено строк PriceTable__row: {len(rows)}")
+    
+    # если строк нет - попытка считается неудачной и будет повторена
+    if len(rows) == 0:
+        raise ScrapeError('Таблица не найдена в HTML.')
+    
+    # разбор распарсенных строк
+    for addr_tag, today_col in rows:
         try:
-            print(f'  [Try] Пробуем зайти на МодаМакс как {browser}')
-            
-            # простой запрос с использованием curl_cffi
-            # impersonate=browser - скрипт имитирует работу одного из браузеров в списке browsers
-            response = c_requests.get(url, impersonate=browser, timeout=30)
-           
-            if response.status_code != 200:
-                print(f"  [Error] МодаМакс: Ошибка доступа: {response.status_code}")
-                time.sleep(2)
-                continue
-                
-            html_text = response.text
-            
-            # смотрю ответ - если скачалось слишком мало (10000 это не страница) - меняю браузер
-            if len(html_text) < 10000:
-                print(f"    [Warn] МодаМакс: Скачано мало - ({len(html_text)} байт). Повторяем...")
-                time.sleep(2)
-                continue
-            
-            # если скачено всё - успех
-            print(f"  [Success] МодаМакс: Скачано байт: {len(html_text)}")
+            # собираю адрес
+            address = addr_tag.text.strip()
             
-            # парсинг скаченного
-            soup = BeautifulSoup(html_text, 'html.parser')
+            # собираю цену/предложение
+            discount_text = "-"
             
-            # ищу строки скаченной таблицы
-            rows = soup.find_all('div', class_='PriceTable__row')
-            print(f"  [Debug] МодаМакс: Найдено строк PriceTable__row: {len(rows)}")
+            if today_col:
+                amount_div = today_col.find('div', class_='PriceTable__amount-numbers')
+                if amount_div:
+                    rub = amount_div.contents[0].strip()
+                    coins_span = amount_div.find('span', class_='PriceTable__amount-coins')
+                    coins = coins_span.text.strip() if coins_span else "00"
+                    discount_text = f"{rub}.{coins} руб/кг"
+                else:
+                    icon = today_col.find('img')
+                    if icon and icon.get('alt'):
+                        discount_text = icon.get('alt')
+                    else:
+                        discount_text = "Спецпредложение"
             
-            # если строк нет - пробую с другим браузером
-            if len(rows) == 0:
-                print("    [Warn] Таблица не найдена в HTML.")
+            # фильтр закрытых магазинов
+            if "не работает" in discount_text.lower() or discount_text == "-":
                 continue
             
-            # разбор распарсенных строк
-            for row in rows:
-                try:
-                    # собираю адрес
-                    addr_tag = row.find('a', class_='PriceTable__link')
-                    if not addr_tag: continue
-                    address = addr_tag.text.strip()
-                    
-                    # собираю цену/предложение
-                    today_col = row.find('div', class_='PriceTable__col--today')
-                    discount_text = "-"
-                    
-                    if today_col:
-                        amount_div = today_col.find('div', class_='PriceTable__amount-numbers')
-                        if amount_div:
-                            rub = amount_div.contents[0].strip()
-                            coins_span = amount_div.find('span', class_='PriceTable__amount-coins')
-                            coins = coins_span.text.strip() if coins_span else "00"
-                            discount_text = f"{rub}.{coins} руб/кг"
-                        else:
-                            icon = today_col.find('img')
-                            if icon and icon.get('alt'):
-                                discount_text = icon.get('alt')
-                            else:
-                                discount_text = "Спецпредложение"
-                    
-                    # фильтр закрытых магазинов
-                    if "не работает" in discount_text.lower() or discount_text == "-":
-                        continue
-                    
-                    # склейка результатов
-                    results.append({
-                        "shop_name": "МодаМакс",
-                        "address": address,
-                        "discount": discount_text,
-                        "color": get_profit_color(discount_text)
-                    })
-                    
-                except Exception:
-                    continue
+            # склейка результатов
+            results.append({
+                "shop_name": "МодаМакс",
+                "address": address,
+                "discount": discount_text
+            })
             
-            # если парсинг удался, выходим из цикла браузеров и возвращаем result
-            print(f"  [Result] МодаМакс: Успешно обработано: {len(results)}")
-            return results
+        except Exception:
+            continue
+    
+    return results
 
-        except Exception as e:
-            print(f"  [Error] МодаМакс: Сбой при обработке curl_cffi с браузером {browser}: {e}")
-            time.sleep(2)
+def get_discounts_modamax(deadline=None):
+    '''
+    Функция получения действующих предложений от сети МодаМакс
+    '''
+    url = "https://modamax.by/price/minsk"
+    
+    print(f"  -> МодаМакс: Скачиваем через curl_cffi...")
+    
+    # так как даже через curl_cffi соединение может отваливаться
+    # при каждой новой попытке меняю имитируемый браузер
+    browsers = ["chrome110", "safari15_5", "chrome100"]
+    
+    def attempt_func(attempt, timeout):
+        browser = browsers[attempt % len(browsers)]
+        print(f'  [Try] Пробуем зайти на МодаМакс как {browser}')
+        
+        # запрос через сессию curl_cffi, своя сессия для каждого браузера
+        # impersonate=browser - скрипт имитирует работу одного из браузеров в списке browsers
+        session_key = f'modamax:{browser}'
+        session = get_session(session_key, lambda: c_requests.Session(impersonate=browser))
+        
+        # условный запрос: если страница не менялась с прошлого запуска, дальше не идём
+        try:
+            with metrics.span('fetch', source='modamax'):
+                response, validators = conditional_get(session.get, url, timeout=timeout)
+        except PageNotModified:
+            raise
+        except Exception:
+            drop_session(session_key)
+            raise
+        
+        if response.status_code != 200:
+            raise ScrapeError(f'Ошибка доступа: {response.status_code}')
+        
+        html_text = response.text
+        
+        # смотрю ответ - если скачалось слишком мало (10000 это не страница) - меняю браузер
+        if len(html_text) < 10000:
+            raise ScrapeError(f'Скачано мало - ({len(html_text)} байт).')
+        
+        # если скачено всё - успех
+        print(f"  [Success] МодаМакс: Скачано байт: {len(html_text)}")
+        
+        with metrics.span('parse', source='modamax'):
+            results = parse_modamax(html_text)
+        print(f"  [Result] МодаМакс: Успешно обработано: {len(results)}")
+        return results, page_state(url, validators, results)
     
-    print('  [Fail] МодаМакс: Не удалось скачать данные после всех попыток.')
-    return [] 
+    if deadline is None:
+        deadline = time.monotonic() + SOURCES['modamax']['deadline']
+    return run_with_retry('МодаМакс', attempt_func, deadline)
 
+def parse_econom(html_text, parser=HTML_PARSER):
+    '''
+    Функция разбора страницы предложений ЭкономСити
+    '''
+    results = []
+    # в дерево попадают только легенда, блок адресов и колонка сегодняшнего дня
+    soup = BeautifulSoup(html_text, parser, parse_only=ECONOM_STRAINER)
+    
+    # создаю справочник иконок ЭкономСити
+    legend_map = {}
+    
+    legend_items = soup.find_all('div', class_='CalendarLegend__item')
+    
+    for item in legend_items:
+        img = item.find('img')
+        description_div = item.find('div', class_='CalendarLegend__item-title')
+        
+        if img and description_div:
+            src = img.get('src')
+            description = description_div.text.strip()
+            if src:
+                legend_map[src] = description
+    
+    print(f' [Debug] ЭкономСити: найдено {len(legend_map)} пиктограмм в легенде страницы.')
+      
+    # сбор списка адресов из price__cities
+    address_list = []
+    cities_container = soup.find('div', class_='price__cities')
+    
+    if not cities_container:
+        raise ScrapeError('Не найден блок адресов.')
+    
+    current_city = 'Минск' # значение по умолчанию
+    
+    # перебор всех элементов внутри блока адресов по очереди
+    for element in cities_container.children:
+        if element.name == 'div' and 'price__cities-title' in element.get('class', []):
+            # если попадается название города (заголовок), то запоминаем его
+            current_city = element.text.strip()
+        
+        elif element.name == 'a' and 'price__city' in element.get('class', []):
+            # если попадается адрес магазина, то берем его
+            street = element.text.strip()
+            # очистка адреса от лишних пробелов
+            street = ' '.join(street.split())
+            # формирую полный адрес
+            full_address = f'{current_city}, {street}'
+            address_list.append(full_address)
+    print(f'  [Debug] ЭкономСити: найдено {len(address_list)} адресов.')
+    # сбор списка скидок на сегодня
+    discount_list = []
+    
+    # сегодняшние предложения находятся в блоке price__col--today
+    today_col = soup.find('div', class_='price__col--today')
+    
+    if not today_col:
+        raise ScrapeError('Колонка сегодняшнего дня не найдена.')
+    
+    # собираю все ячейки в столбце сегодняшних предложений
+    cells = today_col.find_all('div', class_='price__cell')
+    for cell in cells:
+        # беру основной текст в ячейке
+        main_text = cell.get_text(strip=True, separator=' ') # достает текст из вложенных тэгов и чистит его
+        
+        # ищу иконки в ячейке
+        images_in_cell = cell.find_all('img')
+        additional_text = []
+        for img in images_in_cell:
+            src = img.get('src')
+            # если ссылка есть в справочнике иконок
+            if src in legend_map:
+                additional_text.append(legend_map[src])
+        
+        # склейка текста
+        if additional_text:
+            full_text = f"{main_text} {' '.join(additional_text)}"
+        else:
+            full_text = main_text
+        
+        # очистка от лишних пробелов
+        full_text = ' '.join(full_text.split())
+        
+        # на случай если так ничего не найдено в ячейке
+        if not full_text:
+            full_text = 'Предложений в магазине нет.'
+        
+        discount_list.append(full_text)
+    print(f'  [Debug] ЭкономСити: найдено {len(discount_list)} строк с информацией о предложениях.')
+    
+    # объединение двух списков - адресов и скидок на сегодня
+    # тут нужно предполагать, что оба списка - одинаковой длины
+    # во избежание ошибки - принимаю за длину обоих списков длину кратчайшего
+    limit = min(len(address_list), len(discount_list))
+    
+    for i in range(limit):
+        address = address_list[i]
+        discount_text = discount_list[i]
+        
+        # фильтр "не работает" в указании информации о предложениях
+        if "не работает" in discount_text.lower():
+            continue
+        
+        # фильтр города в адресе - по умолчанию оставляю только Минск (см. ECONOM_CITIES)
+        city_part = address.split(',')[0].strip()
+        if ECONOM_CITIES is not None and not any(city in city_part for city in ECONOM_CITIES):
+            continue
+        
+        results.append(
+            {
+                'shop_name': 'ЭкономСити',
+                'address': address,
+                'discount': discount_text
+            }
+        )
+    return results
 
-def get_discounts_econom():
+def get_discounts_econom(deadline=None):
     '''
     Функция получения действующих предложений от сети ЭкономСити
     '''
     url = 'https://secondhand.by/promos'
     
     print(f"  -> ЭкономСити: Скачиваем через cloudscraper...")
-    results = []
     
-    try:
-        scraper = cloudscraper.create_scraper()
-        response = scraper.get(url)
+    def attempt_func(attempt, timeout):
+        # сессия cloudscraper переиспользуется: пройденная проверка Cloudflare сохраняется в cookies
+        scraper = get_session('econom', cloudscraper.create_scraper)
         
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # создаю справочник иконок ЭкономСити
-            legend_map = {}
-            
-            legend_items = soup.find_all('div', class_='CalendarLegend__item')
-            
-            for item in legend_items:
-                img = item.find('img')
-                description_div = item.find('div', class_='CalendarLegend__item-title')
-                
-                if img and description_div:
-                    src = img.get('src')
-                    description = description_div.text.strip()
-                    if src:
-                        legend_map[src] = description
-            
-            print(f' [Debug] ЭкономСити: найдено {len(legend_map)} пиктограмм в легенде страницы.')
-              
-            # сбор списка адресов из price__cities
-            address_list = []
-            cities_container = soup.find('div', class_='price__cities')
-            
-            if not cities_container:
-                print(f'  [Debug] ЭкономСити: Не найден блок адресов.')
-                return []
-            
-            current_city = 'Минск' # значение по умолчанию
-            
-            # перебор всех элементов внутри блока адресов по очереди
-            for element in cities_container.children:
-                if element.name == 'div' and 'price__cities-title' in element.get('class', []):
-                    # если попадается название города (заголовок), то запоминаем его
-                    current_city = element.text.strip()
-                
-                elif element.name == 'a' and 'price__city' in element.get('class', []):
-                    # если попадается адрес магазина, то берем его
-                    street = element.text.strip()
-                    # очистка адреса от лишних пробелов
-                    street = ' '.join(street.split())
-                    # формирую полный адрес
-                    full_address = f'{current_city}, {street}'
-                    address_list.append(full_address)
-            print(f'  [Debug] ЭкономСити: найдено {len(address_list)} адресов.')
-            # сбор списка скидок на сегодня
-            discount_list = []
-            
-            # сегодняшние предложения находятся в блоке price__col--today
-            today_col = soup.find('div', class_='price__col--today')
-            
-            if today_col:
-                # собираю все ячейки в столбце сегодняшних предложений
-                cells = today_col.find_all('div', class_='price__cell')
-                for cell in cells:
-                    # беру основной текст в ячейке
-                    main_text = cell.get_text(strip=True, separator=' ') # достает текст из вложенных тэгов и чистит его
-                    
-                    # ищу иконки в ячейке
-                    images_in_cell = cell.find_all('img')
-                    additional_text = []
-                    for img in images_in_cell:
-                        src = img.get('src')
-                        # если ссылка есть в справочнике иконок
-                        if src in legend_map:
-                            additional_text.append(legend_map[src])
-                    
-                    # склейка текста
-                    if additional_text:
-                        full_text = f"{main_text} {' '.join(additional_text)}"
-                    else:
-                        full_text = main_text
-                    
-                    # очистка от лишних пробелов
-                    full_text = ' '.join(full_text.split())
-                    
-                    # на случай если так ничего не найдено в ячейке
-                    if not full_text:
-                        full_text = 'Предложений в магазине нет.'
-                    
-                    discount_list.append(full_text)
-                print(f'  [Debug] ЭкономСити: найдено {len(discount_list)} строк с информацией о предложениях.')
-            else:
-                print('Колонка сегодняшнего дня ЭкономСити не найдена.')
-                return []
-            
-            # объединение двух списков - адресов и скидок на сегодня
-            # тут нужно предполагать, что оба списка - одинаковой длины
-            # во избежание ошибки - принимаю за длину обоих списков длину кратчайшего
-            limit = min(len(address_list), len(discount_list))
-            
-            for i in range(limit):
-                address = address_list[i]
-                discount_text = discount_list[i]
-                
-                # фильтр "не работает" в указании информации о предложениях
-                if "не работает" in discount_text.lower():
-                    continue
-                
-                # фильтр города в адресе - оставлю только Минск
-                city_part = address.split(',')[0].strip()
-                if "Минск" not in city_part:
-                    continue
-                
-                results.append(
-                    {
-                        'shop_name': 'ЭкономСити',
-                        'address': address,
-                        'discount': discount_text,
-                        'color': get_profit_color(discount_text)
-                    }
-                )
-            print(f"  [Result] ЭкономСити: Успешно обработано: {len(results)}")
-            return results
-             
-        else:
-            print('Ошибка загрузки страницы ЭкономСити')
-            return []
-    except Exception as e:
-        print(f'Глобальная ошибка при обработке ЭкономСити: {e}')
-        return []        
+        # условный запрос: если страница не менялась с прошлого запуска, дальше не идём
+        with metrics.span('fetch', source='econom'):
+            response, validators = conditional_get(scraper.get, url, timeout=timeout)
+        
+        if response.status_code != 200:
+            drop_session('econom')
+            raise ScrapeError(f'Ошибка загрузки страницы: {response.status_code}')
+        
+        with metrics.span('parse', source='econom'):
+            results = parse_econom(response.text)
+        print(f"  [Result] ЭкономСити: Успешно обработано: {len(results)}")
+        return results, page_state(url, validators, results)
     
-def get_discounts():
+    if deadline is None:
+        deadline = time.monotonic() + SOURCES['econom']['deadline']
+    return run_with_retry('ЭкономСити', attempt_func, deadline)
+
+# реестр источников: функция получения данных, дедлайн источника и интервал опроса
+# в планировщике scheduler.py (сек)
+# новый источник - это новая запись здесь, get_discounts и планировщик подхватят её автоматически
+SOURCES = {
+    'modamax': {
+        'title': 'МодаМакс',
+        'func': get_discounts_modamax,
+        'deadline': 90,
+        'interval': 15 * 60,
+    },
+    'econom': {
+        'title': 'ЭкономСити',
+        'func': get_discounts_econom,
+        'deadline': 90,
+        'interval': 15 * 60,
+    },
+}
+
+def get_discounts(sources=None):
+    '''
+    Функция параллельного опроса источников из реестра SOURCES.
+    Каждый источник ограничен своим дедлайном; если источник упал или не уложился -
+    возвращаются данные остальных (частичный результат).
+    Источники, у которых ничего не изменилось с прошлого запуска, в результат не попадают.
+    Возвращает кортеж (предложения, состояния страниц): состояния - только источников, уложившихся
+    в дедлайн (опоздавший источник продолжает работать в фоне, но его результат отброшен);
+    после сохранения предложений их нужно передать в fetcher.commit_fetch_state().
+    '''
+    names = list(sources or SOURCES)
     all_shops = []
+    pages = {}
+    
+    started = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=len(names), thread_name_prefix='scraper')
+    
+    futures = {}
+    for name in names:
+        source = SOURCES[name]
+        print(f"Парсим магазин {source['title']}...")
+        deadline = started + source['deadline']
+        futures[name] = (executor.submit(source['func'], deadline), deadline)
+    
+    for name, (future, deadline) in futures.items():
+        title = SOURCES[name]['title']
+        try:
+            shops, source_pages = future.result(timeout=max(0, deadline - time.monotonic()))
+            all_shops.extend(shops)
+            pages.update(source_pages)
+            outcome = 'ok' if shops else 'empty'
+        except PageNotModified as e:
+            # магазины сети в базе остаются как есть (save_to_db удаляет только пришедшие сети)
+            print(f'  [Skip] {title}: Без изменений - {e}.')
+            pages.update(e.pages)
+            outcome = 'not_modified'
+        except FutureTimeoutError:
+            print(f'  [Fail] {title}: Источник не уложился в {SOURCES[name]["deadline"]} с, пропускаем.')
+            outcome = 'timeout'
+        except Exception as e:
+            print(f'  [Error] {title}: Сбой источника: {e}')
+            outcome = 'error'
+        metrics.inc('source_polls_total', help_text='Опросы источников по результату', source=name, outcome=outcome)
     
-    print("Парсим магазин 1 (МодаМакс)...")
-    all_shops.extend(get_discounts_modamax())
+    # не жду зависшие источники - их результат уже не нужен
+    executor.shutdown(wait=False, cancel_futures=True)
     
-    print("Парсим магазин 2 (ЭкономСити)...")
-    all_shops.extend(get_discounts_econom())
+    print(f'Опрос источников занял {time.monotonic() - started:.1f} с.')
     
-    return all_shops
\ No newline at end of file
+    # цвет, цена и единица - одним проходом классификатора по всему результату
+    with metrics.span('classify'):
+        return classify_items(all_shops), pages
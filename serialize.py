@@ -0,0 +1,20 @@
+'''
+Быстрая сериализация JSON для ответов API.
+Если установлен orjson (написан на Rust), используется он, иначе - стандартный json.
+Обе функции возвращают байты в UTF-8, готовые к отправке клиенту.
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps(obj):
+    '''
+    Функция сериализации объекта в байты JSON (UTF-8, без пробелов).
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
@@ -0,0 +1,162 @@
+'''
+Индекс магазинов в памяти для пространственных запросов "что рядом со мной".
+Координаты переводятся в точки на сфере (метры), поверх них строится scipy.spatial.cKDTree.
+Индекс перестраивается только при смене версии данных (см. db.get_data_version).
+Если опубликован общий снимок (store.py), индекс строится по его колонкам - без запросов к базе.
+'''
+
+import threading
+import numpy as np
+from scipy.spatial import cKDTree
+
+import db
+from classifier import profit_scores
+from store import ShopRows, get_store
+
+EARTH_RADIUS = 6371008.8
+
+# ограничения параметров запросов
+MAX_NEAREST = 50
+MAX_RADIUS = 50000
+
+_index = None
+_index_lock = threading.Lock()
+
+def to_xyz(lat, lon):
+    '''
+    Функция перевода широты/долготы (градусы) в декартовы координаты на сфере радиуса Земли.
+    Евклидово расстояние между такими точками - хорда; для городских масштабов она
+    практически совпадает с расстоянием по поверхности.
+    '''
+    lat, lon = np.radians(lat), np.radians(lon)
+    return EARTH_RADIUS * np.column_stack([
+        np.cos(lat) * np.cos(lon),
+        np.cos(lat) * np.sin(lon),
+        np.sin(lat),
+    ])
+
+def chord_to_distance(chord):
+    '''
+    Функция перевода длины хорды в расстояние по поверхности Земли (м).
+    '''
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / (2 * EARTH_RADIUS), 1))
+
+def distance_to_chord(distance):
+    '''
+    Функция перевода расстояния по поверхности Земли (м) в длину хорды - радиус запроса к дереву.
+    '''
+    return 2 * EARTH_RADIUS * np.sin(np.minimum(distance, np.pi * EARTH_RADIUS) / (2 * EARTH_RADIUS))
+
+def build_shop_index(version):
+    '''
+    Функция построения индекса: дерево cKDTree, атрибуты магазинов и оценка выгодности.
+    '''
+    conn = db.get_connection(readonly=True)
+    rows = conn.execute('SELECT id, shop_name, address, discount, color, price, unit, lat, lon FROM shops').fetchall()
+
+    lat = np.array([row['lat'] for row in rows], dtype=float)
+    lon = np.array([row['lon'] for row in rows], dtype=float)
+
+    # числовая цена и единица уже разобраны при записи (колонки price, unit)
+    score = profit_scores(
+        [row['unit'] for row in rows],
+        [np.nan if row['price'] is None else row['price'] for row in rows],
+    )
+
+    return {
+        'version': version,
+        'tree': cKDTree(to_xyz(lat, lon)) if rows else None,
+        'rows': rows,
+        'score': score,
+        'lat': lat,
+        'lon': lon,
+        'store': None,
+    }
+
+def build_store_index(store):
+    '''
+    Функция построения индекса по общему снимку: колонки отображены в память, строки читаются по обращению.
+    '''
+    arrays = store['arrays']
+    return {
+        'version': store['version'],
+        'tree': cKDTree(to_xyz(arrays['shops.lat'], arrays['shops.lon'])) if len(arrays['shops.id']) else None,
+        'rows': ShopRows(store),
+        'score': arrays['shops.score'],
+        'lat': arrays['shops.lat'],
+        'lon': arrays['shops.lon'],
+        'store': store,
+    }
+
+def get_shop_index():
+    '''
+    Функция получения актуального индекса магазинов (с перестройкой при смене версии данных).
+    '''
+    global _index
+    store = get_store()
+    version = store['version'] if store is not None else db.get_data_version()
+
+    # индекс по снимку заменяет индекс той же версии, построенный по SQLite, пока снимок не был опубликован
+    index = _index
+    if index is not None and index['version'] == version and index['store'] is store:
+        return index
+
+    with _index_lock:
+        if _index is None or _index['version'] != version or _index['store'] is not store:
+            _index = build_store_index(store) if store is not None else build_shop_index(version)
+        return _index
+
+def _to_features(index, positions, distances):
+    features = []
+    for i, distance in zip(positions, distances):
+        row = index['rows'][i]
+        features.append({
+            'type': 'Feature',
+            'properties': {
+                'id': row['id'],
+                'shop_name': row['shop_name'],
+                'address': row['address'],
+                'discount': row['discount'],
+                'color': row['color'],
+                'price': row['price'],
+                'unit': row['unit'],
+                'distance_m': round(float(distance)),
+            },
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [row['lon'], row['lat']]
+            }
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+def find_nearest(lat, lon, k=5):
+    '''
+    Функция поиска k ближайших магазинов к точке. Возвращает FeatureCollection,
+    у каждого магазина есть расстояние distance_m.
+    '''
+    index = get_shop_index()
+    if index['tree'] is None:
+        return _to_features(index, [], [])
+
+    k = min(k, len(index['rows']))
+    chords, positions = index['tree'].query(to_xyz(lat, lon)[0], k=k)
+    chords, positions = np.atleast_1d(chords), np.atleast_1d(positions)
+    return _to_features(index, positions, chord_to_distance(chords))
+
+def find_best(lat, lon, radius=2000, limit=10):
+    '''
+    Функция поиска самых выгодных магазинов в радиусе radius (м) от точки.
+    Магазины упорядочены по оценке выгодности (classifier.profit_score), затем по расстоянию;
+    магазины без разобранной цены не участвуют.
+    '''
+    index = get_shop_index()
+    if index['tree'] is None:
+        return _to_features(index, [], [])
+
+    point = to_xyz(lat, lon)[0]
+    positions = np.array(index['tree'].query_ball_point(point, distance_to_chord(radius)), dtype=np.int64)
+    positions = positions[~np.isnan(index['score'][positions])]
+
+    chords = np.linalg.norm(index['tree'].data[positions] - point, axis=1)
+    order = np.lexsort((chords, index['score'][positions]))[:limit]
+    return _to_features(index, positions[order], chord_to_distance(chords[order]))
@@ -0,0 +1,270 @@
+'''
+Общий снимок данных карты в файлах, отображаемых в память (mmap), - для нескольких процессов веб-приложения.
+
+Процесс обновления после записи в базу публикует неизменяемый снимок версии данных
+(export.publish_store), процессы веб-приложения читают его без SQLite:
+- каталог STORE_DIR/v<версия>: колонки магазинов - массивы numpy (.npy: id, координаты, цена, оценка),
+  строки и готовые Feature GeoJSON - "таблицы": файл данных .dat и массив границ записей .offsets.npy
+- файл .dat таблицы Feature - это сразу весь FeatureCollection (записи идут подряд через запятую),
+  он отдаётся целиком как файл, а ответ по рамке склеивается из срезов записей
+- диаграмма Вороного - по уровням упрощения: Feature, рамки ячеек и координаты "рваными массивами"
+  (shapely.to_ragged_array) для ответа geobin по рамке; кластеры магазинов - массивы уровней подряд
+- файл CURRENT содержит имя актуального каталога и заменяется атомарно (os.replace) после того,
+  как каталог записан целиком; процесс веб-приложения при каждом запросе сверяет CURRENT (os.stat)
+  и при смене версии открывает новый каталог
+- массивы открываются np.load(mmap_mode='r'): страницы файлов общие для всех процессов через кэш ОС,
+  память не растёт с числом процессов; копируются только выбранные для ответа записи
+
+Если снимка нет (разработка, первый запуск) или он не совпадает с базой (другой файл SHOPS_DB,
+версия данных в базе ушла вперёд, а публикация снимка не удалась), веб-приложение работает через SQLite.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import shapely
+
+import db
+import geobin
+
+STORE_DIR = os.environ.get('SHOPS_STORE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'store'))
+CURRENT_NAME = 'CURRENT'
+
+FEATURES_PREFIX = b'{"type":"FeatureCollection","features":['
+FEATURES_SUFFIX = b']}'
+
+# колонки магазинов: числовые - массивы .npy, остальные - таблицы значений JSON
+SHOP_NUMERIC = ('id', 'price', 'score', 'lon', 'lat')
+SHOP_COLUMNS = ('id', 'shop_name', 'address', 'discount', 'color', 'price', 'unit', 'lon', 'lat')
+
+# свойства Feature магазина и ячейки Вороного (как в geodata.shop_feature и analytics.CELL_PROPERTIES)
+SHOP_PROPERTIES = ('id', 'shop_name', 'address', 'discount', 'color')
+CELL_PROPERTIES = ('shop_name', 'address', 'color')
+
+_store = None
+_store_lock = threading.Lock()
+
+def level_key(level):
+    '''
+    Функция имени уровня упрощения диаграммы Вороного в снимке (None - полная геометрия).
+    '''
+    return 'full' if level is None else str(level)
+
+def load_meta(path):
+    '''
+    Функция чтения описания снимка (meta.json) из его каталога.
+    '''
+    with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+def matches_db(meta):
+    '''
+    Функция проверки, что снимок построен по текущей базе (db.DB_PATH) и её текущей версии данных.
+    Если база недоступна, снимок считается актуальным - отвечать через SQLite всё равно нельзя.
+    Обращается к базе - в веб-приложении вызывается только при смене CURRENT, не на каждый запрос.
+    '''
+    if meta.get('db_path') != os.path.abspath(db.DB_PATH):
+        return False
+    try:
+        return meta['version'] == db.get_data_version()
+    except sqlite3.Error:
+        return True
+
+def open_store(path):
+    '''
+    Функция открытия каталога снимка: все массивы отображаются в память, ничего не читается заранее.
+    '''
+    meta = load_meta(path)
+
+    arrays = {}
+    for filename in os.listdir(path):
+        full_path = os.path.join(path, filename)
+        if filename.endswith('.npy'):
+            arrays[filename[:-4]] = np.load(full_path, mmap_mode='r')
+        elif filename.endswith('.dat'):
+            # пустой файл отобразить нельзя
+            size = os.path.getsize(full_path)
+            arrays[filename[:-4] + '.data'] = np.memmap(full_path, dtype=np.uint8, mode='r') if size else np.zeros(0, np.uint8)
+
+    # уровни кластеров лежат подряд - срезы общего массива (без копирования)
+    bounds = arrays['clusters.levels']
+    clusters = {
+        zoom: {name: arrays[f'clusters.{name}'][bounds[zoom]:bounds[zoom + 1]]
+               for name in ('lon', 'lat', 'count', 'best', 'expansion')}
+        for zoom in range(len(bounds) - 1)
+    }
+
+    return {'path': path, 'version': meta['version'], 'meta': meta, 'arrays': arrays, 'clusters': clusters}
+
+def get_store():
+    '''
+    Функция получения актуального снимка. Если снимок ещё не опубликован или построен не по текущей
+    базе и её версии данных (matches_db) - None, ответы строятся через SQLite.
+    Смена версии видна по файлу CURRENT: os.replace даёт ему новый inode. Соответствие базе проверяется
+    один раз при открытии снимка; дальше он отдаётся без обращений к SQLite, пока не сменится CURRENT -
+    в том числе пока процесс обновления, уже увеличивший версию данных, не опубликовал новый снимок.
+    '''
+    global _store
+    current_path = os.path.join(STORE_DIR, CURRENT_NAME)
+    try:
+        stat = os.stat(current_path)
+    except FileNotFoundError:
+        return None
+    stamp = (stat.st_ino, stat.st_mtime_ns)
+
+    store = _store
+    if store is None or store['stamp'] != stamp:
+        with _store_lock:
+            if _store is None or _store['stamp'] != stamp:
+                try:
+                    with open(current_path, encoding='utf-8') as f:
+                        name = f.read().strip()
+                    store = open_store(os.path.join(STORE_DIR, name))
+                except (OSError, ValueError, KeyError) as e:
+                    print(f' [Warn] Снимок данных не открылся ({e}), работаю через базу.')
+                    store = _store
+                else:
+                    store['stamp'] = stamp
+                    store['matches_db'] = matches_db(store['meta'])
+                    if not store['matches_db']:
+                        print(f' [Warn] Снимок {name} построен не по текущей базе, работаю через базу.')
+                    _store = store
+            else:
+                store = _store
+
+    if store is None or not store['matches_db']:
+        return None
+    return store
+
+def _ranges(starts, ends):
+    # позиции всех элементов отрезков [starts[i], ends[i]) подряд - без цикла
+    counts = ends - starts
+    return np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) + np.arange(counts.sum())
+
+def gather(store, name, index):
+    '''
+    Функция склейки записей index таблицы name в один кусок байтов.
+    '''
+    arrays = store['arrays']
+    offsets = arrays[f'{name}.offsets']
+    return arrays[f'{name}.data'][_ranges(offsets[index], offsets[index + 1])].tobytes()
+
+def values(store, name, index):
+    '''
+    Функция чтения значений колонки магазинов (или свойств ячеек) для записей index.
+    '''
+    arrays = store['arrays']
+    if name in arrays:
+        column = arrays[name][index]
+        if column.dtype.kind == 'f':
+            return [None if value != value else value for value in column.tolist()]
+        return column.tolist()
+
+    offsets = arrays[f'{name}.offsets']
+    data = arrays[f'{name}.data']
+    return [json.loads(data[offsets[i]:offsets[i + 1]].tobytes()) for i in np.asarray(index).tolist()]
+
+class ShopRows:
+    '''
+    Строки магазинов снимка для shop_index и clusters: rows[i]['shop_name'] и т. п.,
+    значения читаются из отображённых файлов по мере обращения.
+    '''
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store['arrays']['shops.id'])
+
+    def __getitem__(self, i):
+        return {name: values(self.store, f'shops.{name}', [i])[0] for name in SHOP_COLUMNS}
+
+    def column(self, name, index):
+        # значения одной колонки для многих строк - быстрее, чем по строке
+        return values(self.store, f'shops.{name}', index)
+
+def features_body(store, name, index):
+    '''
+    Функция сборки FeatureCollection из записей index таблицы Feature name (index - по возрастанию).
+    '''
+    if not len(index):
+        return FEATURES_PREFIX + FEATURES_SUFFIX
+    # у каждой записи в таблице - свой разделитель после неё (',' или у последней ']'): он отрезается
+    return FEATURES_PREFIX + gather(store, name, index)[:-1] + FEATURES_SUFFIX
+
+def shops_in_bbox(store, bbox):
+    '''
+    Функция номеров магазинов в рамке bbox=(min_lon, min_lat, max_lon, max_lat).
+    '''
+    arrays = store['arrays']
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lon, lat = arrays['shops.lon'], arrays['shops.lat']
+    return np.flatnonzero((lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat))
+
+def _subset_etag(etag, bbox):
+    return hashlib.sha1(f'{etag}:{bbox}'.encode()).hexdigest()[:16]
+
+def shops_body(store, bbox=None, binary=False):
+    '''
+    Функция ответа "магазины" из снимка. Возвращает (etag, body, path):
+    весь набор - путь к готовому файлу (body None), по рамке - собранные байты (path None).
+    '''
+    meta = store['meta']['shops']
+    etag = meta['binary_etag'] if binary else meta['etag']
+    if bbox is None:
+        filename = 'shops.bin' if binary else 'shops.features.dat'
+        return etag, None, os.path.join(store['path'], filename)
+
+    index = shops_in_bbox(store, bbox)
+    if binary:
+        arrays = store['arrays']
+        body = geobin.encode(
+            shapely.points(np.column_stack([arrays['shops.lon'][index], arrays['shops.lat'][index]])) if len(index) else [],
+            {name: values(store, f'shops.{name}', index) for name in SHOP_PROPERTIES},
+        )
+    else:
+        body = features_body(store, 'shops.features', index)
+    return _subset_etag(etag, bbox), body, None
+
+def _ragged_subset(coords, offsets, index):
+    # выбор геометрий index из "рваных массивов": от внешнего уровня смещений к внутреннему
+    subset_offsets = []
+    for level in reversed(offsets):
+        starts, ends = level[index], level[index + 1]
+        subset_offsets.append(np.concatenate([[0], np.cumsum(ends - starts)]))
+        index = _ranges(starts, ends)
+    return coords[index], subset_offsets[::-1]
+
+def voronoi_body(store, level, bbox=None, binary=False):
+    '''
+    Функция ответа "диаграмма Вороного" уровня упрощения level из снимка (см. shops_body).
+    Ячейки по рамке выбираются по их ограничивающим прямоугольникам.
+    '''
+    key = level_key(level)
+    meta = store['meta']['voronoi'][key]
+    name = f'voronoi.{key}'
+    etag = meta['binary_etag'] if binary else meta['etag']
+    if bbox is None:
+        filename = f'{name}.bin' if binary else f'{name}.features.dat'
+        return etag, None, os.path.join(store['path'], filename)
+
+    arrays = store['arrays']
+    min_lon, min_lat, max_lon, max_lat = bbox
+    bounds = arrays[f'{name}.bounds']
+    index = np.flatnonzero(
+        (bounds[:, 0] <= max_lon) & (bounds[:, 2] >= min_lon) & (bounds[:, 1] <= max_lat) & (bounds[:, 3] >= min_lat)
+    )
+
+    if not binary:
+        return _subset_etag(etag, bbox), features_body(store, f'{name}.features', index), None
+
+    geometries = []
+    if len(index):
+        offsets = [arrays[f'{name}.offsets{i}'] for i in range(meta['offsets'])]
+        coords, offsets = _ragged_subset(arrays[f'{name}.coords'], offsets, index)
+        geometries = shapely.from_ragged_array(shapely.GeometryType[meta['type']], coords, offsets)
+    properties = {prop: values(store, f'{name}.{prop}', index) for prop in CELL_PROPERTIES}
+    return _subset_etag(etag, bbox), geobin.encode(geometries, properties, meta['binary_precision']), None
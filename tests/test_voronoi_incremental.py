@@ -0,0 +1,103 @@
+'''
+Проверка частичного пересчёта диаграммы Вороного (analytics.update_planar_cells / update_projected_cells):
+после вставок, удалений и перемещений магазинов ячейки должны совпадать с построением заново,
+в том числе после нескольких пересчётов подряд (каждый - от результата предыдущего).
+
+Запуск из корня проекта: python -m pytest tests
+'''
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import shapely
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics
+
+# центр и разброс точек (градусы) - как у синтетической базы benchmarks/generate_db.py
+CENTER = (27.5619, 53.9023)
+SPREAD = (0.08, 0.05)
+
+CITIES = ('Минск', 'Брест', 'Гродно')
+CITY_OFFSETS = ((0, 0), (-3.8, -1.8), (-3.7, -0.2))
+
+ROUNDS = 4
+
+def random_points(rng, n, offset=(0, 0)):
+    return np.column_stack([
+        rng.normal(CENTER[0] + offset[0], SPREAD[0], n),
+        rng.normal(CENTER[1] + offset[1], SPREAD[1], n),
+    ])
+
+def change_points(rng, points, frame=None):
+    '''
+    Удаляет, перемещает и добавляет по несколько точек; новые точки - внутри рамки frame (если задана).
+    Возвращает новые точки в порядке np.unique, как в analytics.compute_cells.
+    '''
+    keep = np.ones(len(points), dtype=bool)
+    keep[rng.choice(len(points), 6, replace=False)] = False
+    moved = points[rng.choice(np.flatnonzero(keep), 4, replace=False)] + rng.normal(0, 0.002, (4, 2))
+    added = random_points(rng, 5, points.mean(axis=0) - CENTER)
+    new_points = np.vstack([points[keep], moved, added])
+    if frame is not None:
+        new_points = np.clip(new_points, frame[:2], frame[2:])
+    return np.unique(new_points, axis=0)
+
+def assert_same_cells(cells, expected):
+    assert len(cells) == len(expected)
+    # порядок вершин и начало кольца у двух построений могут различаться
+    same = shapely.equals_exact(shapely.normalize(cells), shapely.normalize(expected), tolerance=1e-9)
+    assert same.all(), f'ячейки отличаются: {np.flatnonzero(~same)[:10]}'
+
+def test_planar_update_matches_rebuild():
+    rng = np.random.default_rng(1)
+    points = np.unique(random_points(rng, 1500), axis=0)
+    min_lon, min_lat = points.min(axis=0) - analytics.BBOX_MARGIN
+    max_lon, max_lat = points.max(axis=0) + analytics.BBOX_MARGIN
+    clip = shapely.box(min_lon, min_lat, max_lon, max_lat)
+
+    cells, topology = analytics.build_voronoi_cells(points, clip, topology=True)
+    previous = {'points': points, 'cells': cells, 'topology': topology, 'clip': clip}
+
+    for _ in range(ROUNDS):
+        # новые точки - внутри рамки вспомогательных точек, иначе пересчёт сразу отказывается (None)
+        new_points = change_points(rng, previous['points'], topology['frame'])
+        old_index = analytics.match_points(previous['points'], new_points)
+
+        update = analytics.update_planar_cells(previous, new_points, clip, old_index)
+        assert update is not None
+        cells, topology, changed = update
+        assert 0 < np.count_nonzero(changed) < len(new_points)
+
+        assert_same_cells(cells, analytics.build_voronoi_cells(new_points, clip))
+        previous = {'points': new_points, 'cells': cells, 'topology': topology, 'clip': clip}
+
+@pytest.mark.parametrize('changed_cities', (1, 2))
+def test_projected_update_matches_rebuild(changed_cities):
+    rng = np.random.default_rng(2)
+    parts = [np.unique(random_points(rng, 150, offset), axis=0) for offset in CITY_OFFSETS]
+
+    def state(parts):
+        points = np.vstack(parts)
+        cities = np.repeat(CITIES, [len(part) for part in parts])
+        order = np.lexsort(points.T[::-1])
+        return points[order], cities[order]
+
+    points, cities = state(parts)
+    previous = {'points': points, 'cities': cities, 'cells': analytics.build_projected_cells(points, cities)}
+
+    for _ in range(ROUNDS):
+        parts = [change_points(rng, part) if i < changed_cities else part for i, part in enumerate(parts)]
+        points, cities = state(parts)
+        old_index = analytics.match_points(previous['points'], points)
+
+        cells, changed = analytics.update_projected_cells(previous, points, cities, old_index)
+        # города без изменений не пересчитываются
+        assert not changed[np.isin(cities, CITIES[changed_cities:])].any()
+        assert changed[np.isin(cities, CITIES[:changed_cities])].all()
+
+        assert_same_cells(cells, analytics.build_projected_cells(points, cities))
+        previous = {'points': points, 'cities': cities, 'cells': cells}
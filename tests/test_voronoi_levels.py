@@ -0,0 +1,38 @@
+'''
+Проверка уровней упрощения диаграммы Вороного на синтетической базе (benchmarks/generate_db.py):
+ячейки всех уровней должны быть валидными - иначе обрезка по рамке и тайлу падает с TopologyException.
+
+Запуск из корня проекта: python -m pytest tests
+'''
+
+import os
+import sys
+
+import pytest
+import shapely
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import analytics
+import db
+from generate_db import fill_db
+
+@pytest.fixture(scope='module')
+def synthetic_db(tmp_path_factory):
+    previous_path = db.DB_PATH
+    fill_db(str(tmp_path_factory.mktemp('db') / 'shops.db'), 3000)
+    analytics._voronoi_cache.clear()
+    yield
+    db.close_connections()
+    db.set_db_path(previous_path)
+    analytics._voronoi_cache.clear()
+
+@pytest.mark.parametrize('mode', analytics.VORONOI_MODES)
+@pytest.mark.parametrize('zoom', (*analytics.SIMPLIFY_ZOOMS, None))
+def test_levels_are_valid(synthetic_db, mode, zoom):
+    level = analytics.get_voronoi_level(mode, zoom)
+    cells = level['tree'].geometries
+    assert len(cells)
+    assert shapely.is_valid(cells).all()
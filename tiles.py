@@ -0,0 +1,37 @@
+'''
+Геометрия тайлов карты (схема z/x/y, как у OpenStreetMap и Leaflet) и разбор параметра bbox.
+Координаты везде в порядке lon/lat, как в GeoJSON и в L.LatLngBounds.toBBoxString().
+'''
+
+import math
+
+def tile_bbox(z, x, y):
+    '''
+    Функция перевода номера тайла в рамку (min_lon, min_lat, max_lon, max_lat).
+    '''
+    n = 2 ** z
+    if not (0 <= x < n and 0 <= y < n):
+        raise ValueError(f'Тайл {z}/{x}/{y} вне сетки уровня {z}')
+
+    def tile_lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return (x / n * 360 - 180, tile_lat(y + 1), (x + 1) / n * 360 - 180, tile_lat(y))
+
+def parse_bbox(text):
+    '''
+    Функция разбора строки 'min_lon,min_lat,max_lon,max_lat'.
+    Бросает ValueError, если строка некорректна.
+    '''
+    parts = [float(part) for part in text.split(',')]
+    if len(parts) != 4:
+        raise ValueError('bbox должен состоять из 4 чисел: min_lon,min_lat,max_lon,max_lat')
+    # nan и inf проходят float(), а сравнения с nan всегда ложны - проверки ниже их не отсеют
+    if not all(math.isfinite(part) for part in parts):
+        raise ValueError('В bbox допустимы только конечные числа')
+
+    min_lon, min_lat, max_lon, max_lat = parts
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValueError('В bbox минимум больше максимума')
+
+    return min_lon, min_lat, max_lon, max_lat